@@ -6,7 +6,10 @@ other Vissim projects also.
 """
 import os
 from tobin_process.utils import get_project_root
+from tobin_process.utils import TimeIntervalSpec
+from tobin_process.ingest_cache import IngestCache
 import tobin_process.node_evaluation_helper as node_eval_helper  # noqa E402
+import tobin_process.bootstrap as bootstrap
 import numpy as np
 
 if __name__ == "__main__":
@@ -25,6 +28,9 @@ if __name__ == "__main__":
     path_to_output_node_data = os.path.join(
         path_to_interim_data, "process_node_eval.xlsx"
     )
+    # Parsed vissim outputs are cached here. Repeat runs load the cached data instead of
+    # re-parsing the .att file. Run ingest_cache.py to inspect the cache.
+    ingest_cache = IngestCache(os.path.join(path_to_interim_data, "ingest_cache"))
 
     # 2. Set columns to keep, direction order, time interval order, columns to include
     # in results.
@@ -99,8 +105,13 @@ if __name__ == "__main__":
         "9900-13500": "8:00-9:00 am",
         "13500-14400": "9:00-9:15 am",
     }
+    # Time intervals and labels used by all the processing steps. Built once here.
+    timeint_spec_am = TimeIntervalSpec(order_timeint, order_timeint_labels_am)
     # Sort order for the report results column.
     results_cols = ["qlen", "qlenmax", "vehdelay_all", "los"]
+    # Runs to read: the vissim average for the report and the individual runs for the
+    # bootstrap intervals of the delays.
+    keep_runs = ["AVG"] + [str(run) for run in range(1, 11)]
     # Initialize NodeEval class.
     # Check your mapper (path_to_mapper_node_eval) file and the VISSIM network to ensure
     # the mapping between Vissim direction and cardinal directions is correct. Also,
@@ -112,6 +123,10 @@ if __name__ == "__main__":
         path_to_node_eval_res_=path_to_node_eval_res_am,
         path_to_output_node_data_=path_to_output_node_data,
         remove_duplicate_dir=True,
+        ingest_cache_=ingest_cache,
+        # Only read the columns and runs used below from the .att file.
+        read_cols_=keep_cols,
+        read_runs_=keep_runs,
     )
     # After the execution of this function, analyst can access:
     #   node_eval_am.node_eval_res, node_eval_am.node_eval_mapper,
@@ -125,7 +140,7 @@ if __name__ == "__main__":
     #   node_eval_am.node_eval_res_fil
     node_eval_am.clean_node_eval(
         keep_cols_=keep_cols,
-        keep_runs_=["AVG"],
+        keep_runs_=keep_runs,
         keep_movement_fromlink_level_=[1, np.nan],
     )
     # Test if there are missing Vissim directions in the Mapper File
@@ -144,25 +159,31 @@ if __name__ == "__main__":
     node_eval_am.test_deduplicate_has_correct_values()
     # Test that each direction in a node occur only one time.
     node_eval_am.test_unique_dir_per_node()
-    # Get delay by intersection
-    node_eval_am.get_veh_delay_by_intersection()
-    # Get delay by approach.
-    node_eval_am.get_veh_delay_by_approach()
-    # Concatenate data by direction, approach, and intersection.
-    node_eval_am.set_report_data(
-        df_list=[
-            node_eval_am.node_eval_res_fil_uniq_dir,
-            node_eval_am.node_intersection_delay,
-            node_eval_am.node_approach_delay,
-        ]
+    # Peak hour of each intersection and of all the intersections, from the movement
+    # volumes. Compare with the report time intervals. Searched after the warm-up
+    # (2700 s) and over the hourly intervals only: the volumes of "13500-14400" would
+    # be spread over windows that do not start on an hour.
+    node_peak_hours, network_peak_hour = node_eval_am.get_peak_windows(
+        start_=2700, end_=13500
     )
+    print(node_peak_hours)
+    print(network_peak_hour)
+    # Get delay by intersection and approach in one grouped pass and concatenate data by
+    # direction, intersection, and approach. Same as get_veh_delay_by_intersection,
+    # get_veh_delay_by_approach and set_report_data.
+    node_eval_am.set_report_data_rollup()
     # Get LOS based on the type of intersection.
     node_eval_am.set_los()
-    # Format report table using multi-index.
+    # 95% bootstrap intervals of the delays from the individual runs, saved to the "ci"
+    # sheet of the output file.
+    node_ci = bootstrap.bootstrap_node_ci(node_eval_am, seed_=0)
+    # Format report table using multi-index. Only the vissim average is reported.
     node_eval_am.format_report_table(
         order_direction_results_=order_direction_results,
-        order_timeint_=order_timeint,
+        order_timeint_=None,
         results_cols_=results_cols,
-        order_timeint_label_=order_timeint_labels_am,
+        order_timeint_label_=None,
+        timeint_spec_=timeint_spec_am,
+        report_runs_=["AVG"],
     )
-    node_eval_am.save_output_file()
+    node_eval_am.save_output_file(ci_=node_ci)
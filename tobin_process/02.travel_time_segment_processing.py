@@ -2,7 +2,13 @@ import pandas as pd
 import os
 import glob
 from tobin_process.utils import get_project_root
+from tobin_process.utils import TimeIntervalSpec
+from tobin_process.ingest_cache import IngestCache
+from tobin_process.occupancy import OccupancyTable
 import tobin_process.travel_time_seg_helper as tt_helper
+import tobin_process.run_count as run_count
+import tobin_process.bootstrap as bootstrap
+from tobin_process.quantile_sketch import check_relative_accuracy
 
 if __name__ == "__main__":
     # 1. Set the paths for input files and output files.
@@ -19,6 +25,12 @@ if __name__ == "__main__":
         os.path.join(path_to_raw_data, "AM_Raw Travel Time", "*.mer")
     )
     path_to_output_tt = os.path.join(path_to_interim_data, "process_tt.xlsx")
+    path_to_run_count_tracker = os.path.join(
+        path_to_interim_data, "run_count_tracker_tt.pkl"
+    )
+    # Parsed vissim outputs are cached here. Repeat runs load the cached data instead of
+    # re-parsing the .rsr files. Run ingest_cache.py to inspect the cache.
+    ingest_cache = IngestCache(os.path.join(path_to_interim_data, "ingest_cache"))
     path_to_output_fig = os.path.join(path_to_interim_data, "figures")
     if not os.path.exists(path_to_output_fig):
         os.mkdir(path_to_output_fig)
@@ -79,6 +91,8 @@ if __name__ == "__main__":
         "6:45-7:00",
         "7:00-7:15",
     ]
+    # Time intervals and labels used by all the processing steps. Built once here.
+    timeint_spec_am = TimeIntervalSpec(order_timeint, order_timeint_labels_am)
     # Report vehicle classes and corresponding vissim vehicle types.
     veh_types_res_cls = {
         "car_hgv_bus": [100, 200, 300, 301, 302, 303, 304, 305],
@@ -88,6 +102,20 @@ if __name__ == "__main__":
 
     # Which data collection points to use for vehicle occupancy?
     use_data_col_no = [3000, 3001, 3002, 3003, 3004, 3005, 3006, 3007, 3008]
+    # Occupancy of each vissim vehicle type: persons per vehicle, or the data collection
+    # points where the occupancy is measured (bus passengers).
+    occupancy_table = OccupancyTable(
+        {
+            100: 1.3,
+            200: 1.3,
+            300: use_data_col_no,
+            301: use_data_col_no,
+            302: use_data_col_no,
+            303: use_data_col_no,
+            304: use_data_col_no,
+            305: use_data_col_no,
+        }
+    )
     # Columns to keep.
     keep_cols = ["time", "no", "veh", "veh_type", "trav", "delay", "dist"]
     # Result columns.
@@ -95,6 +123,9 @@ if __name__ == "__main__":
         "avg_trav",
         "avg_speed",
         "q95_trav",
+        # 95th percentile of the vehicles of all the runs (q95_trav is the average of
+        # the per-run 95th percentiles).
+        "q95_trav_pooled",
         "avg_veh_delay",
         "avg_pers_delay",
         "tot_veh",
@@ -107,6 +138,10 @@ if __name__ == "__main__":
 
     # Which Travel time segments to include in travel time results
     plot_tt_segs = [1, 23, 4, 20, 21, 11, 12, 13]
+    # Relative accuracy of q95_trav_pooled. Checked against np.quantile on random
+    # travel times before it is used (raises an AssertionError if a quantile is off).
+    sketch_accuracy = 0.005
+    check_relative_accuracy(sketch_accuracy)
     tt_eval_am = tt_helper.TtEval(
         path_to_mapper_tt_seg_=path_to_mapper_tt_seg,
         paths_tt_vissim_raw_=paths_tt_vissim_raw,
@@ -119,31 +154,69 @@ if __name__ == "__main__":
     # Delete the following if you do not want to incoporate occupancy data from data
     # collection points:
     #     paths_data_col_vissim_raw_ = paths_data_col_vissim_raw,
-    #     use_data_col_no_ = use_data_col_no,
-    #     use_data_col_res = True,
-    #     car_hgv_veh_occupancy = 1.3,
-    # TODO: Make the read_rsr_tt and get_person_delay_from_data_col_raw_data_bus_occupancy more
-    #  flexible.
-    #  Currently it makes assumption about what vehicle types are buses; all vehicle type
-    #  below 300 are considered cars and HGVs and all vehicle type above or equal to 300
-    #  are considered buses.
-    #  Let user define what vehicle type is a bus. I (Apoorb) have hard coded this for
-    #  Tobin Bridge.
+    #     occupancy_table_ = occupancy_table,
     tt_eval_am.read_rsr_tt(
-        order_timeint_=order_timeint,
-        order_timeint_labels_=order_timeint_labels_am,
+        order_timeint_=None,
+        order_timeint_labels_=None,
+        timeint_spec_=timeint_spec_am,
         veh_types_res_cls_=veh_types_res_cls,
         keep_cols_=keep_cols,
         keep_tt_segs_=keep_tt_segs,
+        ingest_cache_=ingest_cache,
         paths_data_col_vissim_raw_=paths_data_col_vissim_raw,
-        use_data_col_no_=use_data_col_no,
-        use_data_col_res=True,
-        car_hgv_veh_occupancy=1.3,
+        occupancy_table_=occupancy_table,
+        # Keep each traversal once; the overlapping report classes are aggregated with
+        # the vehicle type x class membership matrix.
+        class_masks_=True,
+        # Sketch the travel times for q95_trav_pooled.
+        pooled_quantiles_="q95_trav_pooled" in results_cols,
+        sketch_accuracy_=sketch_accuracy,
+    )
+    # Peak hour (1 minute steps) of each travel time segment and run, and of all the
+    # traversals, from the .rsr exit times.
+    tt_peak_hours, corridor_peak_hour = tt_eval_am.get_peak_windows(
+        start_=2700, end_=14400
     )
+    tt_peak_hours.to_excel(os.path.join(path_to_interim_data, "peak_hours_tt.xlsx"))
+    print(corridor_peak_hour)
+    # Hourly and peak hour run aggregates from the traversals read above, without
+    # re-reading the .rsr files. Add other schemes (e.g. 5-minute) to the dict.
+    rebinned_am = tt_eval_am.get_rebinned_rsr_tt(
+        {
+            "hourly": TimeIntervalSpec(
+                ["2700-6300", "6300-9900", "9900-13500"],
+                ["6:00-7:00", "7:00-8:00", "8:00-9:00"],
+            ),
+            "peak_hour": TimeIntervalSpec(
+                corridor_peak_hour.peak_timeint.tolist(), ["peak_hour"]
+            ),
+        }
+    )
+    for name, (tt_vissim_raw_grp_runs, _) in rebinned_am.items():
+        tt_vissim_raw_grp_runs.to_excel(
+            os.path.join(path_to_interim_data, f"process_tt_runs_{name}.xlsx")
+        )
     # Add travel time segment name and direction to the data with summary statistics for
     # each simulation run.
-    tt_eval_am.merge_mapper()
+    tt_eval_am.merge_mapper(engine_="lookup")
+    # Number of runs needed for the run averages to be within +/- 10% with 95%
+    # confidence. The tracker is saved, so re-running after each new seed only adds the
+    # new runs. Stop launching seeds once no group is left in get_unconverged().
+    run_count_tracker = run_count.load_run_count_tracker(
+        path_to_run_count_tracker,
+        keys_=run_count.TT_RUN_KEYS,
+        metrics_=run_count.TT_RUN_METRICS,
+        tolerance_=0.1,
+        confidence_=0.95,
+    )
+    run_count_tracker.update(run_count.get_tt_run_results(tt_eval_am))
+    run_count_tracker.save(path_to_run_count_tracker)
+    print(run_count_tracker.get_unconverged())
+    print(f"Runs to add: {run_count_tracker.get_runs_to_add()}")
     # Aggregate travel time results to get an average of all simulation runs.
     tt_eval_am.agg_tt(results_cols_=results_cols)
-    tt_eval_am.save_tt_processed()
+    # 95% bootstrap intervals of the run averages, saved to the "ci" sheet of the output
+    # file.
+    tt_ci = bootstrap.bootstrap_tt_ci(tt_eval_am, seed_=0)
+    tt_eval_am.save_tt_processed(ci_=tt_ci)
     tt_eval_am.plot_heatmaps(segs_to_plot=plot_tt_segs, var="avg_speed")
@@ -2,7 +2,10 @@ import pandas as pd
 import os
 import glob
 from tobin_process.utils import get_project_root
+from tobin_process.utils import TimeIntervalSpec
+from tobin_process.ingest_cache import IngestCache
 import tobin_process.bus_headway_helper as bus_helper
+import tobin_process.bootstrap as bootstrap
 
 if __name__ == "__main__":
     # 1. Set the paths for input files and output files.
@@ -18,6 +21,9 @@ if __name__ == "__main__":
         os.path.join(path_to_raw_data, "AM_Raw Travel Time", "*.rsr")
     )
     path_to_output_headway = os.path.join(path_to_interim_data, "process_headway.xlsx")
+    # Parsed vissim outputs are cached here. Repeat runs load the cached data instead of
+    # re-parsing the .rsr files. Run ingest_cache.py to inspect the cache.
+    ingest_cache = IngestCache(os.path.join(path_to_interim_data, "ingest_cache"))
     # 2. Set time interval, time interval labels, report vehicle classes mapping to
     # vehicle types, occupancy by vissim vehicle type, results column to retain,
     # travel time segments to keep.
@@ -29,6 +35,8 @@ if __name__ == "__main__":
     order_timeint_labels_am = ["6:00-7:00", "7:00-8:00", "8:00-9:00", "9:00-9:15"]
     # Vissim time interval labels for pm.
     order_timeint_labels_pm = ["4:00-5:00", "5:00-6:00", "6:00-7:00", "7:00-7:15"]
+    # Time intervals and labels used by all the processing steps. Built once here.
+    timeint_spec_am = TimeIntervalSpec(order_timeint, order_timeint_labels_am)
     # Report vehicle classes and corresponding vissim vehicle types.
     veh_types_res_cls = {
         "MBTA-111": [301],
@@ -62,14 +70,20 @@ if __name__ == "__main__":
     # read_rsr_tt is same function as that used in 02.travel_time_segment_processing.py
     # but without the parameters that are required for occupancy/ person delay processing.
     bus_headway_am.read_rsr_tt(
-        order_timeint_=order_timeint,
-        order_timeint_labels_=order_timeint_labels_am,
+        order_timeint_=None,
+        order_timeint_labels_=None,
+        timeint_spec_=timeint_spec_am,
         veh_types_res_cls_=veh_types_res_cls,
         keep_cols_=keep_cols,
         keep_tt_segs_=keep_tt_segs,
+        ingest_cache_=ingest_cache,
     ) # read_rsr_tt inherited from TtEval
     # Add travel time segment name and direction to the raw data for each simulation
     # run.
     bus_headway_am.merge_mapper() # merge_mapper inherited from TtEval
-    bus_headway_am.get_headway_stats()
-    bus_headway_am.save_headway()
+    # The numpy engine uses the time order of the .rsr rows instead of sorting all the
+    # runs; same results as the default pandas engine.
+    bus_headway_am.get_headway_stats(engine_="numpy")
+    # 95% bootstrap intervals of avg_headway, saved to the "ci" sheet of the output file.
+    headway_ci = bootstrap.bootstrap_headway_ci(bus_headway_am, seed_=0)
+    bus_headway_am.save_headway(ci_=headway_ci)
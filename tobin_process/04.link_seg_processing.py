@@ -1,6 +1,8 @@
 import os
 from tobin_process.utils import remove_special_char_vissim_col
 from tobin_process.utils import get_project_root
+from tobin_process.utils import TimeIntervalSpec
+from tobin_process.ingest_cache import IngestCache
 import tobin_process.link_seg_helper as link_helper
 
 
@@ -26,6 +28,10 @@ if __name__ == "__main__":
     )
     if not os.path.exists(path_to_output_link_seg_fig):
         os.mkdir(path_to_output_link_seg_fig)
+    path_to_link_seg_cube = os.path.join(path_to_interim_data, "link_seg_cube_am.npz")
+    # Parsed vissim outputs are cached here. Repeat runs load the cached data instead of
+    # re-parsing the .att file. Run ingest_cache.py to inspect the cache.
+    ingest_cache = IngestCache(os.path.join(path_to_interim_data, "ingest_cache"))
     # 2. Set columns to keep, direction order, time interval order, columns to include
     # in results.
     # ************************************************************************************
@@ -88,6 +94,8 @@ if __name__ == "__main__":
         "6:45-7:00",
         "7:00-7:15",
     ]
+    # Time intervals and labels used by all the processing steps. Built once here.
+    timeint_spec_am = TimeIntervalSpec(order_timeint, order_timeint_labels_am)
     # Vissim runs to output result for: 1,2, ... or "AVG".
     keep_runs = ["AVG"]
 
@@ -95,19 +103,26 @@ if __name__ == "__main__":
         path_to_mapper_link_seg_=path_to_mapper_link_seg,
         path_link_seg_vissim_=path_link_seg_vissim,
         path_to_output_link_seg_fig_=path_to_output_link_seg_fig,
+        ingest_cache_=ingest_cache,
+        read_runs_=keep_runs,
     )
     link_seg_am.read_link_seg()
 
     link_seg_am.clean_filter_link_eval(
         keep_runs_=keep_runs,
         keep_cols_=keep_cols,
-        order_timeint_=order_timeint,
-        order_timeint_labels_=order_timeint_labels_am,
+        order_timeint_=None,
+        order_timeint_labels_=None,
+        timeint_spec_=timeint_spec_am,
     )
     # Test if the analyst has set the link evaluation length to correct value in vissim.
     link_seg_am.test_seg_eval_len(eval_len=1000)
 
     link_seg_am.merge_link_mapper()
+    # Space-time cube of the results, built once. The heatmaps slice it; the saved cube
+    # can be reloaded with link_seg_cube.load_link_seg_cube.
+    link_seg_am.set_link_seg_cube()
+    link_seg_am.link_seg_cube.save(path_to_link_seg_cube)
 
     link_seg_am.plot_heatmaps(
         plot_var="speed_1020",
@@ -139,9 +154,7 @@ if __name__ == "__main__":
         colorscale_="viridis",
     )
 
-    link_seg_am.link_seg_vissim_fil_ord = link_seg_am.link_seg_vissim_fil_ord.assign(
-        density_1020_by_ln=lambda df: df.density_1020 / df.linkevalsegment_link_numlanes
-    )
+    link_seg_am.add_density_by_lane()
     link_seg_am.plot_heatmaps(
         plot_var="density_1020_by_ln",
         index_var="display_name",
@@ -0,0 +1,292 @@
+"""
+Module for bootstrap confidence intervals of the results averaged across vissim runs
+(travel times, delays, queues, headways). The runs are resampled with replacement. All
+the bootstrap replicates are drawn as one (replicates x runs) index matrix and turned
+into run counts; the replicate means of all the groups are then a single matrix product
+of the per-run sums with the run counts, with no loop over the replicates.
+"""
+import numpy as np
+import pandas as pd
+from tobin_process.grouped_stats import factorize_groups
+
+
+def draw_run_counts(n_runs_, n_boot_, seed_=None):
+    """
+    Number of times each run is drawn in each bootstrap replicate.
+    Parameters
+    ----------
+    n_runs_: int
+        Number of vissim runs.
+    n_boot_: int
+        Number of bootstrap replicates.
+    seed_: int
+        Seed for reproducible intervals.
+    Returns
+    -------
+    run_counts: np.ndarray
+        Shape (n_boot_, n_runs_); each row sums to n_runs_.
+    """
+    rng = np.random.default_rng(seed_)
+    # All the replicates as one index matrix.
+    boot_idx = rng.integers(0, n_runs_, size=(n_boot_, n_runs_))
+    flat_idx = (np.arange(n_boot_)[:, None] * n_runs_ + boot_idx).ravel()
+    return np.bincount(flat_idx, minlength=n_boot_ * n_runs_).reshape(
+        n_boot_, n_runs_
+    )
+
+
+def bootstrap_ci(
+    df_,
+    keys_,
+    value_cols_,
+    run_col_="run_no",
+    weight_col_=None,
+    n_boot_=2000,
+    ci_level_=0.95,
+    seed_=None,
+):
+    """
+    Percentile bootstrap confidence interval of the mean across runs of value_cols_ for
+    each group of keys_. The same resampled runs are used for all the groups of a
+    replicate.
+    Parameters
+    ----------
+    df_: pd.DataFrame
+        Per-run results, e.g. TtEval.tt_vissim_raw_grp_runs. One row per group and run
+        (rows of the same group and run are averaged).
+    keys_: list
+        Group columns.
+    value_cols_: list
+        Columns to compute intervals for.
+    run_col_: str
+        Run column.
+    weight_col_: str
+        If given, weighted mean across runs, e.g. with the number of buses of each run
+        so that the mean is the mean over all the buses. Default: runs count equally,
+        as in TtEval.agg_tt.
+    n_boot_: int
+        Number of bootstrap replicates.
+    ci_level_: float
+        Confidence level, e.g. 0.95 for the 2.5% and 97.5% percentiles.
+    seed_: int
+        Seed for reproducible intervals.
+    Returns
+    -------
+    boot_ci: pd.DataFrame
+        One row per group, indexed by keys_. Columns (value col, stat) with stat in
+        mean, ci_low and ci_high, and n_runs with the number of runs with the group.
+    """
+    if not 0 < ci_level_ < 1:
+        raise ValueError("ci_level_ needs to be between 0 and 1.")
+    group_codes, group_index = factorize_groups(df_, keys_)
+    run_codes, runs = pd.factorize(df_[run_col_])
+    keep = (group_codes >= 0) & (run_codes >= 0)
+    n_groups, n_runs = len(group_index), len(runs)
+    cell_idx = group_codes[keep] * n_runs + run_codes[keep]
+    weights = (
+        np.ones(keep.sum())
+        if weight_col_ is None
+        else df_[weight_col_].values[keep].astype(np.float64)
+    )
+    run_counts = draw_run_counts(n_runs, n_boot_, seed_)
+    alpha = (1 - ci_level_) / 2
+    boot_ci = {}
+    n_runs_group = None
+    for value_col in value_cols_:
+        values = df_[value_col].values[keep].astype(np.float64)
+        valid = ~np.isnan(values)
+        # Per-run weighted sums of each group: (groups x runs) matrices.
+        value_sums = np.bincount(
+            cell_idx[valid],
+            weights=weights[valid] * values[valid],
+            minlength=n_groups * n_runs,
+        ).reshape(n_groups, n_runs)
+        weight_sums = np.bincount(
+            cell_idx[valid], weights=weights[valid], minlength=n_groups * n_runs
+        ).reshape(n_groups, n_runs)
+        # Rows of the same group and run are averaged.
+        n_rows = np.bincount(cell_idx[valid], minlength=n_groups * n_runs).reshape(
+            n_groups, n_runs
+        )
+        with np.errstate(invalid="ignore", divide="ignore"):
+            run_weights = np.where(n_rows > 0, weight_sums / np.maximum(n_rows, 1), 0)
+            run_means = np.where(weight_sums != 0, value_sums / weight_sums, 0)
+            # (groups x replicates) in one product.
+            boot_means = ((run_weights * run_means) @ run_counts.T) / (
+                run_weights @ run_counts.T
+            )
+            mean = (run_weights * run_means).sum(axis=1) / run_weights.sum(axis=1)
+        ci_low, ci_high = np.full(n_groups, np.nan), np.full(n_groups, np.nan)
+        has_boot = ~np.isnan(boot_means).all(axis=1)
+        if has_boot.any():
+            ci_low[has_boot], ci_high[has_boot] = np.nanquantile(
+                boot_means[has_boot], [alpha, 1 - alpha], axis=1
+            )
+        boot_ci[(value_col, "mean")] = mean
+        boot_ci[(value_col, "ci_low")] = ci_low
+        boot_ci[(value_col, "ci_high")] = ci_high
+        if n_runs_group is None:
+            n_runs_group = (n_rows > 0).sum(axis=1)
+    boot_ci[("n_runs", "")] = n_runs_group
+    return pd.DataFrame(boot_ci, index=group_index)
+
+
+def get_report_col_names(value_cols_):
+    """
+    {value col}_ci_low and {value col}_ci_high for each value col.
+    """
+    return [
+        f"{value_col}_{stat}"
+        for value_col in value_cols_
+        for stat in ("ci_low", "ci_high")
+    ]
+
+
+def to_report_columns(boot_ci_, value_cols_, column_level_=None, column_order_=None):
+    """
+    Flatten the bootstrap_ci columns to {value col}_ci_low and {value col}_ci_high.
+    If column_level_ is given, move this index level to the columns, with its values in
+    column_order_ order, like the report tables.
+    """
+    report_ci = pd.DataFrame(
+        {
+            f"{value_col}_{stat}": boot_ci_[(value_col, stat)]
+            for value_col in value_cols_
+            for stat in ("ci_low", "ci_high")
+        },
+        index=boot_ci_.index,
+    )
+    if column_level_ is None:
+        return report_ci
+    mux = pd.MultiIndex.from_product(
+        [list(column_order_), get_report_col_names(value_cols_)],
+        names=[column_level_, ""],
+    )
+    return report_ci.unstack(column_level_).swaplevel(axis=1).reindex(mux, axis=1)
+
+
+def bootstrap_tt_ci(
+    tt_eval_, value_cols_=("avg_trav", "q95_trav", "avg_veh_delay"), **kwargs
+):
+    """
+    Bootstrap intervals for the travel time results of TtEval.agg_tt.
+    Parameters
+    ----------
+    tt_eval_: tobin_process.travel_time_seg_helper.TtEval
+        After merge_mapper.
+    value_cols_: list
+        Columns of tt_eval_.tt_vissim_raw_grp_runs.
+    kwargs:
+        n_boot_, ci_level_, seed_. See bootstrap_ci.
+    Returns
+    -------
+    tt_ci: pd.DataFrame
+        Same layout as tt_eval_.tt_vissim_raw_grps_ttname_agg: index (timeint,
+        direction, tt_seg_name), columns (veh_cls_res, {value col}_ci_low/ ci_high).
+        Saved next to the agg_tt table with TtEval.save_tt_processed(ci_=tt_ci).
+    """
+    tt_vissim_raw_grp_runs = tt_eval_.tt_vissim_raw_grp_runs.loc[
+        lambda df: df.run_no.notna()
+    ]
+    boot_ci = bootstrap_ci(
+        tt_vissim_raw_grp_runs,
+        keys_=["timeint", "direction", "tt_seg_name", "veh_cls_res"],
+        value_cols_=list(value_cols_),
+        run_col_="run_no",
+        **kwargs
+    )
+    return to_report_columns(
+        boot_ci,
+        value_cols_,
+        column_level_="veh_cls_res",
+        column_order_=tt_eval_.veh_types_res_cls.keys(),
+    )
+
+
+def bootstrap_node_ci(
+    node_eval_, value_cols_=("vehdelay_all",), exclude_runs_=("AVG",), **kwargs
+):
+    """
+    Bootstrap intervals for the node results (movement, approach, and intersection).
+    Parameters
+    ----------
+    node_eval_: tobin_process.node_evaluation_helper.NodeEval
+        After set_report_data or set_report_data_rollup with the individual runs in
+        keep_runs_ of clean_node_eval.
+    value_cols_: list
+        Columns of node_eval_.report_data.
+    exclude_runs_: list
+        Runs that are not simulation runs, e.g. the vissim average "AVG".
+    kwargs:
+        n_boot_, ci_level_, seed_. See bootstrap_ci.
+    Returns
+    -------
+    node_ci: pd.DataFrame
+        Index (node_no, direction_results), columns (timeint, {value col}_ci_low/
+        ci_high) with the time intervals in the order of report_data. Saved next to
+        the report table with NodeEval.save_output_file(ci_=node_ci).
+    """
+    report_data = node_eval_.report_data.loc[
+        lambda df: ~df.movementevaluation_simrun.isin(exclude_runs_)
+    ]
+    if report_data.empty:
+        raise ValueError(
+            "No individual runs in report_data. Add them to keep_runs_ of "
+            "clean_node_eval."
+        )
+    boot_ci = bootstrap_ci(
+        report_data,
+        keys_=["timeint", "node_no", "direction_results"],
+        value_cols_=list(value_cols_),
+        run_col_="movementevaluation_simrun",
+        **kwargs
+    )
+    return to_report_columns(
+        boot_ci,
+        value_cols_,
+        column_level_="timeint",
+        column_order_=report_data.timeint.unique(),
+    )
+
+
+def bootstrap_headway_ci(bus_headway_, **kwargs):
+    """
+    Bootstrap intervals for avg_headway of BusHeadway.get_headway_stats. avg_headway is
+    the mean over the buses of all the runs, so the runs are weighted by their number
+    of headways.
+    Parameters
+    ----------
+    bus_headway_: tobin_process.bus_headway_helper.BusHeadway
+        After get_headway_stats.
+    kwargs:
+        n_boot_, ci_level_, seed_. See bootstrap_ci.
+    Returns
+    -------
+    headway_ci: pd.DataFrame
+        Same rows and key columns as bus_headway_.tt_vissim_headway_grp, with
+        avg_headway_ci_low and avg_headway_ci_high. Saved next to the headway table
+        with BusHeadway.save_headway(ci_=headway_ci).
+    """
+    keys = ["direction", "tt_seg_name", "veh_cls_res", "timeint"]
+    headway_runs = (
+        bus_headway_.tt_vissim_headway.groupby(keys + ["run_no"], observed=True)
+        .headway.agg(["mean", "count"])
+        .rename(columns={"mean": "avg_headway", "count": "n_headway"})
+        .reset_index()
+    )
+    boot_ci = bootstrap_ci(
+        headway_runs,
+        keys_=keys,
+        value_cols_=["avg_headway"],
+        run_col_="run_no",
+        weight_col_="n_headway",
+        **kwargs
+    )
+    return (
+        bus_headway_.tt_vissim_headway_grp.filter(items=keys)
+        .merge(
+            to_report_columns(boot_ci, ["avg_headway"]).reset_index(),
+            on=keys,
+            how="left",
+        )
+    )
@@ -3,18 +3,59 @@ import numpy as np
 import os
 import glob
 from tobin_process.utils import get_project_root
+from tobin_process.grouped_stats import grouped_stats
+from tobin_process.grouped_stats import grouped_diff
+from tobin_process.grouped_stats import GroupIndex
 import tobin_process.travel_time_seg_helper as tt_helper
 
 
+# Headways are computed within each run, direction, segment and class...
+HEADWAY_RUN_KEYS = ["run_no", "direction", "tt_seg_name", "veh_cls_res"]
+# ...and summarised across runs by direction, segment, class and time interval.
+HEADWAY_STAT_KEYS = ["direction", "tt_seg_name", "veh_cls_res", "timeint"]
+HEADWAY_STATS = {
+    "avg_headway": "mean",
+    "min_headway": "min",
+    "q50_headway": 0.5,
+    "q95_headway": 0.95,
+    "max_headway": "max",
+    "std_dev_headway": "std",
+    "coeff_var_headway": "cv",
+}
+
+
 class BusHeadway(tt_helper.TtEval):
     """
+    Class for processing bus headways from the travel time (.rsr) results. Inherits
+    read_rsr_tt and merge_mapper from TtEval.
 
+    ...
+    Attributes
+    ___________
+    path_to_output_headway: str
+        Path to output the processed bus headway results.
+    tt_vissim_headway: pd.DataFrame()
+        Headway of each bus (all the traversals but the first of each run, direction,
+        segment and class), sorted by run, direction, segment, class and time.
+    tt_vissim_headway_grp: pd.DataFrame()
+        Headway statistics across runs by direction, segment, class and time interval.
+    headway_group_index: tobin_process.grouped_stats.GroupIndex
+        Group index of tt_vissim_headway on HEADWAY_RUN_KEYS and timeint. Coarsened to
+        HEADWAY_STAT_KEYS for the statistics and to HEADWAY_RUN_KEYS for the headway
+        arrays. Set by get_headway_stats.
+    Methods
+    ________
+    get_headway_stats(engine_="pandas"): Get headways and headway statistics.
+    get_headway_arrays(): Headway arrays of each run, direction, segment and class.
+    save_headway(ci_=None): Save tt_vissim_headway_grp (and the bootstrap intervals ci_
+        on a second sheet).
     """
     def __init__(
         self,
         paths_tt_vissim_raw_,
         path_to_mapper_bus_headway_,
         path_to_output_headway_,
+        mapper_cache_=None,
     ):
         """
         Parameters
@@ -25,70 +66,142 @@ class BusHeadway(tt_helper.TtEval):
             Path to the bus headway mapper file.
         path_to_output_headway_: str
             Path to output the processed bus headway results.
+        mapper_cache_: tobin_process.mapper_cache.MapperCache
+            Cache for the parsed mapper workbook. See TtEval.
         """
         self.path_to_output_headway = path_to_output_headway_
+        self.tt_vissim_headway = pd.DataFrame()
         self.tt_vissim_headway_grp = pd.DataFrame()
+        self.headway_group_index = None
         super().__init__(
             path_to_mapper_tt_seg_=path_to_mapper_bus_headway_,
             paths_tt_vissim_raw_=paths_tt_vissim_raw_,
             path_output_tt_="",
             path_to_output_tt_fig_="",
+            mapper_cache_=mapper_cache_,
         )
 
-    def get_headway_stats(self):
+    def get_headway_stats(self, engine_="pandas"):
         """
         Get headway statistics by using the data from all vissim runs.
+        Parameters
+        ----------
+        engine_: str
+            "pandas" (default) sorts tt_vissim_raw on the group columns and time and
+            uses groupby diff. "numpy" uses the time order of the .rsr rows within each
+            run: only a stable sort on the group codes is needed and headways are array
+            differences masked at the group boundaries (see grouped_stats.grouped_diff).
+            Same results; use it for many transit routes and runs.
+        """
+        if self.class_masks:
+            raise ValueError(
+                "Headways need veh_cls_res in tt_vissim_raw. Use read_rsr_tt with "
+                "class_masks_=False."
+            )
+        if engine_ == "numpy":
+            self.tt_vissim_headway = self.get_headways_numpy()
+        elif engine_ == "pandas":
+            self.tt_vissim_headway = self.get_headways_pandas()
+            self.headway_group_index = GroupIndex(
+                self.tt_vissim_headway, HEADWAY_RUN_KEYS + ["timeint"]
+            )
+        else:
+            raise ValueError(f"Unknown headway engine {engine_}. Use 'pandas' or 'numpy'.")
+        # Get aggregate statistics for headway across all vissim runs. All the groups
+        # are summarised in one sorted pass; see grouped_stats.
+        self.tt_vissim_headway_grp = (
+            grouped_stats(
+                self.tt_vissim_headway,
+                keys_=HEADWAY_STAT_KEYS,
+                value_col_="headway",
+                stats_=HEADWAY_STATS,
+                group_index_=self.headway_group_index.coarsen(HEADWAY_STAT_KEYS),
+            )
+            .dropna(axis=0)
+            .reset_index()
+        )
+
+    def get_headways_pandas(self):
+        """
+        Headway of each bus with sort_values and groupby diff.
         """
         # Get headway by individual vissim run.
         # TODO: Figure out the aggregation variables. Should we use veh_type or
         #  veh_cls_res?
+        # Filter the columns before sorting so that only the columns used below are
+        # copied. In compact mode (see read_rsr_tt) the group columns are small integers
+        # and categoricals.
         tt_vissim_headway = (
-            self.tt_vissim_raw.sort_values(
-                ["run_no", "direction", "tt_seg_name", "veh_cls_res", "time",]
+            self.tt_vissim_raw.filter(
+                items=HEADWAY_RUN_KEYS + ["veh", "veh_type", "timeint", "time"]
             )
+            .sort_values(HEADWAY_RUN_KEYS + ["time"])
             .assign(
-                headway=lambda df: df.groupby(
-                    ["run_no", "direction", "tt_seg_name", "veh_cls_res"]
-                )["time"].diff()
-            )
-            .filter(
-                items=[
-                    "run_no",
-                    "direction",
-                    "tt_seg_name",
-                    "veh_type",
-                    "veh_cls_res",
-                    "timeint",
-                    "time",
-                    "headway",
-                ]
+                headway=lambda df: df.groupby(HEADWAY_RUN_KEYS)["time"].diff()
             )
         )
-        tt_vissim_headway_fil = tt_vissim_headway.query("~ headway.isna()")
+        return tt_vissim_headway.query("~ headway.isna()")
 
-        # Get aggregate statistics for headway across all vissim runs.
-        self.tt_vissim_headway_grp = (
-            tt_vissim_headway_fil.groupby(
-                ["direction", "tt_seg_name", "veh_cls_res", "timeint"]
-            )
-            .agg(
-                avg_headway=("headway", "mean"),
-                min_headway=("headway", "min"),
-                q50_headway=("headway", lambda x: np.quantile(x, 0.5)),
-                q95_headway=("headway", lambda x: np.quantile(x, 0.95)),
-                max_headway=("headway", "max"),
-                std_dev_headway=("headway", "std"),
-                coeff_var_headway=("headway", lambda x: x.std() / x.mean()),
+    def get_headways_numpy(self):
+        """
+        Headway of each bus with grouped_stats.grouped_diff. Sets headway_group_index.
+        """
+        # Factorized once: the headways are within the run groups and the statistics
+        # are by time interval.
+        raw_group_index = GroupIndex(self.tt_vissim_raw, HEADWAY_RUN_KEYS + ["timeint"])
+        run_group_index = raw_group_index.coarsen(HEADWAY_RUN_KEYS)
+        order, headway, _ = grouped_diff(
+            run_group_index.codes,
+            self.tt_vissim_raw.time.values,
+            run_group_index.n_groups,
+        )
+        # The first bus of each group has no headway.
+        has_headway = ~np.isnan(headway)
+        self.headway_group_index = raw_group_index.take(order[has_headway])
+        return (
+            self.tt_vissim_raw.filter(
+                items=HEADWAY_RUN_KEYS + ["veh", "veh_type", "timeint", "time"]
             )
-            .dropna(axis=0)
-            .reset_index()
+            .take(order[has_headway])
+            .assign(headway=headway[has_headway])
         )
 
-    def save_headway(self):
+    def get_headway_arrays(self):
+        """
+        Headway arrays of each run, direction, segment and class, in time order.
+        Returns
+        -------
+        headway_arrays: dict
+            (run_no, direction, tt_seg_name, veh_cls_res) --> np.ndarray.
+        """
+        if self.tt_vissim_headway.empty:
+            raise ValueError("No headways. Run get_headway_stats first.")
+        run_group_index = self.headway_group_index.coarsen(HEADWAY_RUN_KEYS)
+        # Rows are in time order within each group.
+        order, offsets = run_group_index.get_offsets()
+        headway = self.tt_vissim_headway.headway.values[order]
+        return {
+            group_key: headway[start:end]
+            for group_key, start, end in zip(
+                run_group_index.group_index, offsets[:-1], offsets[1:]
+            )
+        }
+
+    def save_headway(self, ci_=None):
         """
         Save headwy data.
+        Parameters
+        ----------
+        ci_: pd.DataFrame
+            Bootstrap confidence intervals, e.g. from bootstrap.bootstrap_headway_ci.
+            If given, saved to the "ci" sheet of the same file.
         """
-        self.tt_vissim_headway_grp.to_excel(self.path_to_output_headway)
+        if ci_ is None:
+            self.tt_vissim_headway_grp.to_excel(self.path_to_output_headway)
+            return
+        with pd.ExcelWriter(self.path_to_output_headway) as writer:
+            self.tt_vissim_headway_grp.to_excel(writer)
+            ci_.to_excel(writer, sheet_name="ci")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,636 @@
+"""
+Module with a sort-based kernel for grouped statistics (quantiles, mean, std, coefficient
+of variation...). Replaces groupby aggregations with Python callbacks such as
+lambda x: np.quantile(x, 0.95), which call back into Python once per group. The values
+are sorted once on (group code, value); each group is then a contiguous slice given by
+the group offsets and all the statistics are computed for all the groups with array
+operations. GroupIndex keeps the group codes of a frame so that the key columns are
+factorized once and reused by all the aggregations (and coarser groupings) of the frame.
+"""
+import numpy as np
+import pandas as pd
+from tobin_process.utils import categories_to_object
+from tobin_process.utils import map_index_level
+
+
+class GroupIndex:
+    """
+    Group code of each row of a dataframe for the keys columns, factorized once and
+    reused for all the sums, means, counts and quantiles of the frame. Same groups as
+    df_.groupby(keys) with observed=True: rows with a missing key get code -1 and are
+    not in any group. Coarser group indexes (e.g. without run_no) and the index of a
+    subset of the rows are derived from the integer codes, without factorizing the
+    key columns again.
+
+    ...
+    Attributes
+    ___________
+    keys: list
+        Group columns.
+    key_uniques: dict
+        Key --> sorted unique values (in category order for categorical keys).
+    codes: np.ndarray
+        Group code of each row; -1 for rows with a missing key.
+    n_groups: int
+        Number of groups.
+    level_codes: np.ndarray
+        Shape (n_groups, number of keys): position of the value of each key of each
+        group in key_uniques.
+    group_index: pd.MultiIndex
+        Key values of each group code. Groups are sorted like groupby(keys).
+    fine_group_codes: np.ndarray
+        Set by coarsen: group code of each group of the finer index it was coarsened
+        from. None otherwise.
+    Methods
+    ________
+    coarsen(keys_): Group index of the same rows on a subset of the keys.
+    take(positions_): Group index of the rows at positions_.
+    get_offsets(): Rows sorted by group and the offsets of each group.
+    get_object_index(): group_index with categorical keys as their values.
+    count(values_=None), sum(values_), mean(values_): Count, sum and mean of each group.
+    quantiles(values_, quantiles_, mask_=None): Quantiles of each group.
+    """
+
+    def __init__(self, df_, keys_):
+        """
+        Parameters
+        ----------
+        df_: pd.DataFrame
+            Data.
+        keys_: list
+            Group columns.
+        """
+        if not len(keys_):
+            raise ValueError("Pass at least one key.")
+        self.keys = list(keys_)
+        self.key_uniques = {}
+        self.fine_group_codes = None
+        n_rows = len(df_)
+        combined = np.zeros(n_rows, dtype=np.int64)
+        n_combined = 1
+        list_key_codes = []
+        for key in self.keys:
+            key_codes, key_uniques = pd.factorize(df_[key], sort=True)
+            radix = len(key_uniques) + 1
+            if n_combined * radix > np.iinfo(np.int64).max:
+                # Renumber the combined codes so that they fit in int64.
+                combined_uniques, combined = np.unique(combined, return_inverse=True)
+                n_combined = len(combined_uniques)
+            # Mixed radix with 0 for a missing key: codes of the earlier keys are the
+            # most significant digits.
+            combined = combined * radix + (key_codes + 1)
+            n_combined *= radix
+            list_key_codes.append(key_codes)
+            self.key_uniques[key] = key_uniques
+        _, first_rows, full_codes = np.unique(
+            combined, return_index=True, return_inverse=True
+        )
+        self._set_groups(
+            full_codes.reshape(-1),
+            np.column_stack([key_codes[first_rows] for key_codes in list_key_codes]),
+        )
+
+    @classmethod
+    def _from_codes(cls, keys, key_uniques, full_codes, full_level_codes):
+        group_index = cls.__new__(cls)
+        group_index.keys = list(keys)
+        group_index.key_uniques = {key: key_uniques[key] for key in keys}
+        group_index.fine_group_codes = None
+        group_index._set_groups(full_codes, full_level_codes)
+        return group_index
+
+    def _set_groups(self, full_codes, full_level_codes):
+        # Full groups also include the key combinations with missing keys, so that a
+        # coarser index can keep the rows with a missing value in a dropped key.
+        self._full_codes = full_codes.astype(np.int64)
+        self._full_level_codes = full_level_codes.reshape(-1, len(self.keys))
+        valid = (self._full_level_codes >= 0).all(axis=1)
+        self._full_to_group = np.full(len(valid), -1, dtype=np.int64)
+        self._full_to_group[valid] = np.arange(valid.sum())
+        self.codes = self._full_to_group[self._full_codes]
+        self.n_groups = int(valid.sum())
+        self.level_codes = self._full_level_codes[valid]
+        self.group_index = pd.MultiIndex.from_arrays(
+            [
+                self.key_uniques[key].take(self.level_codes[:, key_no])
+                for key_no, key in enumerate(self.keys)
+            ],
+            names=self.keys,
+        )
+        self._order = None
+        self._offsets = None
+
+    def coarsen(self, keys_):
+        """
+        Group index of the same rows on keys_, a subset of keys (in any order), e.g.
+        without run_no to pool the runs. Only the codes of the groups are combined.
+        Returns
+        -------
+        coarse_index: GroupIndex
+            With fine_group_codes, the coarse group of each group of self.
+        """
+        missing_keys = set(keys_) - set(self.keys)
+        if missing_keys:
+            raise ValueError(f"{sorted(missing_keys)} not in {self.keys}.")
+        key_pos = [self.keys.index(key) for key in keys_]
+        coarse_level_codes, full_to_coarse = np.unique(
+            self._full_level_codes[:, key_pos], axis=0, return_inverse=True
+        )
+        full_to_coarse = full_to_coarse.reshape(-1)
+        coarse_index = GroupIndex._from_codes(
+            keys_,
+            self.key_uniques,
+            full_to_coarse[self._full_codes],
+            coarse_level_codes,
+        )
+        coarse_index.fine_group_codes = coarse_index._full_to_group[
+            full_to_coarse[self._full_to_group >= 0]
+        ]
+        return coarse_index
+
+    def take(self, positions_):
+        """
+        Group index of the rows at positions_ (e.g. df_.take(positions_)). Groups
+        without rows are dropped.
+        """
+        full_codes = self._full_codes[positions_]
+        used_full, full_codes = np.unique(full_codes, return_inverse=True)
+        return GroupIndex._from_codes(
+            self.keys,
+            self.key_uniques,
+            full_codes.reshape(-1),
+            self._full_level_codes[used_full],
+        )
+
+    def get_offsets(self):
+        """
+        Returns
+        -------
+        order: np.ndarray
+            Positions of the rows with a group, sorted by group code. Rows of a group
+            keep their order.
+        offsets: np.ndarray
+            Group g is order[offsets[g]: offsets[g + 1]].
+        """
+        if self._order is None:
+            keep = np.flatnonzero(self.codes >= 0)
+            self._order = keep[np.argsort(self.codes[keep], kind="stable")]
+            self._offsets = np.zeros(self.n_groups + 1, dtype=np.int64)
+            np.cumsum(
+                np.bincount(self.codes[keep], minlength=self.n_groups),
+                out=self._offsets[1:],
+            )
+        return self._order, self._offsets
+
+    def get_object_index(self):
+        """
+        group_index with the categorical keys as their values (object), like the
+        indexes of GroupedMoments and GroupedQuantileSketch.
+        """
+        return pd.MultiIndex.from_frame(
+            categories_to_object(self.group_index.to_frame(index=False))
+        )
+
+    def _get_valid(self, values_):
+        values = np.asarray(values_, dtype=np.float64)
+        return values, (self.codes >= 0) & ~np.isnan(values)
+
+    def count(self, values_=None):
+        """
+        Number of rows of each group; number of non-NaN values_ if given.
+        """
+        if values_ is None:
+            return np.bincount(self.codes[self.codes >= 0], minlength=self.n_groups)
+        _, valid = self._get_valid(values_)
+        return np.bincount(self.codes[valid], minlength=self.n_groups)
+
+    def sum(self, values_):
+        """
+        Sum of values_ of each group. NaN are skipped; groups without values get 0.
+        """
+        values, valid = self._get_valid(values_)
+        return np.bincount(
+            self.codes[valid], weights=values[valid], minlength=self.n_groups
+        )
+
+    def mean(self, values_):
+        """
+        Mean of values_ of each group. NaN are skipped; groups without values get NaN.
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sum(values_) / self.count(values_)
+
+    def quantiles(self, values_, quantiles_, mask_=None):
+        """
+        Quantiles of values_ of each group, like np.quantile (see grouped_quantiles).
+        Parameters
+        ----------
+        values_: np.ndarray
+            Value of each row.
+        quantiles_: list
+            Quantiles between 0 and 1.
+        mask_: np.ndarray
+            If given, only the rows where mask_ is True. Groups without rows get NaN.
+        Returns
+        -------
+        group_quantiles: np.ndarray
+            Shape (n_groups, len(quantiles_)).
+        """
+        codes = self.codes if mask_ is None else np.where(mask_, self.codes, -1)
+        values_sorted, offsets, _ = sort_groups(codes, values_, self.n_groups)
+        return grouped_quantiles(values_sorted, offsets, quantiles_)
+
+
+def factorize_groups(df_, keys_):
+    """
+    Group code for each row of df_ based on the keys_ columns. See GroupIndex.
+    Returns
+    -------
+    codes: np.ndarray
+        Group code for each row; -1 for rows with a missing key.
+    group_index: pd.MultiIndex
+        Key values of each group code. Groups are sorted like groupby(keys_), i.e. in
+        category order for categorical keys.
+    """
+    group_index = GroupIndex(df_, keys_)
+    return group_index.codes, group_index.group_index
+
+
+def sort_groups(codes_, values_, n_groups_):
+    """
+    Sort values_ by (group code, value) and get the offsets of each group in the sorted
+    values. Rows with code -1 are dropped. NaN are sorted last within each group.
+    Returns
+    -------
+    values_sorted: np.ndarray
+    offsets: np.ndarray
+        Group g is values_sorted[offsets[g]: offsets[g + 1]].
+    n_valid: np.ndarray
+        Number of non-NaN values in each group.
+    """
+    keep = codes_ >= 0
+    codes = codes_[keep]
+    values = np.asarray(values_, dtype=np.float64)[keep]
+    order = np.lexsort((values, codes))
+    values_sorted = values[order]
+    sizes = np.bincount(codes, minlength=n_groups_)
+    offsets = np.zeros(n_groups_ + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    n_valid = np.bincount(codes, weights=~np.isnan(values), minlength=n_groups_)
+    return values_sorted, offsets, n_valid.astype(np.int64)
+
+
+def grouped_diff(codes_, values_, n_groups_):
+    """
+    Difference between each value and the previous value of its group, in value order,
+    e.g. headways from passage times. Uses the existing row order when the values of
+    each group are already sorted (.rsr rows are in time order within a run): the rows
+    then only need a stable sort on the group codes. Otherwise sorts on (group code,
+    value). Rows with code -1 are dropped.
+    Returns
+    -------
+    order: np.ndarray
+        Row positions sorted by group code and value.
+    diffs: np.ndarray
+        Difference for each row in order; NaN for the first row of each group.
+    offsets: np.ndarray
+        Group g is order[offsets[g]: offsets[g + 1]].
+    """
+    values = np.asarray(values_, dtype=np.float64)
+    keep = np.flatnonzero(codes_ >= 0)
+    order = keep[np.argsort(codes_[keep], kind="stable")]
+    codes_sorted = codes_[order]
+    diffs = np.full(len(order), np.nan)
+    diffs[1:] = np.diff(values[order])
+    same_group = np.r_[False, codes_sorted[1:] == codes_sorted[:-1]]
+    if (diffs[same_group] < 0).any():
+        # Not presorted.
+        order = keep[np.lexsort((values[keep], codes_[keep]))]
+        diffs[1:] = np.diff(values[order])
+    diffs[~same_group] = np.nan
+    sizes = np.bincount(codes_sorted, minlength=n_groups_)
+    offsets = np.zeros(n_groups_ + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return order, diffs, offsets
+
+
+def grouped_quantiles(values_sorted_, offsets_, quantiles_):
+    """
+    Quantiles of each group with linear interpolation; same as np.quantile(x, q) on the
+    values of each group. Groups with NaN values get NaN, like np.quantile. Empty groups
+    get NaN.
+    Parameters
+    ----------
+    values_sorted_, offsets_:
+        See sort_groups.
+    quantiles_: list
+        Quantiles between 0 and 1.
+    Returns
+    -------
+    group_quantiles: np.ndarray
+        Shape (number of groups, len(quantiles_)).
+    """
+    starts = offsets_[:-1]
+    sizes = np.diff(offsets_)
+    non_empty = sizes > 0
+    group_quantiles = np.full((len(sizes), len(quantiles_)), np.nan)
+    if not non_empty.any():
+        return group_quantiles
+    starts, sizes = starts[non_empty], sizes[non_empty]
+    # NaN are sorted last, so a group has NaN if its last value is NaN.
+    has_nan = np.isnan(values_sorted_[starts + sizes - 1])
+    for q_no, quantile in enumerate(quantiles_):
+        pos = quantile * (sizes - 1)
+        pos_below = np.floor(pos).astype(np.int64)
+        pos_above = np.minimum(pos_below + 1, sizes - 1)
+        frac = pos - pos_below
+        below = values_sorted_[starts + pos_below]
+        above = values_sorted_[starts + pos_above]
+        # Same interpolation as np.quantile (numpy's _lerp).
+        diff = above - below
+        group_quantile = np.where(
+            frac >= 0.5, above - diff * (1 - frac), below + diff * frac
+        )
+        group_quantile[has_nan] = np.nan
+        group_quantiles[non_empty, q_no] = group_quantile
+    return group_quantiles
+
+
+def grouped_stats(df_, keys_, value_col_, stats_, group_index_=None):
+    """
+    Statistics of value_col_ for each group of keys_, for all the groups at once.
+    Parameters
+    ----------
+    df_: pd.DataFrame
+        Data.
+    keys_: list
+        Group columns.
+    value_col_: str
+        Column to summarise.
+    stats_: dict
+        Output column --> statistic. Statistic is "count", "mean", "min", "max", "std"
+        (ddof=1), "cv" (std / mean), or a float between 0 and 1 for a quantile
+        (np.quantile with linear interpolation). count, mean, min, max, std and cv skip
+        NaN like pandas; quantiles of groups with NaN are NaN like np.quantile.
+    group_index_: GroupIndex
+        GroupIndex of df_ on keys_, if already built.
+    Returns
+    -------
+    group_stats: pd.DataFrame
+        One row per observed group, indexed by keys_ and sorted like groupby(keys_).
+    """
+    if group_index_ is None:
+        group_index_ = GroupIndex(df_, keys_)
+    codes, group_index = group_index_.codes, group_index_.group_index
+    n_groups = len(group_index)
+    values_sorted, offsets, n_valid = sort_groups(
+        codes, df_[value_col_].values, n_groups
+    )
+    starts = offsets[:-1]
+    quantiles = [stat for stat in stats_.values() if not isinstance(stat, str)]
+    group_quantiles = dict(
+        zip(quantiles, grouped_quantiles(values_sorted, offsets, quantiles).T)
+    )
+    # Group code of each sorted value, for the sums below.
+    sorted_codes = np.repeat(np.arange(n_groups), np.diff(offsets))
+    valid = ~np.isnan(values_sorted)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = (
+            np.bincount(
+                sorted_codes[valid], weights=values_sorted[valid], minlength=n_groups
+            )
+            / n_valid
+        )
+        dev = values_sorted[valid] - mean[sorted_codes[valid]]
+        std = np.sqrt(
+            np.bincount(sorted_codes[valid], weights=dev * dev, minlength=n_groups)
+            / (n_valid - 1)
+        )
+        std[n_valid < 2] = np.nan
+        cv = std / mean
+    has_valid = n_valid > 0
+    # Non-NaN values of a group are first in its slice.
+    min_ = np.full(n_groups, np.nan)
+    max_ = np.full(n_groups, np.nan)
+    min_[has_valid] = values_sorted[starts[has_valid]]
+    max_[has_valid] = values_sorted[starts[has_valid] + n_valid[has_valid] - 1]
+    stat_arrays = {
+        "count": n_valid,
+        "mean": mean,
+        "min": min_,
+        "max": max_,
+        "std": std,
+        "cv": cv,
+    }
+    group_stats = {}
+    for colnm, stat in stats_.items():
+        if isinstance(stat, str):
+            if stat not in stat_arrays:
+                raise ValueError(f"Unknown statistic {stat}.")
+            group_stats[colnm] = stat_arrays[stat]
+        else:
+            group_stats[colnm] = group_quantiles[stat]
+    return pd.DataFrame(group_stats, index=group_index)
+
+
+class GroupedMoments:
+    """
+    Running count, sum and variance of several columns for each group. Chunks of data
+    are added one at a time with update; the moments of each chunk are merged into the
+    running moments with the parallel form of Welford's algorithm (Chan et al.), so the
+    memory used depends on the number of groups and not on the number of rows added.
+
+    ...
+    Attributes
+    ___________
+    keys: list
+        Group columns.
+    value_cols: list
+        Columns to summarise.
+    moments: pd.DataFrame()
+        One row per group seen so far, indexed by keys. Columns (count, col), (sum, col)
+        and (m2, col) for each col in value_cols; m2 is the sum of squared deviations
+        from the group mean. NaN values are skipped. Categorical keys are stored as
+        their values (object).
+    Methods
+    ________
+    update(df_, group_index_=None): Add the rows of df_.
+    merge(other_): Add the moments of another GroupedMoments with the same keys and
+        value_cols.
+    regroup(key_, key_map_): Moments of groups made of several key_ values, e.g. report
+        vehicle classes made of vehicle types.
+    get_stats(): count, sum, mean and var (ddof=1) for each group and column.
+    """
+
+    def __init__(self, keys_, value_cols_):
+        """
+        Parameters
+        ----------
+        keys_: list
+            Group columns.
+        value_cols_: list
+            Columns to summarise.
+        """
+        self.keys = list(keys_)
+        self.value_cols = list(value_cols_)
+        self.moments = pd.DataFrame()
+
+    def update(self, df_, group_index_=None):
+        """
+        Add the rows of df_ to the running moments.
+        Parameters
+        ----------
+        df_: pd.DataFrame
+            Chunk of data with the keys and value_cols columns.
+        group_index_: GroupIndex
+            GroupIndex of df_ on keys, if already built (e.g. shared with a
+            GroupedQuantileSketch of the same chunk).
+        """
+        if group_index_ is not None:
+            self._merge_moments(self._get_index_moments(df_, group_index_))
+            return self
+        # Object keys: aligning indexes with categorical levels in merge can duplicate
+        # groups.
+        chunk_grp = categories_to_object(df_[self.keys]).join(
+            df_[self.value_cols]
+        ).groupby(self.keys)[self.value_cols]
+        chunk_count = chunk_grp.count()
+        chunk_moments = pd.concat(
+            {
+                "count": chunk_count,
+                "sum": chunk_grp.sum(),
+                "m2": (chunk_grp.var(ddof=0) * chunk_count).fillna(0),
+            },
+            axis=1,
+        )
+        self._merge_moments(chunk_moments)
+        return self
+
+    def _get_index_moments(self, df_, group_index_):
+        if group_index_.keys != self.keys:
+            raise ValueError(f"group_index_ needs the keys {self.keys}.")
+        codes = group_index_.codes
+        moments = {"count": {}, "sum": {}, "m2": {}}
+        for col in self.value_cols:
+            values = df_[col].values.astype(np.float64)
+            valid = (codes >= 0) & ~np.isnan(values)
+            count = group_index_.count(values)
+            sums = group_index_.sum(values)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                dev = values[valid] - (sums / count)[codes[valid]]
+            moments["count"][col] = count
+            moments["sum"][col] = sums
+            moments["m2"][col] = np.bincount(
+                codes[valid], weights=dev * dev, minlength=group_index_.n_groups
+            )
+        # Sorted by the key values like the groupby of update.
+        return pd.concat(
+            {
+                stat: pd.DataFrame(
+                    stat_cols,
+                    index=group_index_.get_object_index(),
+                    columns=self.value_cols,
+                )
+                for stat, stat_cols in moments.items()
+            },
+            axis=1,
+        ).sort_index()
+
+    def merge(self, other_):
+        """
+        Add the moments of other_, e.g. computed from another file or process.
+        """
+        if (other_.keys != self.keys) or (other_.value_cols != self.value_cols):
+            raise ValueError("Can only merge moments with the same keys and columns.")
+        if not other_.moments.empty:
+            self._merge_moments(other_.moments)
+        return self
+
+    def regroup(self, key_, key_map_):
+        """
+        Moments of new groups made of key_ values, without the rows: key_ is replaced
+        with the new key of key_map_. A key_ value mapped to several new values is
+        counted in each of them.
+        Parameters
+        ----------
+        key_: str
+            Key to replace, e.g. "veh_type".
+        key_map_: pd.DataFrame
+            key_ and the new key columns, one row per pair, e.g. veh_type and
+            veh_cls_res.
+        Returns
+        -------
+        regrouped: GroupedMoments
+        """
+        if key_ not in self.keys:
+            raise ValueError(f"{key_} is not in {self.keys}.")
+        if self.moments.empty:
+            new_key = [colnm for colnm in key_map_.columns if colnm != key_][0]
+            return GroupedMoments(
+                [new_key if key == key_ else key for key in self.keys], self.value_cols
+            )
+        positions, new_index = map_index_level(self.moments.index, key_, key_map_)
+        regrouped = GroupedMoments(list(new_index.names), self.value_cols)
+        if len(positions) == 0:
+            return regrouped
+        moments = self.moments.iloc[positions].set_axis(new_index, axis=0)
+        count, sums = moments["count"], moments["sum"]
+        count_new = count.groupby(level=regrouped.keys).sum()
+        sums_new = sums.groupby(level=regrouped.keys).sum()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            # m2 of a new group: m2 of its parts and their squared deviations from the
+            # new group mean.
+            delta = (sums / count) - (sums_new / count_new).reindex(new_index).values
+            m2_new = (
+                (moments["m2"] + (delta * delta * count).fillna(0))
+                .groupby(level=regrouped.keys)
+                .sum()
+            )
+        regrouped.moments = pd.concat(
+            {"count": count_new, "sum": sums_new, "m2": m2_new}, axis=1
+        )
+        return regrouped
+
+    def _merge_moments(self, moments_b):
+        if self.moments.empty:
+            self.moments = moments_b
+            return
+        moments_a, moments_b = self.moments.align(moments_b, join="outer")
+        moments_a, moments_b = moments_a.fillna(0), moments_b.fillna(0)
+        count_a, count_b = moments_a["count"], moments_b["count"]
+        count = count_a + count_b
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = moments_b["sum"] / count_b - moments_a["sum"] / count_a
+            m2 = (
+                moments_a["m2"]
+                + moments_b["m2"]
+                + (delta * delta * count_a * count_b / count).fillna(0)
+            )
+        self.moments = pd.concat(
+            {"count": count, "sum": moments_a["sum"] + moments_b["sum"], "m2": m2},
+            axis=1,
+        )
+
+    def get_stats(self):
+        """
+        Returns
+        -------
+        group_stats: pd.DataFrame
+            One row per group, indexed by keys. Columns (stat, col) for stat in count,
+            sum, mean and var (ddof=1; NaN for groups with less than 2 values).
+        """
+        if self.moments.empty:
+            return pd.DataFrame()
+        count = self.moments["count"]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.moments["sum"] / count
+            var = (self.moments["m2"] / (count - 1)).where(count > 1)
+        return pd.concat(
+            {
+                "count": count.astype(np.int64),
+                "sum": self.moments["sum"],
+                "mean": mean,
+                "var": var,
+            },
+            axis=1,
+        )
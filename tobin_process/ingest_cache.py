@@ -0,0 +1,294 @@
+"""
+Module for caching parsed vissim outputs (.att, .rsr, .mer) as columnar binary files.
+Re-running the 01-04 scripts re-parses the same semicolon-delimited text files; the
+cache stores each parsed and column-normalized dataframe as one NumPy array per column
+and loads it back on the next run.
+"""
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from tobin_process.utils import get_project_root
+
+
+class IngestCache:
+    """
+    Cache for parsed and column-normalized vissim output files.
+
+    ...
+    Attributes
+    ___________
+    path_to_cache: str
+        Directory with the cached files. Created if it does not exist.
+    max_size_mb: float
+        Maximum size of the cache. Least recently used entries are deleted once the
+        cache grows above this size.
+    Methods
+    ________
+    load_or_parse(path_raw_, parse_func_, variant_=""): Return the cached dataframe
+        for path_raw_ if present. Else call parse_func_(), cache and return its result.
+    get_key(path_raw_, variant_=""): Cache key based on the file path, size, mtime,
+        content hash and variant_.
+    info(): Dataframe with the cached entries.
+    evict(): Delete least recently used entries until the cache is below max_size_mb.
+    clear(): Delete all cached entries.
+    """
+
+    def __init__(self, path_to_cache_, max_size_mb_=2000):
+        """
+        Parameters
+        ----------
+        path_to_cache_: str
+            Directory with the cached files.
+        max_size_mb_: float
+            Maximum size of the cache in MB.
+        """
+        self.path_to_cache = path_to_cache_
+        self.max_size_mb = max_size_mb_
+        self.path_to_stamps = os.path.join(path_to_cache_, "stamps")
+        os.makedirs(self.path_to_stamps, exist_ok=True)
+
+    @staticmethod
+    def _hash_file(path_raw_, block_size=1 << 20):
+        """
+        Content hash of path_raw_.
+        """
+        file_hash = hashlib.blake2b(digest_size=16)
+        with open(path_raw_, "rb") as input_file:
+            for block in iter(lambda: input_file.read(block_size), b""):
+                file_hash.update(block)
+        return file_hash.hexdigest()
+
+    def _get_content_hash(self, path_raw_, stat_):
+        """
+        Content hash of path_raw_. The hash is stored in a stamp file with the file size
+        and mtime, so the file is only re-hashed when its size or mtime change.
+        """
+        path_abs = os.path.abspath(path_raw_)
+        path_stamp = os.path.join(
+            self.path_to_stamps,
+            hashlib.sha1(path_abs.encode("utf-8")).hexdigest() + ".json",
+        )
+        if os.path.exists(path_stamp):
+            with open(path_stamp) as stamp_file:
+                stamp = json.load(stamp_file)
+            if (stamp["size"] == stat_.st_size) & (stamp["mtime_ns"] == stat_.st_mtime_ns):
+                return stamp["content_hash"]
+        content_hash = self._hash_file(path_raw_)
+        self._write_json(
+            path_stamp,
+            {
+                "path": path_abs,
+                "size": stat_.st_size,
+                "mtime_ns": stat_.st_mtime_ns,
+                "content_hash": content_hash,
+            },
+        )
+        return content_hash
+
+    def get_key(self, path_raw_, variant_=""):
+        """
+        Cache key for path_raw_.
+        Parameters
+        ----------
+        path_raw_: str
+            Path to the raw vissim file.
+        variant_: str
+            Describes how the file was parsed (reader, columns, filters). Same file
+            parsed differently is cached under different keys.
+        """
+        path_abs = os.path.abspath(path_raw_)
+        stat_ = os.stat(path_abs)
+        content_hash = self._get_content_hash(path_abs, stat_)
+        key = "|".join(
+            [path_abs, str(stat_.st_size), str(stat_.st_mtime_ns), content_hash, variant_]
+        )
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def load_or_parse(self, path_raw_, parse_func_, variant_=""):
+        """
+        Return the cached dataframe for path_raw_ and variant_. If it is not cached,
+        call parse_func_(), cache the result and return it.
+        Parameters
+        ----------
+        path_raw_: str
+            Path to the raw vissim file.
+        parse_func_: callable
+            Function without arguments that parses path_raw_ and returns a dataframe.
+        variant_: str
+            See get_key.
+        """
+        key = self.get_key(path_raw_, variant_)
+        path_data = os.path.join(self.path_to_cache, key + ".npz")
+        path_meta = os.path.join(self.path_to_cache, key + ".json")
+        if os.path.exists(path_data) & os.path.exists(path_meta):
+            try:
+                data = self._read_entry(path_data, path_meta)
+            except (OSError, ValueError, KeyError):
+                # Entry evicted or partially written by another process. Parse again.
+                pass
+            else:
+                os.utime(path_data)  # Mark as recently used for eviction.
+                return data
+        data = parse_func_()
+        if self._write_entry(data, path_data, path_meta, path_raw_, variant_):
+            self.evict()
+        return data
+
+    @staticmethod
+    def _write_json(path_json, obj):
+        path_tmp = f"{path_json}.{os.getpid()}.tmp"
+        with open(path_tmp, "w") as json_file:
+            json.dump(obj, json_file)
+        os.replace(path_tmp, path_json)
+
+    def _write_entry(self, data, path_data, path_meta, path_raw_, variant_):
+        """
+        Store data as one array per column. Object columns are stored as integer codes
+        and string categories. Returns False if data has columns that cannot be stored
+        without pickling; such data is not cached.
+        """
+        arrays = {}
+        columns = []
+        for col_no, (colnm, col) in enumerate(data.items()):
+            if isinstance(col.dtype, pd.CategoricalDtype):
+                kind = "category"
+                codes, uniques = col.cat.codes.values, col.cat.categories
+            elif col.dtype == object or pd.api.types.is_string_dtype(col.dtype):
+                kind = "object"
+                codes, uniques = pd.factorize(col)
+            elif col.dtype.kind in "biufcmM":
+                kind = "array"
+                arrays[f"col_{col_no}"] = col.values
+                columns.append({"name": colnm, "kind": kind})
+                continue
+            else:
+                return False
+            if not all(isinstance(value, str) for value in uniques):
+                if (kind == "category") & (uniques.dtype.kind in "biuf"):
+                    arrays[f"cat_{col_no}"] = np.asarray(uniques)
+                else:
+                    return False
+            else:
+                arrays[f"cat_{col_no}"] = np.asarray(uniques, dtype=str)
+            arrays[f"col_{col_no}"] = np.asarray(codes)
+            columns.append(
+                {
+                    "name": colnm,
+                    "kind": kind,
+                    "ordered": bool(getattr(col.dtype, "ordered", False)),
+                }
+            )
+        if not isinstance(data.index, pd.RangeIndex):
+            if data.index.dtype.kind not in "iu":
+                return False
+            arrays["index"] = data.index.values
+        path_tmp = f"{path_data}.{os.getpid()}.tmp.npz"
+        np.savez(path_tmp, **arrays)
+        os.replace(path_tmp, path_data)
+        self._write_json(
+            path_meta,
+            {
+                "path": os.path.abspath(path_raw_),
+                "variant": variant_,
+                "columns": columns,
+                "created": time.time(),
+            },
+        )
+        return True
+
+    @staticmethod
+    def _read_entry(path_data, path_meta):
+        with open(path_meta) as meta_file:
+            meta = json.load(meta_file)
+        data = {}
+        with np.load(path_data, allow_pickle=False) as arrays:
+            for col_no, col_meta in enumerate(meta["columns"]):
+                values = arrays[f"col_{col_no}"]
+                if col_meta["kind"] == "array":
+                    data[col_meta["name"]] = values
+                    continue
+                col = pd.Categorical.from_codes(
+                    values, categories=arrays[f"cat_{col_no}"], ordered=col_meta["ordered"]
+                )
+                if col_meta["kind"] == "object":
+                    col = np.asarray(col, dtype=object)
+                data[col_meta["name"]] = col
+            index = arrays["index"] if "index" in arrays.files else None
+        # Dict keys keep the column order. Column names are assigned after
+        # construction so that duplicated names survive.
+        data_df = pd.DataFrame(
+            {col_no: col for col_no, col in enumerate(data.values())}, index=index
+        )
+        data_df.columns = [col_meta["name"] for col_meta in meta["columns"]]
+        return data_df
+
+    def info(self):
+        """
+        Dataframe with the cached entries: key, source file, variant, size and last use.
+        """
+        entries = []
+        for file_nm in os.listdir(self.path_to_cache):
+            if not file_nm.endswith(".json"):
+                continue
+            key = file_nm[: -len(".json")]
+            path_data = os.path.join(self.path_to_cache, key + ".npz")
+            if not os.path.exists(path_data):
+                continue
+            with open(os.path.join(self.path_to_cache, file_nm)) as meta_file:
+                meta = json.load(meta_file)
+            stat_ = os.stat(path_data)
+            entries.append(
+                {
+                    "key": key,
+                    "path": meta["path"],
+                    "variant": meta["variant"],
+                    "size_mb": stat_.st_size / 2 ** 20,
+                    "last_used": pd.Timestamp(stat_.st_mtime, unit="s"),
+                }
+            )
+        return pd.DataFrame(
+            entries, columns=["key", "path", "variant", "size_mb", "last_used"]
+        ).sort_values("last_used", ascending=False, ignore_index=True)
+
+    def _remove_entry(self, key):
+        for ext in (".npz", ".json"):
+            try:
+                os.remove(os.path.join(self.path_to_cache, key + ext))
+            except FileNotFoundError:
+                pass  # Removed by another process.
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache is below max_size_mb.
+        """
+        cache_info = self.info()
+        if cache_info.size_mb.sum() <= self.max_size_mb:
+            return
+        # info is sorted by last use; keep the most recent entries that fit.
+        keep = cache_info.size_mb.cumsum() <= self.max_size_mb
+        for key in cache_info.loc[~keep, "key"]:
+            self._remove_entry(key)
+
+    def clear(self):
+        """
+        Delete all cached entries and content hash stamps.
+        """
+        for file_nm in os.listdir(self.path_to_cache):
+            if file_nm.endswith((".npz", ".json")):
+                os.remove(os.path.join(self.path_to_cache, file_nm))
+        for file_nm in os.listdir(self.path_to_stamps):
+            os.remove(os.path.join(self.path_to_stamps, file_nm))
+
+
+if __name__ == "__main__":
+    # Inspect the cache used by the 01-04 scripts. Call ingest_cache.clear() to delete
+    # all the cached files.
+    path_to_prj = get_project_root()
+    path_to_interim_data = os.path.join(path_to_prj, "data", "interim")
+    ingest_cache = IngestCache(os.path.join(path_to_interim_data, "ingest_cache"))
+    with pd.option_context("display.max_columns", 10, "display.width", 200):
+        print(ingest_cache.info())
+    print(f"Total size: {ingest_cache.info().size_mb.sum():.1f} MB")
@@ -0,0 +1,413 @@
+"""
+Module with a dense space-time cube of the link segment results: one float array indexed
+by (run, direction, segment, time interval, metric), with the segments of each direction
+in mapper order (order, then start point). The cube is built once from
+LinkSegEval.link_seg_vissim_fil_ord. The heatmaps, the QA/QC table and derived metrics
+(e.g. density per lane) are slices and element-wise operations on the array instead of
+a pivot table per run and direction. The cube is saved as an uncompressed .npz file
+(np.load with allow_pickle=False), so it loads without re-reading the vissim output.
+"""
+import numpy as np
+import pandas as pd
+
+# Metrics of the cube built by LinkSegEval.set_link_seg_cube.
+LINK_SEG_CUBE_METRICS = [
+    "speed_1020",
+    "density_1020",
+    "volume_1020",
+    "linkevalsegment_link_numlanes",
+]
+# Segment columns of the cube. direction and seg_pos locate the segment in the array.
+LINK_SEG_CUBE_SEG_COLS = [
+    "direction",
+    "seg_pos",
+    "link",
+    "st_pt",
+    "end_pt",
+    "linkevalsegment",
+    "order",
+    "display_name",
+    "seg_label",
+    "cum_offset",
+]
+
+
+def get_pos(labels_, label_, name_):
+    """
+    Position of label_ in labels_; ValueError if label_ is not in labels_.
+    """
+    pos = np.flatnonzero(np.asarray(labels_) == label_)
+    if not len(pos):
+        raise ValueError(f"{name_} {label_} is not in the cube: {list(labels_)}.")
+    return pos[0]
+
+
+class LinkSegCube:
+    """
+    Link segment results as a dense (run, direction, segment, time interval, metric)
+    array. Cells without data (segments padding the shorter directions, missing time
+    intervals) are NaN.
+
+    ...
+    Attributes
+    ___________
+    values: np.ndarray
+        C-contiguous float64 array of shape (runs, directions, segments, timeints,
+        metrics).
+    runs: np.ndarray
+        Run labels, sorted.
+    directions: np.ndarray
+        Direction labels, sorted.
+    timeints: np.ndarray
+        Time interval labels in time order.
+    metrics: list
+        Metric names.
+    segments: pd.DataFrame()
+        One row per segment with the LINK_SEG_CUBE_SEG_COLS columns. seg_pos is the
+        position of the segment in the segment axis of its direction; seg_label is the
+        heatmap label (display name, start and end point); cum_offset is the distance
+        in miles from the start of the direction to the end of the segment.
+    Methods
+    ________
+    get(metric_, run_=None, direction_=None): View of the array of a metric.
+    add_metric(metric_, values_): Add a derived metric, e.g. density per lane.
+    get_groups(): (run, direction) pairs with data.
+    get_heatmap_frame(metric_, run_, direction_, index_var_="display_name"): segments x
+        time intervals table of a metric for a run and direction.
+    to_frame(): Long table with one row per run, direction, segment and time interval.
+    merge(other_): Add the runs of another cube with the same axes.
+    save(path_): Save the cube to a .npz file. Load it with load_link_seg_cube.
+    """
+
+    def __init__(self, values_, runs_, directions_, timeints_, metrics_, segments_):
+        """
+        Parameters
+        ----------
+        values_: np.ndarray
+            Array of shape (runs, directions, segments, timeints, metrics).
+        runs_: list
+            Run labels.
+        directions_: list
+            Direction labels.
+        timeints_: list
+            Time interval labels.
+        metrics_: list
+            Metric names.
+        segments_: pd.DataFrame
+            Segment table with the LINK_SEG_CUBE_SEG_COLS columns.
+        """
+        self.values = np.ascontiguousarray(values_, dtype=np.float64)
+        self.runs = np.asarray(runs_)
+        self.directions = np.asarray(directions_)
+        self.timeints = np.asarray(timeints_)
+        self.metrics = list(metrics_)
+        expected_shape = (
+            len(self.runs),
+            len(self.directions),
+            self.values.shape[2] if self.values.ndim == 5 else -1,
+            len(self.timeints),
+            len(self.metrics),
+        )
+        if self.values.shape != expected_shape:
+            raise ValueError(
+                f"values_ has the shape {self.values.shape}; the labels need "
+                f"{expected_shape}."
+            )
+        missing_cols = set(LINK_SEG_CUBE_SEG_COLS) - set(segments_.columns)
+        if missing_cols:
+            raise ValueError(f"segments_ needs the columns {sorted(missing_cols)}.")
+        self.segments = segments_.filter(items=LINK_SEG_CUBE_SEG_COLS).reset_index(
+            drop=True
+        )
+
+    def get(self, metric_, run_=None, direction_=None):
+        """
+        View (no copy) of the array of metric_, for run_ and direction_ if given.
+        Returns
+        -------
+        metric_values: np.ndarray
+            Shape (runs, directions, segments, timeints) with the run and direction
+            axes dropped when run_ or direction_ is given.
+        """
+        metric_values = self.values[..., get_pos(self.metrics, metric_, "metric")]
+        if direction_ is not None:
+            metric_values = metric_values[
+                :, get_pos(self.directions, direction_, "direction")
+            ]
+        if run_ is not None:
+            metric_values = metric_values[get_pos(self.runs, run_, "run")]
+        return metric_values
+
+    def add_metric(self, metric_, values_):
+        """
+        Add (or replace) metric_ with values_ of shape (runs, directions, segments,
+        timeints), e.g. cube.get("density_1020") / cube.get(
+        "linkevalsegment_link_numlanes").
+        """
+        values = np.asarray(values_, dtype=np.float64)
+        if values.shape != self.values.shape[:-1]:
+            raise ValueError(
+                f"values_ has the shape {values.shape}; the cube needs "
+                f"{self.values.shape[:-1]}."
+            )
+        if metric_ in self.metrics:
+            self.values[..., self.metrics.index(metric_)] = values
+            return self
+        self.values = np.concatenate([self.values, values[..., None]], axis=-1)
+        self.metrics.append(metric_)
+        return self
+
+    def get_groups(self):
+        """
+        (run, direction) pairs with at least one value, in run and direction order.
+        """
+        has_data = ~np.isnan(self.values).all(axis=(2, 3, 4))
+        return [
+            (self.runs[run_pos], self.directions[dir_pos])
+            for run_pos, dir_pos in zip(*np.nonzero(has_data))
+        ]
+
+    def get_heatmap_frame(self, metric_, run_, direction_, index_var_="display_name"):
+        """
+        Table of metric_ with one row per segment of direction_ (in segment order) and
+        one column per time interval. Rows and columns without values are dropped.
+        Parameters
+        ----------
+        index_var_: str
+            Segment column for the row labels. "display_name" uses seg_label
+            (e.g. "Tobin Bridge 0-1000 ft"), "cum_offset" the distance in miles.
+        """
+        segments_dir = self.segments.loc[lambda df: df.direction == direction_]
+        index_col = "seg_label" if index_var_ == "display_name" else index_var_
+        heatmap_frame = pd.DataFrame(
+            self.get(metric_, run_, direction_)[segments_dir.seg_pos.values],
+            index=pd.Index(segments_dir[index_col].values, name=index_var_),
+            columns=pd.Index(self.timeints, name="timeint"),
+        )
+        return heatmap_frame.dropna(how="all", axis=0).dropna(how="all", axis=1)
+
+    def to_frame(self):
+        """
+        Long table of the cube, e.g. for the QA/QC export: one row per run, direction,
+        segment and time interval with any value; segment columns and one column per
+        metric. Rows are sorted by run, time interval, direction and segment.
+        """
+        values = self.values.transpose(0, 3, 1, 2, 4)
+        run_pos, timeint_pos, dir_pos, seg_pos = np.nonzero(
+            ~np.isnan(values).all(axis=-1)
+        )
+        seg_row = pd.MultiIndex.from_frame(
+            self.segments[["direction", "seg_pos"]]
+        ).get_indexer(pd.MultiIndex.from_arrays([self.directions[dir_pos], seg_pos]))
+        long_frame = self.segments.iloc[seg_row].reset_index(drop=True)
+        long_frame.insert(0, "run", self.runs[run_pos])
+        long_frame.insert(
+            1,
+            "timeint",
+            pd.Categorical.from_codes(
+                timeint_pos, categories=self.timeints, ordered=True
+            ),
+        )
+        metric_values = values[run_pos, timeint_pos, dir_pos, seg_pos]
+        for metric_no, metric in enumerate(self.metrics):
+            long_frame[metric] = metric_values[:, metric_no]
+        return long_frame
+
+    def merge(self, other_):
+        """
+        Add the runs of other_, e.g. the cube of another run built in a worker process
+        with the same axes (see get_link_seg_cube_axes).
+        """
+        same_axes = (
+            np.array_equal(self.directions, other_.directions)
+            and np.array_equal(self.timeints, other_.timeints)
+            and (self.metrics == other_.metrics)
+            and self.segments.equals(other_.segments)
+        )
+        if not same_axes:
+            raise ValueError(
+                "Can only merge cubes with the same directions, segments, time "
+                "intervals and metrics."
+            )
+        shared_runs = np.intersect1d(
+            self.runs.astype(str), other_.runs.astype(str)
+        ).tolist()
+        if shared_runs:
+            raise ValueError(f"Runs {shared_runs} are in both cubes.")
+        runs = np.concatenate([self.runs, other_.runs])
+        run_order = np.argsort(runs, kind="mergesort")
+        self.runs = runs[run_order]
+        self.values = np.ascontiguousarray(
+            np.concatenate([self.values, other_.values])[run_order]
+        )
+        return self
+
+    def save(self, path_):
+        """
+        Save the arrays and labels to path_ (.npz). Load it with load_link_seg_cube.
+        """
+        arrays = {
+            "values": self.values,
+            "runs": self.runs.astype(str),
+            "directions": self.directions.astype(str),
+            "timeints": self.timeints.astype(str),
+            "metrics": np.asarray(self.metrics, dtype=str),
+        }
+        for col in LINK_SEG_CUBE_SEG_COLS:
+            seg_col = self.segments[col].values
+            arrays[f"seg_{col}"] = (
+                seg_col.astype(str) if seg_col.dtype == object else seg_col
+            )
+        np.savez(path_, **arrays)
+
+
+def load_link_seg_cube(path_):
+    """
+    Load a cube saved with LinkSegCube.save. Run labels are read back as strings.
+    """
+    with np.load(path_, allow_pickle=False) as arrays:
+        segments = pd.DataFrame(
+            {col: arrays[f"seg_{col}"] for col in LINK_SEG_CUBE_SEG_COLS}
+        )
+        return LinkSegCube(
+            values_=arrays["values"],
+            runs_=arrays["runs"].astype(object),
+            directions_=arrays["directions"].astype(object),
+            timeints_=arrays["timeints"].astype(object),
+            metrics_=arrays["metrics"].tolist(),
+            segments_=segments.assign(
+                **{
+                    col: segments[col].astype(object)
+                    for col in segments.columns
+                    if segments[col].dtype.kind == "U"
+                }
+            ),
+        )
+
+
+def get_link_seg_cube_rows(
+    link_seg_vissim_fil_ord_, run_col_="linkevalsegmentevaluation_simrun"
+):
+    """
+    Rows of link_seg_vissim_fil_ord_ that go in the cube. Mapper links without vissim
+    data have no run; time intervals not in the time interval spec have no label.
+    """
+    return link_seg_vissim_fil_ord_.loc[
+        lambda df: df[run_col_].notna() & df.timeint.notna()
+    ]
+
+
+def get_link_seg_cube_axes(link_seg_):
+    """
+    Segment and time interval axes of the cube of link_seg_ (see
+    get_link_seg_cube_rows). Pass them to build_link_seg_cube so that the cubes of
+    different runs can be merged.
+    Returns
+    -------
+    segments: pd.DataFrame
+        See LinkSegCube.segments.
+    timeints: np.ndarray
+        Categories of a categorical timeint; sorted labels otherwise.
+    """
+    segments = (
+        link_seg_[
+            ["direction", "link", "st_pt", "end_pt", "linkevalsegment", "order"]
+            + ["display_name"]
+        ]
+        .drop_duplicates(["direction", "link", "st_pt", "end_pt"])
+        .sort_values(["direction", "order", "st_pt"], kind="mergesort")
+        .reset_index(drop=True)
+        .assign(
+            seg_pos=lambda df: df.groupby("direction").cumcount(),
+            seg_label=lambda df: df.display_name.astype(str)
+            + " "
+            + df.st_pt.astype(str)
+            + "-"
+            + df.end_pt.astype(str)
+            + " ft",
+            cum_offset=lambda df: (df.end_pt - df.st_pt).groupby(df.direction).cumsum()
+            / 5280,
+        )
+    )
+    if pd.api.types.is_categorical_dtype(link_seg_.timeint):
+        timeints = link_seg_.timeint.cat.categories
+    else:
+        timeints = pd.Index(link_seg_.timeint.unique()).sort_values()
+    return segments, np.asarray(timeints, dtype=object)
+
+
+def build_link_seg_cube(
+    link_seg_vissim_fil_ord_,
+    metrics_=LINK_SEG_CUBE_METRICS,
+    run_col_="linkevalsegmentevaluation_simrun",
+    segments_=None,
+    timeints_=None,
+):
+    """
+    Cube of the link segment results after LinkSegEval.merge_link_mapper.
+    Parameters
+    ----------
+    link_seg_vissim_fil_ord_: pd.DataFrame
+        LinkSegEval.link_seg_vissim_fil_ord (or the rows of some of its runs): one row
+        per run, time interval and segment with the mapper columns (direction, order,
+        display_name).
+    metrics_: list
+        Columns to store in the cube. Columns not in link_seg_vissim_fil_ord_ are
+        skipped.
+    run_col_: str
+        Run column.
+    segments_: pd.DataFrame
+        Segment axis from get_link_seg_cube_axes. None uses the segments of
+        link_seg_vissim_fil_ord_.
+    timeints_: list
+        Time interval axis from get_link_seg_cube_axes. None uses the time intervals
+        of link_seg_vissim_fil_ord_.
+    Returns
+    -------
+    link_seg_cube: LinkSegCube
+    """
+    link_seg = get_link_seg_cube_rows(link_seg_vissim_fil_ord_, run_col_)
+    metrics = [metric for metric in metrics_ if metric in link_seg.columns]
+    if link_seg.empty or not metrics:
+        raise ValueError("No link segment results to build the cube from.")
+    segments, timeints = get_link_seg_cube_axes(link_seg)
+    if segments_ is not None:
+        segments = segments_
+    if timeints_ is not None:
+        timeints = np.asarray(timeints_, dtype=object)
+    run_codes, runs = pd.factorize(link_seg[run_col_], sort=True)
+    directions = pd.Index(segments.direction.unique()).sort_values()
+    dir_codes = directions.get_indexer(link_seg.direction)
+    timeint_codes = pd.Index(timeints).get_indexer(
+        np.asarray(link_seg.timeint, dtype=object)
+    )
+    seg_cols = ["direction", "link", "st_pt", "end_pt"]
+    seg_row = pd.MultiIndex.from_frame(segments[seg_cols]).get_indexer(
+        pd.MultiIndex.from_frame(link_seg[seg_cols])
+    )
+    if (seg_row == -1).any() or (timeint_codes == -1).any():
+        raise ValueError("Rows with segments or time intervals not in the cube axes.")
+    seg_pos = segments.seg_pos.values[seg_row]
+    n_segs = segments.seg_pos.max() + 1
+    cell_idx = np.ravel_multi_index(
+        (run_codes, dir_codes, seg_pos, timeint_codes),
+        (len(runs), len(directions), n_segs, len(timeints)),
+    )
+    if len(np.unique(cell_idx)) < len(cell_idx):
+        raise ValueError(
+            "Several rows for the same run, direction, segment and time interval."
+        )
+    values = np.full(
+        (len(runs), len(directions), n_segs, len(timeints), len(metrics)), np.nan
+    )
+    values.reshape(-1, len(metrics))[cell_idx] = link_seg[metrics].to_numpy(
+        dtype=np.float64
+    )
+    return LinkSegCube(
+        values_=values,
+        runs_=np.asarray(runs, dtype=object),
+        directions_=np.asarray(directions, dtype=object),
+        timeints_=timeints,
+        metrics_=metrics,
+        segments_=segments,
+    )
@@ -1,7 +1,19 @@
+from functools import partial
+import numpy as np
 import pandas as pd
 import os
 from tobin_process.utils import remove_special_char_vissim_col
+from tobin_process.utils import read_vissim_att
+from tobin_process.utils import categories_to_object
 from tobin_process.utils import get_project_root
+from tobin_process.utils import TimeIntervalSpec
+from tobin_process.mapper_cache import default_mapper_cache
+from tobin_process.link_seg_cube import build_link_seg_cube
+from tobin_process.link_seg_cube import get_link_seg_cube_axes
+from tobin_process.link_seg_cube import get_link_seg_cube_rows
+from tobin_process.link_seg_cube import LINK_SEG_CUBE_METRICS
+from tobin_process.map_reduce import map_reduce
+from tobin_process.map_reduce import partition_by_run
 import plotly.graph_objects as go
 import plotly.io as pio
 
@@ -14,6 +26,10 @@ class LinkSegEval:
         path_to_mapper_link_seg_,
         path_link_seg_vissim_,
         path_to_output_link_seg_fig_,
+        ingest_cache_=None,
+        read_cols_=None,
+        read_runs_=None,
+        mapper_cache_=None,
     ):
         """
         Parameters
@@ -24,36 +40,67 @@ class LinkSegEval:
             Path to the vissim link evaluation file.
         path_to_output_link_seg_fig_: str
             Path for storing the output figures.
+        ingest_cache_: tobin_process.ingest_cache.IngestCache
+            If given, load the parsed link segment data from the cache when
+            path_link_seg_vissim_ was already parsed.
+        read_cols_: list
+            Only read these columns from path_link_seg_vissim_. None reads all the
+            columns.
+        read_runs_: list
+            Only read these runs (e.g. ["AVG"]) from path_link_seg_vissim_. None reads
+            all the runs.
+        mapper_cache_: tobin_process.mapper_cache.MapperCache
+            Cache for the parsed mapper workbook. Defaults to
+            mapper_cache.default_mapper_cache.
         """
         self.path_to_mapper_link_seg = path_to_mapper_link_seg_
         self.path_link_seg_vissim = path_link_seg_vissim_
         self.path_to_output_link_seg_fig = path_to_output_link_seg_fig_
+        self.ingest_cache = ingest_cache_
+        self.read_cols = read_cols_
+        self.read_runs = read_runs_
         # Mapper file to get link names.
-        self.link_seg_mapper = pd.read_excel(self.path_to_mapper_link_seg)
+        if mapper_cache_ is None:
+            mapper_cache_ = default_mapper_cache
+        self.link_seg_mapper = mapper_cache_.read_sheet(self.path_to_mapper_link_seg)
         self.link_seg_vissim = pd.DataFrame()
         self.link_seg_vissim_fil = pd.DataFrame()
         self.link_seg_vissim_fil_ord = pd.DataFrame()
+        self.link_seg_cube = None
 
     def read_link_seg(self):
         """
         Read vissim link segment evaluation data.
         """
-        # * is comment line. $ also means comment, but in pandas we can only use one
-        # char for denoting comment, so using skiprow=1 to skip the 1st row, which has
-        # a $ sign. 2nd and last $ sign is used with column name. Will address it below.
-        self.link_seg_vissim = pd.read_csv(
-            self.path_link_seg_vissim, comment="*", sep=";", skiprows=1
+        if self.ingest_cache is not None:
+            self.link_seg_vissim = self.ingest_cache.load_or_parse(
+                path_raw_=self.path_link_seg_vissim,
+                parse_func_=self.parse_link_seg,
+                variant_=f"link_seg|att|{self.read_cols}|{self.read_runs}",
+            )
+        else:
+            self.link_seg_vissim = self.parse_link_seg()
+        # Split the unique segment names (link-start-end) once and broadcast with the
+        # categorical codes.
+        linkevalsegment = self.link_seg_vissim.linkevalsegment.astype("category")
+        link_st_end = (
+            linkevalsegment.cat.categories.to_series()
+            .str.split("-", expand=True)
+            .values.astype(int)
         )
-        # Remove special charaters from the Vissim names.
-        self.link_seg_vissim.columns = remove_special_char_vissim_col(
-            self.link_seg_vissim.columns
+        self.link_seg_vissim[["link", "st_pt", "end_pt"]] = link_st_end[
+            linkevalsegment.cat.codes.values
+        ]
+
+    def parse_link_seg(self):
+        """
+        Parse the vissim link segment evaluation data in self.path_link_seg_vissim.
+        """
+        return read_vissim_att(
+            self.path_link_seg_vissim,
+            usecols_=self.read_cols,
+            keep_runs_=self.read_runs,
         )
-        self.link_seg_vissim[
-            ["link", "st_pt", "end_pt"]
-        ] = self.link_seg_vissim.linkevalsegment.str.split("-", expand=True)
-        self.link_seg_vissim[["link", "st_pt", "end_pt"]] = self.link_seg_vissim[
-            ["link", "st_pt", "end_pt"]
-        ].values.astype(int)
 
     def test_seg_eval_len(self, eval_len=1000):
         """
@@ -64,7 +111,12 @@ class LinkSegEval:
         ), f"Change link evaluation segment length to {eval_len} ft. in Vissim."
 
     def clean_filter_link_eval(
-        self, keep_runs_, keep_cols_, order_timeint_, order_timeint_labels_
+        self,
+        keep_runs_,
+        keep_cols_,
+        order_timeint_,
+        order_timeint_labels_,
+        timeint_spec_=None,
     ):
         """
         Filter rows and columns of the raw vissim node evaluation data.
@@ -77,11 +129,16 @@ class LinkSegEval:
             Runs to process. Generaly would only be interested in average results.
         order_timeint: Order of timeint.
         order_timeint_labels_: Labels for the timeint.
+        timeint_spec_: tobin_process.utils.TimeIntervalSpec
+            Time intervals and labels shared with the other modules. If given,
+            order_timeint_ and order_timeint_labels_ are not used and can be None.
         """
         if type(keep_runs_) == str:
             keep_runs_ = [keep_runs_]
         else:
             keep_runs_ = keep_runs_
+        if timeint_spec_ is None:
+            timeint_spec_ = TimeIntervalSpec(order_timeint_, order_timeint_labels_)
 
         self.link_seg_vissim_fil = (
             self.link_seg_vissim.loc[
@@ -92,16 +149,11 @@ class LinkSegEval:
                     )  # 1 or empty cells are  for arterial roads.
                 )
             ]
-            .assign(
-                timeint=lambda df: pd.Categorical(df.timeint, categories=order_timeint_)
-            )
+            .pipe(categories_to_object)
+            .assign(timeint=lambda df: timeint_spec_.label_timeint(df.timeint))
             .filter(items=keep_cols_ + ["link", "st_pt", "end_pt"])
         )
 
-        self.link_seg_vissim_fil.timeint = self.link_seg_vissim_fil.timeint.cat.rename_categories(
-            {i: j for (i, j) in zip(order_timeint_, order_timeint_labels_)}
-        )
-
     def merge_link_mapper(self):
         """
         Merge link mapper.
@@ -125,6 +177,51 @@ class LinkSegEval:
             / 5280,
         )
 
+    def set_link_seg_cube(self, metrics_=LINK_SEG_CUBE_METRICS, n_workers_=1):
+        """
+        Build the (run, direction, segment, time interval, metric) cube of
+        link_seg_vissim_fil_ord once after merge_link_mapper. The heatmaps and the
+        derived metrics slice the cube. Save it with self.link_seg_cube.save. The cube
+        of each run is built on the shared segment and time interval axes and the run
+        cubes are merged (see map_reduce).
+        Parameters
+        ----------
+        metrics_: list
+            Columns of link_seg_vissim_fil_ord to keep in the cube.
+        n_workers_: int
+            Number of worker processes for the runs. Default 1 builds the run cubes in
+            this process.
+        """
+        run_col = "linkevalsegmentevaluation_simrun"
+        link_seg = get_link_seg_cube_rows(self.link_seg_vissim_fil_ord, run_col)
+        if link_seg.empty:
+            raise ValueError("No link segment results to build the cube from.")
+        segments, timeints = get_link_seg_cube_axes(link_seg)
+        self.link_seg_cube = map_reduce(
+            partial(
+                build_link_seg_cube,
+                metrics_=metrics_,
+                run_col_=run_col,
+                segments_=segments,
+                timeints_=timeints,
+            ),
+            partition_by_run(link_seg, run_col),
+            n_workers_,
+        )
+
+    def add_density_by_lane(self):
+        """
+        Add density_1020_by_ln (veh/mi/ln) to the cube.
+        """
+        if self.link_seg_cube is None:
+            self.set_link_seg_cube()
+        with np.errstate(invalid="ignore", divide="ignore"):
+            self.link_seg_cube.add_metric(
+                "density_1020_by_ln",
+                self.link_seg_cube.get("density_1020")
+                / self.link_seg_cube.get("linkevalsegment_link_numlanes"),
+            )
+
     def plot_heatmaps(
         self,
         plot_var,
@@ -145,45 +242,22 @@ class LinkSegEval:
         Parameters
         ----------
         plot_var: str
-            Variable for defining color scale.
+            Variable for defining color scale. A metric of self.link_seg_cube.
+        index_var: str
+            "display_name" (display name with the start and end point of the
+            segment) or "cum_offset" (miles).
         color_lab: str
             Label for the plot_var.
         """
-        # Groupby simualation runs and direction and then plot heatmaps for each of these
-        # groups.
-        plot_grps = self.link_seg_vissim_fil_ord.groupby(
-            ["linkevalsegmentevaluation_simrun", "direction"]
-        )
-
-        for name, group in plot_grps:
-            plot_grp_reshaped = (
-                pd.pivot_table(
-                    (
-                        group.assign(
-                            display_name=lambda df: df[
-                                ["display_name", "st_pt", "end_pt"]
-                            ].apply(
-                                lambda x: str(x[0])
-                                + " "
-                                + str(x[1])
-                                + "-"
-                                + str(x[2])
-                                + " ft",
-                                axis=1,
-                            )
-                        ).assign(
-                            display_name=lambda df: pd.Categorical(
-                                df.display_name, df.display_name.unique()
-                            )
-                        )
-                    ),
-                    values=plot_var,
-                    columns="timeint",
-                    index=index_var,
-                )
-                .sort_index(axis=1, ascending=True)
-                .sort_index(axis=0, ascending=True)
+        # One heatmap per simulation run and direction, sliced from the cube.
+        if self.link_seg_cube is None:
+            self.set_link_seg_cube()
+        for name in self.link_seg_cube.get_groups():
+            plot_grp_reshaped = self.link_seg_cube.get_heatmap_frame(
+                metric_=plot_var, run_=name[0], direction_=name[1], index_var_=index_var
             )
+            if plot_grp_reshaped.empty:
+                continue
 
             fig = go.Figure(
                 data=go.Heatmap(
@@ -338,6 +412,7 @@ if __name__ == "__main__":
     )
     link_seg_am.test_seg_eval_len()
     link_seg_am.merge_link_mapper()
+    link_seg_am.set_link_seg_cube()
 
     link_seg_am.plot_heatmaps(
         plot_var="speed_1020",
@@ -370,10 +445,8 @@ if __name__ == "__main__":
         colorscale_="RdYlGn",
     )
 
-    link_seg_am.link_seg_vissim_fil_ord = link_seg_am.link_seg_vissim_fil_ord.assign(
-        density_1020_by_ln=lambda df: df.density_1020 / df.linkevalsegment_link_numlanes
-    )
-    link_seg_am.link_seg_vissim_fil_ord.to_excel(path_to_output_qaqc_link)
+    link_seg_am.add_density_by_lane()
+    link_seg_am.link_seg_cube.to_frame().to_excel(path_to_output_qaqc_link)
 
     link_seg_am.plot_heatmaps(
         plot_var="density_1020_by_ln",
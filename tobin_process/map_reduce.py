@@ -0,0 +1,102 @@
+"""
+Module with a small map-reduce layer shared by the evaluation helpers. The inputs are
+split into partitions (vissim runs: one .rsr file per run, or the rows of a run of an
+.att file; or scenarios), a map function computes partial aggregates of each partition,
+in worker processes if n_workers_ > 1, and the partials are reduced into the output
+tables:
+
+- dataframes are concatenated in partition order,
+- mergeable accumulators (objects with a merge method, e.g. GroupedMoments,
+  GroupedQuantileSketch or LinkSegCube) are merged,
+- None is skipped.
+
+A partial is a single value, a tuple or a dict of values; tuples and dicts (also nested
+ones) are reduced element by element. Map functions need to be defined at module level (or be a
+functools.partial of one) so that they can be sent to worker processes.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+
+def partition_by_run(df_, run_col_):
+    """
+    Rows of each run of df_, in sorted run order (as groupby).
+    Returns
+    -------
+    partitions: list
+        One dataframe per run. Rows keep their order and index.
+    """
+    return [
+        partition for _, partition in df_.groupby(run_col_, sort=True, dropna=False)
+    ]
+
+
+def map_partitions(map_func_, partitions_, n_workers_=1):
+    """
+    Apply map_func_ to each partition. With n_workers_ > 1 each partition is processed
+    in a worker process; the partials are returned in partition order in both cases.
+    """
+    if n_workers_ > 1:
+        with ProcessPoolExecutor(max_workers=n_workers_) as executor:
+            return list(executor.map(map_func_, partitions_))
+    return [map_func_(partition) for partition in partitions_]
+
+
+def reduce_values(values_):
+    """
+    Reduce the partials of one output: concat dataframes, merge mergeable
+    accumulators. None values are skipped; returns None if all the values are None.
+    """
+    values = [value for value in values_ if value is not None]
+    if not values:
+        return None
+    if isinstance(values[0], (pd.DataFrame, pd.Series)):
+        return pd.concat(values)
+    if isinstance(values[0], (dict, tuple)):
+        return reduce_partials(values)
+    if not hasattr(values[0], "merge"):
+        raise ValueError(
+            f"Cannot reduce {type(values[0]).__name__} partials. Return dataframes or "
+            "objects with a merge method."
+        )
+    # The partials are merged into the first one (merge methods update in place).
+    reduced = values[0]
+    for value in values[1:]:
+        reduced = reduced.merge(value)
+    return reduced
+
+
+def reduce_partials(partials_):
+    """
+    Reduce the partials of all the partitions. Tuples and dicts are reduced element by
+    element (same positions or keys in all the partials).
+    """
+    partials = list(partials_)
+    if not partials:
+        raise ValueError("No partials to reduce.")
+    if isinstance(partials[0], dict):
+        return {
+            key: reduce_values([partial[key] for partial in partials])
+            for key in partials[0]
+        }
+    if isinstance(partials[0], tuple):
+        return tuple(
+            reduce_values([partial[pos] for partial in partials])
+            for pos in range(len(partials[0]))
+        )
+    return reduce_values(partials)
+
+
+def map_reduce(map_func_, partitions_, n_workers_=1):
+    """
+    reduce_partials(map_partitions(map_func_, partitions_, n_workers_)).
+    Parameters
+    ----------
+    map_func_: callable
+        Partition --> partial aggregates (value, tuple or dict).
+    partitions_: list
+        Partitions, e.g. .rsr paths or partition_by_run(df, run col).
+    n_workers_: int
+        Number of worker processes. 1 maps the partitions in this process.
+    """
+    return reduce_partials(map_partitions(map_func_, partitions_, n_workers_))
@@ -0,0 +1,241 @@
+"""
+Module for loading the mapper workbooks (data/mappers/*.xlsx). Each workbook is parsed
+once with openpyxl; all its sheets and the lookup dicts/ arrays built from them are
+stored in a pickle file and loaded from there by the next scripts. The pickle file is
+rebuilt when the workbook size or modification time changes.
+"""
+import hashlib
+import os
+import pickle
+import numpy as np
+import pandas as pd
+from tobin_process.utils import get_project_root
+
+
+def build_dense_lookup(keys_):
+    """
+    Array mapping an integer key (e.g. tt_seg_no) to its row in the mapper sheet; -1 for
+    keys not in the sheet. Index the array with the key values instead of merging.
+    """
+    keys = np.asarray(keys_, dtype=np.int64)
+    dense_lookup = np.full(keys.max() + 1 if len(keys) else 0, -1, dtype=np.int32)
+    # Same as drop_duplicates: first row wins.
+    dense_lookup[keys[::-1]] = np.arange(len(keys), dtype=np.int32)[::-1]
+    return dense_lookup
+
+
+def compile_sheet_lookups(sheet_):
+    """
+    Build the lookups for the mapper sheets used by the helper modules. The sheet type is
+    recognised from its columns; sheets with other columns get no lookups.
+    Parameters
+    ----------
+    sheet_: pd.DataFrame
+        Mapper sheet.
+    Returns
+    -------
+    lookups: dict
+        Lookup name --> dict or np.ndarray.
+    """
+    cols = set(sheet_.columns)
+    lookups = {}
+    if {"node_no", "node_type"} <= cols:
+        # node_no --> signalized or twsc
+        lookups["node_no_node_type"] = (
+            sheet_.drop_duplicates(["node_no"]).set_index("node_no").node_type.to_dict()
+        )
+    if {"node_no", "intersection_type"} <= cols:
+        lookups["node_no_intersection_type"] = (
+            sheet_.drop_duplicates(["node_no"])
+            .set_index("node_no")
+            .intersection_type.to_dict()
+        )
+    if {"node_no", "movement_direction_unique", "direction_results"} <= cols:
+        # (node_no, movement_direction_unique) --> report direction
+        lookups["node_dir_direction_results"] = {
+            (node_no, str(movement_direction_unique).strip()): direction_results
+            for node_no, movement_direction_unique, direction_results in sheet_[
+                ["node_no", "movement_direction_unique", "direction_results"]
+            ].itertuples(index=False)
+        }
+    if {
+        "node_no",
+        "movement_direction",
+        "movement_direction_unique",
+        "from_link",
+        "to_link",
+    } <= cols:
+        # (node_no, movement_direction, from_link, to_link) --> unique direction
+        lookups["node_movement_direction_unique"] = {
+            (
+                node_no,
+                str(movement_direction).strip(),
+                str(from_link).strip(),
+                str(to_link).strip(),
+            ): movement_direction_unique
+            for (
+                node_no,
+                movement_direction,
+                movement_direction_unique,
+                from_link,
+                to_link,
+            ) in sheet_[
+                [
+                    "node_no",
+                    "movement_direction",
+                    "movement_direction_unique",
+                    "from_link",
+                    "to_link",
+                ]
+            ].itertuples(index=False)
+        }
+    if {"tt_seg_no", "tt_seg_name", "direction", "sort_order"} <= cols:
+        # tt_seg_no --> (tt_seg_name, direction, sort_order)
+        lookups["tt_seg_no_name_direction_order"] = {
+            tt_seg_no: (tt_seg_name, direction, sort_order)
+            for tt_seg_no, tt_seg_name, direction, sort_order in sheet_[
+                ["tt_seg_no", "tt_seg_name", "direction", "sort_order"]
+            ].itertuples(index=False)
+        }
+        lookups["tt_seg_no_row"] = build_dense_lookup(sheet_.tt_seg_no.values)
+    if {"link", "direction", "order", "display_name"} <= cols:
+        # link --> (direction, order, display_name)
+        lookups["link_direction_order_name"] = {
+            link: (direction, order, display_name)
+            for link, direction, order, display_name in sheet_[
+                ["link", "direction", "order", "display_name"]
+            ].itertuples(index=False)
+        }
+        lookups["link_row"] = build_dense_lookup(sheet_.link.values)
+    return lookups
+
+
+class MapperCache:
+    """
+    Cache for the parsed mapper workbooks.
+
+    ...
+    Attributes
+    ___________
+    path_to_cache: str
+        Directory with the compiled mapper files. Created on the first write.
+    Methods
+    ________
+    load_workbook(path_xlsx_): Return {"sheets": {sheet name: pd.DataFrame},
+        "lookups": {sheet name: {lookup name: dict or np.ndarray}}} for the workbook.
+    read_sheet(path_xlsx_, sheet_name_=0): Copy of a mapper sheet. Same as
+        pd.read_excel(path_xlsx_, sheet_name=sheet_name_).
+    get_lookups(path_xlsx_, sheet_name_=0): Lookups built from a mapper sheet. See
+        compile_sheet_lookups.
+    """
+
+    def __init__(self, path_to_cache_):
+        """
+        Parameters
+        ----------
+        path_to_cache_: str
+            Directory with the compiled mapper files.
+        """
+        self.path_to_cache = path_to_cache_
+        # Workbooks loaded by this process: abs path --> (size, mtime_ns, compiled).
+        self._loaded = {}
+
+    def _get_path_compiled(self, path_abs):
+        return os.path.join(
+            self.path_to_cache,
+            hashlib.sha1(path_abs.encode("utf-8")).hexdigest() + ".pkl",
+        )
+
+    def load_workbook(self, path_xlsx_):
+        """
+        Load the compiled workbook; parse and compile it if the workbook is new or
+        changed since it was compiled.
+        Parameters
+        ----------
+        path_xlsx_: str
+            Path to the mapper workbook.
+        """
+        path_abs = os.path.abspath(path_xlsx_)
+        stat_ = os.stat(path_abs)
+        stamp = (stat_.st_size, stat_.st_mtime_ns)
+        if (path_abs in self._loaded) and (self._loaded[path_abs][:2] == stamp):
+            return self._loaded[path_abs][2]
+        path_compiled = self._get_path_compiled(path_abs)
+        compiled = None
+        if os.path.exists(path_compiled):
+            try:
+                with open(path_compiled, "rb") as compiled_file:
+                    compiled = pickle.load(compiled_file)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                compiled = None  # Partially written by another process. Rebuild.
+            if (compiled is not None) and (compiled["stamp"] != stamp):
+                compiled = None
+        if compiled is None:
+            sheets = pd.read_excel(path_abs, sheet_name=None)
+            compiled = {
+                "stamp": stamp,
+                "path": path_abs,
+                "sheets": sheets,
+                "lookups": {
+                    sheet_name: compile_sheet_lookups(sheet)
+                    for sheet_name, sheet in sheets.items()
+                },
+            }
+            os.makedirs(self.path_to_cache, exist_ok=True)
+            path_tmp = f"{path_compiled}.{os.getpid()}.tmp"
+            with open(path_tmp, "wb") as compiled_file:
+                pickle.dump(compiled, compiled_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path_tmp, path_compiled)
+        self._loaded[path_abs] = (*stamp, compiled)
+        return compiled
+
+    def _get_sheet_name(self, compiled, sheet_name_):
+        if isinstance(sheet_name_, int):
+            return list(compiled["sheets"])[sheet_name_]
+        if sheet_name_ not in compiled["sheets"]:
+            raise ValueError(f"No sheet {sheet_name_} in {compiled['path']}.")
+        return sheet_name_
+
+    def read_sheet(self, path_xlsx_, sheet_name_=0):
+        """
+        Copy of a mapper sheet. Same as pd.read_excel(path_xlsx_, sheet_name=sheet_name_).
+        Parameters
+        ----------
+        path_xlsx_: str
+            Path to the mapper workbook.
+        sheet_name_: str or int
+            Sheet name or position.
+        """
+        compiled = self.load_workbook(path_xlsx_)
+        return compiled["sheets"][self._get_sheet_name(compiled, sheet_name_)].copy()
+
+    def get_lookups(self, path_xlsx_, sheet_name_=0):
+        """
+        Lookup dicts and arrays built from a mapper sheet. See compile_sheet_lookups.
+        Parameters
+        ----------
+        path_xlsx_: str
+            Path to the mapper workbook.
+        sheet_name_: str or int
+            Sheet name or position.
+        """
+        compiled = self.load_workbook(path_xlsx_)
+        return compiled["lookups"][self._get_sheet_name(compiled, sheet_name_)]
+
+
+# Cache used by TtEval, BusHeadway, LinkSegEval and NodeEval when no cache is passed.
+default_mapper_cache = MapperCache(
+    os.path.join(get_project_root(), "data", "interim", "mapper_cache")
+)
+
+
+if __name__ == "__main__":
+    # Compile the mapper workbooks used by the 01-04 scripts.
+    path_to_mappers_data = os.path.join(get_project_root(), "data", "mappers")
+    for file_nm in sorted(os.listdir(path_to_mappers_data)):
+        if file_nm.endswith(".xlsx"):
+            compiled_mapper = default_mapper_cache.load_workbook(
+                os.path.join(path_to_mappers_data, file_nm)
+            )
+            for sheet_nm, lookups_sheet in compiled_mapper["lookups"].items():
+                print(f"{file_nm} | {sheet_nm}: {list(lookups_sheet)}")
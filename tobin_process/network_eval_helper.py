@@ -1,20 +1,37 @@
 import inflection
-import pandas as pd
 import numpy as np
-from tobin_process.utils import remove_special_char_vissim_col
+from tobin_process.utils import read_vissim_att
+from tobin_process.utils import categories_to_object
 from tobin_process.utils import get_project_root
+from tobin_process.utils import TimeIntervalSpec
 import os
 
 
+def read_network_eval(paths_network_eval_vissim_, keep_runs_=None):
+    """
+    Read the vissim network performance evaluation .att file with read_vissim_att.
+    """
+    return read_vissim_att(paths_network_eval_vissim_, keep_runs_=keep_runs_)
+
+
 def network_eval_processing(
-    paths_network_eval_vissim_, order_timeint_, order_timeint_labels_am_
+    paths_network_eval_vissim_,
+    order_timeint_,
+    order_timeint_labels_am_,
+    ingest_cache_=None,
+    timeint_spec_=None,
 ):
-    timeint_dict = {x: y for (x, y) in zip(order_timeint_, order_timeint_labels_am_)}
+    if timeint_spec_ is None:
+        timeint_spec_ = TimeIntervalSpec(order_timeint_, order_timeint_labels_am_)
 
-    network_eval = pd.read_csv(
-        paths_network_eval_vissim_, comment="*", sep=";", skiprows=1
-    )
-    network_eval.columns = remove_special_char_vissim_col(network_eval.columns)
+    if ingest_cache_ is not None:
+        network_eval = ingest_cache_.load_or_parse(
+            path_raw_=paths_network_eval_vissim_,
+            parse_func_=lambda: read_network_eval(paths_network_eval_vissim_),
+            variant_="network_eval|att",
+        )
+    else:
+        network_eval = read_network_eval(paths_network_eval_vissim_)
 
     network_eval_fil = (
         network_eval.loc[
@@ -33,7 +50,8 @@ def network_eval_processing(
                 "demandlatent",
             ]
         )
-        .assign(timeint=lambda df: df.timeint.map(timeint_dict))
+        .pipe(categories_to_object)
+        .assign(timeint=lambda df: timeint_spec_.label_timeint(df.timeint))
     )
     return network_eval_fil
 
@@ -1,55 +1,189 @@
 """
 Module to process node evaluation results from Tobin Bridge Project.
 """
+import re
+from functools import partial
 import pandas as pd
 import numpy as np
 from tobin_process.utils import remove_special_char_vissim_col
+from tobin_process.utils import read_vissim_att
+from tobin_process.utils import categories_to_object
+from tobin_process.utils import extract_distinct
 from tobin_process.utils import get_project_root
+from tobin_process.utils import TimeIntervalSpec
+from tobin_process.mapper_cache import default_mapper_cache
+from tobin_process.map_reduce import map_reduce
+from tobin_process.map_reduce import partition_by_run
+from tobin_process.peak_window import find_interval_peak_windows
 import os
 
 
-def los_calc_signal(delay):
+# node_no, from_link and to_link of a vissim movement, e.g.
+# "101 - 10: NEB Storrow Drive@12.3 - 20: SEB MA 3@45.6". Each lookahead is matched
+# from the start of the string, so each group is the same as a separate str.extract with
+# the pattern inside the lookahead.
+MOVEMENT_PATTERN = re.compile(
+    r"^(?=(?P<node_no>\d*))"
+    r"(?=(?:[^:]*)?(?::\W?)?(?P<from_link>[^@]*)?)"
+    r"(?=(?:[^@]*)?(?:[^:]*)?(?::\W?)?(?P<to_link>[^@]*)?)"
+)
+
+
+def decode_movements(movement_):
     """
-    Get the LOS based on delay using HCM 6th Ed methods for signalized intersections.
+    Get node_no, from_link and to_link from the vissim movement strings. Each distinct
+    movement is decoded once with MOVEMENT_PATTERN; see utils.extract_distinct.
+    Parameters
+    ----------
+    movement_: pd.Series
+        Vissim movement strings.
+    Returns
+    -------
+    movement_parts: pd.DataFrame
+        node_no (int), from_link and to_link (stripped) with the index of movement_.
     """
-    los = ""
-    if delay <= 10:
-        los = "A"
-    elif (delay > 10) & (delay <= 20):
-        los = "B"
-    elif (delay > 20) & (delay <= 35):
-        los = "C"
-    elif (delay > 35) & (delay <= 55):
-        los = "D"
-    elif (delay > 55) & (delay <= 80):
-        los = "E"
-    elif delay > 80:
-        los = "F"
-    else:
-        los = ""
-    return los
-
-
-def los_calc_twsc(delay):
+    movement_parts = extract_distinct(movement_, MOVEMENT_PATTERN)
+    return movement_parts.assign(
+        node_no=lambda df: df.node_no.astype(int),
+        from_link=lambda df: df.from_link.str.strip(),
+        to_link=lambda df: df.to_link.str.strip(),
+    )
+
+
+# Upper bounds of control delay (s/veh) for LOS A-E by node type. Delay above the last
+# bound is LOS F. HCM 6th Ed exhibits 19-8 (signalized), 20-2 (twsc), 21-8 (awsc) and
+# 22-8 (roundabout). Use register_los_thresholds to add node types.
+LOS_THRESHOLDS = {
+    "signalized": (10, 20, 35, 55, 80),
+    "twsc": (10, 15, 25, 35, 50),
+    "awsc": (10, 15, 25, 35, 50),
+    "roundabout": (10, 15, 25, 35, 50),
+}
+LOS_LABELS = np.array(["A", "B", "C", "D", "E", "F", ""], dtype=object)
+
+
+def register_los_thresholds(node_type_, thresholds_):
     """
-    Get the LOS based on delay using HCM 6th Ed methods for twsc/ awsc intersections.
+    Add or replace the LOS thresholds for a node type.
+    Parameters
+    ----------
+    node_type_: str
+        Node type as in the node_type column of the mapper (case insensitive).
+    thresholds_: list
+        Upper bounds of delay for LOS A, B, C, D and E (s/veh), in increasing order.
     """
-    los = ""
-    if delay <= 10:
-        los = "A"
-    elif (delay > 10) & (delay <= 15):
-        los = "B"
-    elif (delay > 15) & (delay <= 25):
-        los = "C"
-    elif (delay > 25) & (delay <= 35):
-        los = "D"
-    elif (delay > 35) & (delay <= 50):
-        los = "E"
-    elif delay > 50:
-        los = "F"
-    else:
-        los = ""
-    return los
+    thresholds = tuple(thresholds_)
+    if (len(thresholds) != len(LOS_LABELS) - 2) or (
+        list(thresholds) != sorted(thresholds)
+    ):
+        raise ValueError("Pass 5 increasing delay thresholds for LOS A-E.")
+    LOS_THRESHOLDS[node_type_.lower()] = thresholds
+
+
+def get_los(delay_, node_type_):
+    """
+    Get the LOS for each delay value based on the thresholds for its node type in
+    LOS_THRESHOLDS. Rows are grouped by node type and binned with np.searchsorted, so
+    millions of rows (e.g. all runs instead of only "AVG") are classified in one call.
+    Parameters
+    ----------
+    delay_: array-like
+        Vehicle delay (s/veh).
+    node_type_: array-like
+        Node type for each delay value, e.g. "Signalized" or "twsc".
+    Returns
+    -------
+    los: np.ndarray
+        LOS "A"-"F". "" for missing delay or node types without thresholds.
+    """
+    delay = np.asarray(delay_, dtype=np.float64)
+    node_type_codes, node_types = pd.factorize(pd.Series(node_type_).str.lower())
+    # Index of LOS_LABELS; "" by default.
+    los_idx = np.full(len(delay), len(LOS_LABELS) - 1)
+    for node_type_code, node_type in enumerate(node_types):
+        if node_type not in LOS_THRESHOLDS:
+            continue
+        rows = (node_type_codes == node_type_code) & ~np.isnan(delay)
+        # side="left": delay equal to a bound gets the better LOS, e.g. 10 --> A.
+        los_idx[rows] = np.searchsorted(
+            LOS_THRESHOLDS[node_type], delay[rows], side="left"
+        )
+    return LOS_LABELS[los_idx]
+
+
+def get_rollup_results(node_eval_res_, add_volume_queue_=False):
+    """
+    Approach and intersection results of the movements in node_eval_res_ (map function
+    of NodeEval.set_report_data_rollup; node_eval_res_ holds the movements of one or more
+    runs). The movements are grouped once by run, time interval, node and approach
+    (main_dir); the intersection totals are summed from the approach totals.
+    Volume-weighted delay is sum(vehs_all * vehdelay_all) / sum(vehs_all) at each level.
+    Parameters
+    ----------
+    node_eval_res_: pd.DataFrame
+        Movements with main_dir (see NodeEval.node_eval_res_fil_uniq_dir).
+    add_volume_queue_: bool
+        See NodeEval.set_report_data_rollup.
+    Returns
+    -------
+    rollup_results: dict
+        node_intersection_delay and node_approach_delay.
+    """
+    keys = ["movementevaluation_simrun", "timeint", "node_no"]
+    # Finest level of the rollup. Keep the movements without approach (dropna=False)
+    # for the intersection totals.
+    approach_sums = (
+        node_eval_res_.assign(
+            veh_into_veh_delay=lambda df: df.vehs_all * df.vehdelay_all,
+            qlen_count=lambda df: df.qlen.notna().astype(int),
+        )
+        .groupby(keys + ["main_dir"], sort=True, dropna=False)
+        .agg(
+            vehs_all=("vehs_all", "sum"),
+            veh_into_veh_delay=("veh_into_veh_delay", "sum"),
+            qlen_sum=("qlen", "sum"),
+            qlen_count=("qlen_count", "sum"),
+            qlenmax=("qlenmax", "max"),
+        )
+    )
+    intersection_sums = approach_sums.groupby(level=keys).agg(
+        {
+            "vehs_all": "sum",
+            "veh_into_veh_delay": "sum",
+            "qlen_sum": "sum",
+            "qlen_count": "sum",
+            "qlenmax": "max",
+        }
+    )
+
+    def get_level_results(level_sums):
+        # Groups without volume get 0 delay, as the sum of the weighted delays in
+        # get_veh_delay_by_intersection.
+        level_results = pd.DataFrame(
+            {
+                "vehdelay_all": (
+                    level_sums.veh_into_veh_delay
+                    / level_sums.vehs_all.where(level_sums.vehs_all != 0)
+                ).fillna(0)
+            },
+            index=level_sums.index,
+        )
+        if add_volume_queue_:
+            level_results = level_results.assign(
+                vehs_all=level_sums.vehs_all,
+                qlen=level_sums.qlen_sum / level_sums.qlen_count,
+                qlenmax=level_sums.qlenmax,
+            )
+        return level_results.reset_index()
+
+    return {
+        "node_intersection_delay": get_level_results(intersection_sums).assign(
+            direction_results="Intersection"
+        ),
+        "node_approach_delay": get_level_results(
+            approach_sums.loc[lambda df: df.index.get_level_values("main_dir").notna()]
+        ).assign(direction_results=lambda df: df.main_dir),
+    }
 
 
 class NodeEval:
@@ -93,7 +227,10 @@ class NodeEval:
     Methods
     -----------
     read_node_eval(): Read vissim node evaluation data. Remove special charaters for the
-        column names. Read the data saved in self.path_to_node_eval_res.
+        column names. Read the data saved in self.path_to_node_eval_res. Use
+        self.ingest_cache if set.
+    parse_node_eval(): Parse the vissim node evaluation data with read_vissim_att
+        without the cache.
     clean_node_eval(keep_cols_, keep_runs_, keep_movement_fromlink_level_): Test if the
         run for which results are needed is actually present in the results. If the run
         is present, then call filter_to_relevant_cols_rows to filter columns using
@@ -116,14 +253,22 @@ class NodeEval:
     get_veh_delay_by_intersection(): Aggregate delay by intersection.
     get_veh_delay_by_approach(): Aggregate delay by approach.
     set_report_data(df_list): Concat results by direction, approach, and intersection.
+    set_report_data_rollup(add_volume_queue_=False, n_workers_=1): Aggregate by
+        approach and intersection in one grouped pass per run and set report_data.
     set_los(): Set LOS based on delay.
     format_report_table(
         order_direction_results_,
         order_timeint_,
         results_cols_,
         order_timeint_label_,
+        timeint_spec_=None,
+        report_runs_=None,
     ): Label time intervals, filter results column, set directions in correct sort order.
-    save_output_file(): Save the final data.
+    get_peak_windows(window_=3600, step_=None, entity_cols_=(
+        "movementevaluation_simrun", "node_no"), start_=None, end_=None): Peak window of
+        each node and run from the movement volumes.
+    save_output_file(ci_=None): Save the final data (and the bootstrap intervals ci_ on
+        a second sheet).
     """
 
     def __init__(
@@ -132,6 +277,10 @@ class NodeEval:
         path_to_node_eval_res_,
         path_to_output_node_data_,
         remove_duplicate_dir=False,
+        ingest_cache_=None,
+        read_cols_=None,
+        read_runs_=None,
+        mapper_cache_=None,
     ):
         """
         Initialize the class with path to the mapper file that provides a cross-walk
@@ -150,29 +299,43 @@ class NodeEval:
         remove_duplicate_dir: bool
             If True, use vissim_report_convertion sheet in path_to_mapper_node_eval_ to
             deduplicate duplicated directions for same node.
+        ingest_cache_: tobin_process.ingest_cache.IngestCache
+            If given, load the parsed node evaluation data from the cache when
+            path_to_node_eval_res_ was already parsed.
+        read_cols_: list
+            Only read these columns from path_to_node_eval_res_. None reads all the
+            columns.
+        read_runs_: list
+            Only read these runs (e.g. ["AVG"]) from path_to_node_eval_res_. None reads
+            all the runs. Saves memory for large multi-run files.
+        mapper_cache_: tobin_process.mapper_cache.MapperCache
+            Cache for the parsed mapper workbook. The workbook is parsed once for both
+            sheets. Defaults to mapper_cache.default_mapper_cache.
         """
         # Set paths.
         self.path_to_mapper_node_eval = path_to_mapper_node_eval_
         self.path_to_node_eval_res = path_to_node_eval_res_
         self.path_to_output_node_data = path_to_output_node_data_
+        self.ingest_cache = ingest_cache_
+        self.read_cols = read_cols_
+        self.read_runs = read_runs_
+        if mapper_cache_ is None:
+            mapper_cache_ = default_mapper_cache
         # Mapper files for converting Vissim directions into traffic operation directions.
-        self.node_eval_mapper = pd.read_excel(
-            path_to_mapper_node_eval_, sheet_name="vissim_report_convertion"
+        self.node_eval_mapper = mapper_cache_.read_sheet(
+            path_to_mapper_node_eval_, sheet_name_="vissim_report_convertion"
         )
         # Read the mapping between node number and node type: signalized or twsc
-        self.node_no_node_type = (
-            self.node_eval_mapper.filter(items=["node_no", "node_type"])
-            .drop_duplicates(["node_no"])
-            .reset_index(drop=True)
+        self.node_no_node_type = dict(
+            mapper_cache_.get_lookups(
+                path_to_mapper_node_eval_, sheet_name_="vissim_report_convertion"
+            )["node_no_node_type"]
         )
-        self.node_no_node_type = self.node_no_node_type.set_index("node_no")[
-            "node_type"
-        ].to_dict()
         # Handle case when one direction for a node occurs more than once. For instance,
         # two NBR for a direction need to separated using to and from link names.
         if remove_duplicate_dir:
-            self.node_eval_deduplicate = pd.read_excel(
-                self.path_to_mapper_node_eval, sheet_name="deduplicate_movements"
+            self.node_eval_deduplicate = mapper_cache_.read_sheet(
+                self.path_to_mapper_node_eval, sheet_name_="deduplicate_movements"
             )
             self.node_eval_deduplicate = self.node_eval_deduplicate.assign(
                 from_link=lambda df: df.from_link.str.strip(),
@@ -212,15 +375,23 @@ class NodeEval:
         Read vissim node evaluation data. Remove special charaters for the column names
         Read the data saved in self.path_to_node_eval_res.
         """
-        # * is comment line. $ also means comment, but in pandas we can only use one
-        # char for denoting comment, so using skiprow=1 to skip the 1st row, which has
-        # a $ sign. 2nd and last $ sign is used with column name. Will address it below.
-        node_eval_res = pd.read_csv(
-            self.path_to_node_eval_res, comment="*", sep=";", skiprows=1
+        if self.ingest_cache is not None:
+            return self.ingest_cache.load_or_parse(
+                path_raw_=self.path_to_node_eval_res,
+                parse_func_=self.parse_node_eval,
+                variant_=f"node_eval|att|{self.read_cols}|{self.read_runs}",
+            )
+        return self.parse_node_eval()
+
+    def parse_node_eval(self):
+        """
+        Parse the vissim node evaluation data in self.path_to_node_eval_res.
+        """
+        return read_vissim_att(
+            self.path_to_node_eval_res,
+            usecols_=self.read_cols,
+            keep_runs_=self.read_runs,
         )
-        # Remove special charaters from the Vissim names.
-        node_eval_res.columns = remove_special_char_vissim_col(node_eval_res.columns)
-        return node_eval_res
 
     def clean_node_eval(self, keep_cols_, keep_runs_, keep_movement_fromlink_level_):
         """
@@ -278,15 +449,15 @@ class NodeEval:
                 )
             ]
             .filter(items=self.keep_cols_cor_nm)
-            .assign(
-                node_no=lambda df: df.movement.str.extract(r"(\d*).*?").astype(int),
-                from_link=lambda df: df.movement.str.extract(
-                    r"(?:[^:]*)?(?::\W?)?([^@]*)?"
-                ).transform(lambda x: x.str.strip()),
-                to_link=lambda df: df.movement.str.extract(
-                    r"(?:[^@]*)?(?:[^:]*)?(?::\W?)?([^@]*)?"
-                ).transform(lambda x: x.str.strip()),
-            )
+            .pipe(categories_to_object)
+        )
+        # Movement strings repeat for every run and time interval; decode each
+        # distinct movement once.
+        movement_parts = decode_movements(self.node_eval_res_fil.movement)
+        self.node_eval_res_fil = self.node_eval_res_fil.assign(
+            node_no=movement_parts.node_no,
+            from_link=movement_parts.from_link,
+            to_link=movement_parts.to_link,
         )
 
     def add_report_directions(self):
@@ -315,7 +486,11 @@ class NodeEval:
                 how="left",
             )
             .loc[lambda df: df.movement_direction_unique != "Total"]
-            .assign(main_dir=lambda df: df.direction_results.str.extract(r"(\S{2})"),)
+            .assign(
+                main_dir=lambda df: extract_distinct(
+                    df.direction_results, r"(\S{2})"
+                )[0],
+            )
         )
 
     def test_deduplicate_has_correct_values(self):
@@ -466,23 +641,55 @@ class NodeEval:
             self.node_no_node_type
         )
 
+    def set_report_data_rollup(self, add_volume_queue_=False, n_workers_=1):
+        """
+        Same report_data as get_veh_delay_by_intersection, get_veh_delay_by_approach and
+        set_report_data(df_list=[node_eval_res_fil_uniq_dir, node_intersection_delay,
+        node_approach_delay]), in one grouped pass (like SQL ROLLUP). The movements are
+        partitioned by run and rolled up with get_rollup_results (see map_reduce). Also
+        sets node_intersection_delay and node_approach_delay.
+        Parameters
+        ----------
+        add_volume_queue_: bool
+            If True, also report the summed volume (vehs_all), the mean queue (qlen) and
+            the max queue (qlenmax) of the movements for the approach and intersection
+            rows. Default False keeps only vehdelay_all, as set_report_data.
+        n_workers_: int
+            Number of worker processes for the runs. Default 1 processes the runs in
+            this process.
+        Returns
+        -------
+        report_data: pd.DataFrame
+            Concatenated turning movement, intersection, and approach data.
+        """
+        node_eval_res = self.node_eval_res_fil_uniq_dir
+        rollup_results = map_reduce(
+            partial(get_rollup_results, add_volume_queue_=add_volume_queue_),
+            partition_by_run(node_eval_res, "movementevaluation_simrun"),
+            n_workers_,
+        )
+        self.node_intersection_delay = rollup_results[
+            "node_intersection_delay"
+        ].reset_index(drop=True)
+        self.node_approach_delay = rollup_results["node_approach_delay"].reset_index(
+            drop=True
+        )
+        self.set_report_data(
+            df_list=[
+                node_eval_res,
+                self.node_intersection_delay,
+                self.node_approach_delay,
+            ]
+        )
+        return self.report_data
+
     def set_los(self):
         """
-        Set LOS based on intersection type.
+        Set LOS based on intersection type. See LOS_THRESHOLDS.
         """
         self.report_data = self.report_data.assign(
-            los=lambda df: np.select(
-                [
-                    df.node_type.str.lower() == "signalized",
-                    df.node_type.str.lower() == "twsc",
-                ],
-                [
-                    df.vehdelay_all.apply(los_calc_signal),
-                    df.vehdelay_all.apply(los_calc_twsc),
-                ],
-            )
+            los=lambda df: get_los(df.vehdelay_all.values, df.node_type.values)
         )
-        # Todo: write this function
 
     def format_report_table(
         self,
@@ -490,6 +697,8 @@ class NodeEval:
         order_timeint_,
         results_cols_,
         order_timeint_label_,
+        timeint_spec_=None,
+        report_runs_=None,
     ):
         """
 
@@ -503,14 +712,27 @@ class NodeEval:
             Order for the result columns.
         order_timeint_label_: dict
             label for order_timeint_
+        timeint_spec_: tobin_process.utils.TimeIntervalSpec
+            Time intervals and labels shared with the other modules. If given,
+            order_timeint_ and order_timeint_label_ are not used and can be None.
+        report_runs_: list
+            Runs to include in the report table, e.g. ["AVG"] when the individual runs
+            are kept for the bootstrap intervals. Default: all the runs of report_data.
         """
+        if timeint_spec_ is None:
+            timeint_spec_ = TimeIntervalSpec(order_timeint_, order_timeint_label_)
         # Missing directions would not be included in the report. These are for Freeway
         # , bikepath or crosswalk.
         report_data_fil = self.report_data.loc[lambda df: ~df.direction_results.isna()]
+        if report_runs_ is not None:
+            report_data_fil = report_data_fil.loc[
+                lambda df: df.movementevaluation_simrun.isin(
+                    [str(run) for run in report_runs_]
+                )
+            ]
         report_data_fil_pivot = (
             report_data_fil.assign(
-                timeint=lambda df: pd.Categorical(df.timeint, order_timeint_),
-                timeint_label=lambda df: df.timeint.replace(order_timeint_label_),
+                timeint_label=lambda df: timeint_spec_.label_timeint(df.timeint),
                 direction_results=lambda df: pd.Categorical(
                     df.direction_results.str.strip(), order_direction_results_
                 ),
@@ -545,15 +767,72 @@ class NodeEval:
             .sort_index()
         )
         mux = pd.MultiIndex.from_product(
-            [order_timeint_label_.values(), results_cols_], names=["timeint_label", ""],
+            [timeint_spec_.labels, results_cols_], names=["timeint_label", ""],
         )
         self.report_data_fil_pivot = report_data_fil_pivot.reindex(mux, axis=1)
 
-    def save_output_file(self):
+    def get_peak_windows(
+        self,
+        window_=3600,
+        step_=None,
+        entity_cols_=("movementevaluation_simrun", "node_no"),
+        start_=None,
+        end_=None,
+    ):
+        """
+        Peak window (e.g. the peak hour) of each node and run, and of all the nodes
+        together, from the volumes (vehs_all) of the movements in
+        node_eval_res_fil_uniq_dir per vissim time interval (the vissim "Total" rows
+        are not counted). See peak_window.find_interval_peak_windows.
+        Parameters
+        ----------
+        window_: float
+            Window length (s). Default: peak hour.
+        step_: float
+            Resolution (s) of the window starts. None starts the windows on the
+            boundaries of the vissim time intervals (if they have the same length).
+        entity_cols_: list
+            Keys of the entities, e.g. ("movementevaluation_simrun", "node_no",
+            "main_dir") by approach.
+        start_, end_: float
+            Period searched (s), e.g. start_ at the end of the warm-up. Only the vissim
+            time intervals entirely in the period are used. See
+            peak_window.find_interval_peak_windows.
+        Returns
+        -------
+        peak_by_entity: pd.DataFrame
+            entity_cols_ with peak_start, peak_end, peak_timeint and peak_volume.
+        peak_overall: pd.DataFrame
+            Peak window of the volumes of all the entities.
+        """
+        # node_eval_res_fil_uniq_dir has no vissim "Total" rows; with node_eval_res_fil
+        # each node would be counted twice (its movements and its Total row).
+        return find_interval_peak_windows(
+            self.node_eval_res_fil_uniq_dir,
+            "timeint",
+            "vehs_all",
+            list(entity_cols_),
+            window_=window_,
+            step_=step_,
+            start_=start_,
+            end_=end_,
+        )
+
+    def save_output_file(self, ci_=None):
         """
         Save the node evaluation output.
+        Parameters
+        ----------
+        ci_: pd.DataFrame
+            Bootstrap confidence intervals, e.g. from bootstrap.bootstrap_node_ci. If
+            given, saved to the "ci" sheet of the same file.
         """
-        self.report_data_fil_pivot.to_excel(self.path_to_output_node_data)
+        if ci_ is None:
+            self.report_data_fil_pivot.to_excel(self.path_to_output_node_data)
+            return
+        with pd.ExcelWriter(self.path_to_output_node_data) as writer:
+            self.report_data_fil_pivot.to_excel(writer)
+            ci_.to_excel(writer, sheet_name="ci")
 
 
 if __name__ == "__main__":
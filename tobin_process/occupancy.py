@@ -0,0 +1,222 @@
+"""
+Module with the vehicle occupancy (persons per vehicle) used for person delay. Each vissim
+vehicle type either has a constant occupancy (e.g. 1.3 persons per car) or an occupancy
+measured at data collection points (the pers column of the .mer file, e.g. bus
+passengers). The occupancy of all the traversals is resolved with array lookups by
+vehicle type and vehicle number, without merging the traversals with the .mer data.
+"""
+import warnings
+import numpy as np
+import pandas as pd
+
+
+class OccupancyTable:
+    """
+    Occupancy source of each vissim vehicle type.
+
+    ...
+    Attributes
+    ___________
+    occupancy_src: pd.DataFrame()
+        veh_type, occupancy and data_col_no. One row per vehicle type with a constant
+        occupancy (data_col_no NaN) and one row per vehicle type and data collection
+        point for measured occupancies (occupancy NaN).
+    veh_types: np.ndarray
+        Sorted vehicle types.
+    occupancy: np.ndarray
+        Constant occupancy of each vehicle type in veh_types; NaN for measured types.
+    measured: np.ndarray
+        True for the vehicle types in veh_types with measured occupancy.
+    use_data_col_no: list
+        Data collection points to read from the .mer files.
+    Methods
+    ________
+    get_measured_pers(dat_col_persons_): Occupancy of each measured vehicle as an
+        array indexed by vehicle number.
+    get_pers(veh_, veh_type_, pers_by_veh_=None): Occupancy of each traversal.
+    add_person_delay(tt_vissim_raw_, pers_by_veh_=None): Add pers and pers_delay.
+    """
+
+    def __init__(self, occupancy_src_):
+        """
+        Parameters
+        ----------
+        occupancy_src_: dict or pd.DataFrame
+            Vehicle type --> constant occupancy (float) or list of data collection
+            points where the occupancy is measured, e.g.
+            {100: 1.3, 200: 1.3, 300: [3000, 3001]}. A vehicle with measured
+            occupancy gets the pers of the first of these points it passes. Or a
+            dataframe with veh_type, occupancy and data_col_no columns (see
+            occupancy_src), e.g. read from a mapper sheet.
+        """
+        if isinstance(occupancy_src_, dict):
+            occupancy_src_ = pd.DataFrame(
+                [
+                    {"veh_type": veh_type, "occupancy": np.nan, "data_col_no": point}
+                    for veh_type, src in occupancy_src_.items()
+                    if np.ndim(src) == 1
+                    for point in src
+                ]
+                + [
+                    {"veh_type": veh_type, "occupancy": src, "data_col_no": np.nan}
+                    for veh_type, src in occupancy_src_.items()
+                    if np.ndim(src) == 0
+                ],
+                columns=["veh_type", "occupancy", "data_col_no"],
+            )
+        missing_cols = {"veh_type", "occupancy", "data_col_no"} - set(
+            occupancy_src_.columns
+        )
+        if missing_cols:
+            raise ValueError(f"occupancy_src_ needs the columns {sorted(missing_cols)}.")
+        if occupancy_src_.empty:
+            raise ValueError("occupancy_src_ has no vehicle types.")
+        self.occupancy_src = occupancy_src_.filter(
+            items=["veh_type", "occupancy", "data_col_no"]
+        ).reset_index(drop=True)
+        is_measured = self.occupancy_src.data_col_no.notna()
+        if (is_measured == self.occupancy_src.occupancy.notna()).any():
+            raise ValueError(
+                "Each occupancy_src_ row needs either an occupancy or a data_col_no."
+            )
+        src_by_type = self.occupancy_src.groupby("veh_type").agg(
+            occupancy=("occupancy", "first"),
+            measured=("data_col_no", lambda data_col_no: data_col_no.notna().any()),
+            constant=("occupancy", lambda occupancy: occupancy.notna().sum()),
+        )
+        if (src_by_type.measured & (src_by_type.constant > 0)).any() or (
+            src_by_type.constant > 1
+        ).any():
+            raise ValueError(
+                "Give each vehicle type one constant occupancy or data collection "
+                "points, not both."
+            )
+        self.veh_types = src_by_type.index.values.astype(np.int64)
+        self.occupancy = src_by_type.occupancy.values.astype(np.float64)
+        self.measured = src_by_type.measured.values.astype(bool)
+        self.use_data_col_no = sorted(
+            self.occupancy_src.data_col_no.dropna().astype(np.int64).unique()
+        )
+
+    def get_measured_pers(self, dat_col_persons_):
+        """
+        Occupancy of each vehicle of a measured vehicle type, at the first of the data
+        collection points of its type it passes.
+        Parameters
+        ----------
+        dat_col_persons_: pd.DataFrame
+            .mer data of a run with measurem, t_entry, veh_no, vehicle type and pers
+            (see travel_time_seg_helper.read_mer_file).
+        Returns
+        -------
+        pers_by_veh: np.ndarray
+            Occupancy indexed by vehicle number; NaN for vehicles not measured.
+        """
+        measured_points = pd.MultiIndex.from_frame(
+            self.occupancy_src.loc[
+                lambda df: df.data_col_no.notna(), ["veh_type", "data_col_no"]
+            ].astype(np.int64)
+        )
+        # t_entry > 0 removes -1 entries.
+        dat_col_persons = (
+            dat_col_persons_.loc[
+                lambda df: (df.t_entry > 0)
+                & pd.MultiIndex.from_arrays(
+                    [
+                        df["vehicle type"].values.astype(np.int64),
+                        df.measurem.values.astype(np.int64),
+                    ]
+                ).isin(measured_points)
+            ]
+            .sort_values("t_entry", kind="mergesort")
+            .drop_duplicates("veh_no")
+        )
+        veh_no = dat_col_persons.veh_no.values.astype(np.int64)
+        pers_by_veh = np.full(veh_no.max() + 1 if len(veh_no) else 0, np.nan)
+        pers_by_veh[veh_no] = dat_col_persons.pers.values
+        return pers_by_veh
+
+    def get_pers(self, veh_, veh_type_, pers_by_veh_=None):
+        """
+        Occupancy of each traversal: the constant of its vehicle type or the measured
+        occupancy of the vehicle.
+        Parameters
+        ----------
+        veh_: np.ndarray
+            Vehicle number of each traversal.
+        veh_type_: np.ndarray
+            Vehicle type of each traversal.
+        pers_by_veh_: np.ndarray
+            From get_measured_pers. Needed if there are measured vehicle types.
+        Returns
+        -------
+        pers: np.ndarray
+            NaN for vehicle types not in the table.
+        """
+        veh = np.asarray(veh_, dtype=np.int64)
+        type_pos = np.searchsorted(self.veh_types, veh_type_)
+        type_pos = np.minimum(type_pos, len(self.veh_types) - 1)
+        known_type = self.veh_types[type_pos] == veh_type_
+        unknown_types = np.unique(np.asarray(veh_type_)[~known_type])
+        if len(unknown_types):
+            warnings.warn(
+                f"No occupancy for the vehicle types {list(unknown_types)}; their "
+                f"person delay is NaN."
+            )
+        is_measured = known_type & self.measured[type_pos]
+        measured_pers = np.full(len(veh), np.nan)
+        if is_measured.any():
+            if pers_by_veh_ is None:
+                raise ValueError("Pass pers_by_veh_ from get_measured_pers.")
+            in_range = is_measured & (veh >= 0) & (veh < len(pers_by_veh_))
+            measured_pers[in_range] = pers_by_veh_[veh[in_range]]
+            if np.isnan(measured_pers[is_measured]).any():
+                missing_veh_types = np.unique(
+                    np.asarray(veh_type_)[is_measured & np.isnan(measured_pers)]
+                )
+                raise ValueError(
+                    "Check if there is occupancy data collected in the data collection "
+                    f"points for all the vehicles of types {list(missing_veh_types)}."
+                )
+        constant_pers = np.where(known_type, self.occupancy[type_pos], np.nan)
+        return np.where(is_measured, measured_pers, constant_pers)
+
+    def add_person_delay(self, tt_vissim_raw_, pers_by_veh_=None):
+        """
+        Add persons (pers) and person delay (pers_delay) to each traversal in
+        tt_vissim_raw_ (in place).
+        Parameters
+        ----------
+        tt_vissim_raw_: pd.DataFrame
+            Traversals with veh, veh_type and veh_delay.
+        pers_by_veh_: np.ndarray
+            See get_pers.
+        """
+        tt_vissim_raw_["pers"] = self.get_pers(
+            tt_vissim_raw_.veh.values, tt_vissim_raw_.veh_type.values, pers_by_veh_
+        )
+        tt_vissim_raw_["pers_delay"] = (
+            tt_vissim_raw_.pers.values * tt_vissim_raw_.veh_delay.values
+        )
+        return tt_vissim_raw_
+
+
+def get_threshold_occupancy_table(
+    veh_types_, car_hgv_veh_occupancy_, use_data_col_no_, min_bus_veh_type_=300
+):
+    """
+    Occupancy table of the Tobin Bridge convention (car_hgv_veh_occupancy and
+    use_data_col_no kwargs of TtEval.read_rsr_tt): vehicle types below
+    min_bus_veh_type_ get car_hgv_veh_occupancy_, the other types are measured at
+    use_data_col_no_.
+    """
+    return OccupancyTable(
+        {
+            veh_type: (
+                car_hgv_veh_occupancy_
+                if veh_type < min_bus_veh_type_
+                else list(use_data_col_no_)
+            )
+            for veh_type in veh_types_
+        }
+    )
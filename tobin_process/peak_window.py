@@ -0,0 +1,254 @@
+"""
+Module to find the peak period (e.g. the peak hour) of each travel time segment or node
+from the simulated volumes, instead of hard-coding report windows such as "6300-9900".
+The volumes of each entity (segment, node, run) are binned at a fine step (e.g. 1
+minute); with the cumulative sum over the steps, the volume of every candidate window
+(one starting at each step) is a single subtraction for all the entities at once. The
+windows are returned as "start-end" strings, like the vissim time intervals, so they can
+be passed to utils.TimeIntervalSpec.
+"""
+import numpy as np
+import pandas as pd
+from tobin_process.utils import categories_to_object
+from tobin_process.utils import TimeIntervalSpec
+from tobin_process.grouped_stats import GroupIndex
+
+
+def get_window_volumes(step_volumes_, window_steps_):
+    """
+    Volume of each window of window_steps_ consecutive steps.
+    Parameters
+    ----------
+    step_volumes_: np.ndarray
+        Volume of each (entity, step).
+    window_steps_: int
+        Number of steps in a window.
+    Returns
+    -------
+    window_volumes: np.ndarray
+        Shape (entities, steps - window_steps_ + 1); column i is the window starting at
+        step i.
+    """
+    cum_volumes = np.zeros((step_volumes_.shape[0], step_volumes_.shape[1] + 1))
+    np.cumsum(step_volumes_, axis=1, out=cum_volumes[:, 1:])
+    return cum_volumes[:, window_steps_:] - cum_volumes[:, :-window_steps_]
+
+
+def get_peak_window_frames(step_volumes_, entity_keys_, start_, step_, window_):
+    """
+    Peak window of each entity and of all the entities together from the binned
+    volumes. The earliest window wins ties.
+    Parameters
+    ----------
+    step_volumes_: np.ndarray
+        Volume of each (entity, step); step 0 starts at start_.
+    entity_keys_: pd.DataFrame
+        Keys of each row of step_volumes_.
+    start_: float
+        Start time (s) of the first step.
+    step_: float
+        Step length (s).
+    window_: float
+        Window length (s). A multiple of step_.
+    Returns
+    -------
+    peak_by_entity: pd.DataFrame
+        entity_keys_ with peak_start, peak_end, peak_timeint ("start-end") and
+        peak_volume.
+    peak_overall: pd.DataFrame
+        Same columns (without the keys) for the sum of the entities.
+    """
+    window_steps = int(round(window_ / step_))
+    if (window_steps < 1) or not np.isclose(window_steps * step_, window_):
+        raise ValueError(f"window_ {window_} is not a multiple of step_ {step_}.")
+    if window_steps > step_volumes_.shape[1]:
+        raise ValueError(
+            f"window_ {window_} is longer than the period with volumes "
+            f"({step_volumes_.shape[1] * step_} s)."
+        )
+
+    def get_peak_frame(step_volumes):
+        window_volumes = get_window_volumes(step_volumes, window_steps)
+        peak_step = np.argmax(window_volumes, axis=1)
+        peak_start = np.float64(start_) + peak_step * step_
+        peak_end = peak_start + window_
+        return pd.DataFrame(
+            {
+                "peak_start": peak_start,
+                "peak_end": peak_end,
+                "peak_timeint": [
+                    f"{peak_start_:g}-{peak_end_:g}"
+                    for peak_start_, peak_end_ in zip(peak_start, peak_end)
+                ],
+                "peak_volume": window_volumes[np.arange(len(peak_step)), peak_step],
+            }
+        )
+
+    peak_by_entity = pd.concat(
+        [
+            entity_keys_.reset_index(drop=True),
+            get_peak_frame(step_volumes_),
+        ],
+        axis=1,
+    )
+    peak_overall = get_peak_frame(step_volumes_.sum(axis=0, keepdims=True))
+    return peak_by_entity, peak_overall
+
+
+def get_entity_index(df_, entity_cols_):
+    """
+    GroupIndex of entity_cols_ and the keys of each entity (object columns).
+    """
+    entity_index = GroupIndex(df_, list(entity_cols_))
+    entity_keys = categories_to_object(
+        entity_index.group_index.to_frame(index=False)
+    )
+    return entity_index, entity_keys
+
+
+def find_peak_windows(
+    df_,
+    time_col_,
+    entity_cols_,
+    window_=3600,
+    step_=60,
+    start_=None,
+    end_=None,
+    weight_col_=None,
+):
+    """
+    Peak window of each entity from event times, e.g. the .rsr exit times of the
+    traversals of each travel time segment and run.
+    Parameters
+    ----------
+    df_: pd.DataFrame
+        One row per event.
+    time_col_: str
+        Event time column (s).
+    entity_cols_: list
+        Entity keys, e.g. ["run_no", "no"].
+    window_: float
+        Window length (s). Default: peak hour.
+    step_: float
+        Resolution (s) of the window starts. Default: 1 minute.
+    start_: float
+        Start of the period searched (s), e.g. the end of the warm-up. Defaults to
+        the first event time rounded down to step_.
+    end_: float
+        End of the period searched (s, excluded). Defaults to the step after the last
+        event time.
+    weight_col_: str
+        Volume of each event. None counts the rows.
+    Returns
+    -------
+    peak_by_entity: pd.DataFrame
+    peak_overall: pd.DataFrame
+        See get_peak_window_frames.
+    """
+    if df_.empty:
+        raise ValueError("No events to find the peak window from.")
+    time = df_[time_col_].values.astype(np.float64)
+    if start_ is None:
+        start_ = np.floor(np.nanmin(time) / step_) * step_
+    if end_ is None:
+        end_ = (np.floor(np.nanmax(time) / step_) + 1) * step_
+    n_steps = int(np.ceil((end_ - start_) / step_))
+    entity_index, entity_keys = get_entity_index(df_, entity_cols_)
+    keep = (entity_index.codes >= 0) & (time >= start_) & (time < end_)
+    step_pos = ((time[keep] - start_) // step_).astype(np.int64)
+    weights = None if weight_col_ is None else df_[weight_col_].values[keep]
+    step_volumes = np.bincount(
+        entity_index.codes[keep] * n_steps + step_pos,
+        weights=weights,
+        minlength=entity_index.n_groups * n_steps,
+    ).reshape(entity_index.n_groups, n_steps)
+    return get_peak_window_frames(step_volumes, entity_keys, start_, step_, window_)
+
+
+def find_interval_peak_windows(
+    df_,
+    timeint_col_,
+    volume_col_,
+    entity_cols_,
+    window_=3600,
+    step_=None,
+    start_=None,
+    end_=None,
+):
+    """
+    Peak window of each entity from volumes per time interval, e.g. the vehs_all of
+    the node evaluation movements. The volume of an interval is spread evenly over
+    its steps, so windows that do not start on an interval boundary use the average
+    rate of the intervals they cut.
+    Parameters
+    ----------
+    df_: pd.DataFrame
+        One row per entity (or movement of an entity) and time interval.
+    timeint_col_: str
+        Time interval column, "start-end" in seconds, e.g. "2700-3600".
+    volume_col_: str
+        Volume column. Rows of an entity and interval are summed.
+    entity_cols_: list
+        Entity keys, e.g. ["movementevaluation_simrun", "node_no"].
+    window_: float
+        Window length (s). Default: peak hour.
+    step_: float
+        Resolution (s) of the window starts. None uses the largest step that divides
+        the interval bounds and window_: with intervals of the same length, the
+        windows then start on interval boundaries.
+    start_: float
+        Start of the period searched (s), e.g. the end of the warm-up. Intervals that
+        start before start_ are not used. Default: the first interval.
+    end_: float
+        End of the period searched (s). Intervals that end after end_ are not used.
+        Default: the last interval.
+    Returns
+    -------
+    peak_by_entity: pd.DataFrame
+    peak_overall: pd.DataFrame
+        See get_peak_window_frames.
+    """
+    if (start_ is not None) or (end_ is not None):
+        # Only the intervals entirely in the period: the volume of an interval cannot
+        # be split at start_ or end_.
+        timeints = pd.unique(df_[timeint_col_].dropna())
+        timeint_spec = TimeIntervalSpec(timeints)
+        in_period = np.ones(len(timeints), dtype=bool)
+        if start_ is not None:
+            in_period &= timeint_spec.starts >= start_
+        if end_ is not None:
+            in_period &= timeint_spec.ends <= end_
+        df_ = df_.loc[df_[timeint_col_].isin(timeints[in_period])]
+    if df_.empty:
+        raise ValueError("No volumes to find the peak window from.")
+    timeint_codes, timeints = pd.factorize(df_[timeint_col_], sort=True)
+    timeint_spec = TimeIntervalSpec(timeints)
+    start = timeint_spec.starts.min()
+    if step_ is None:
+        bounds = np.r_[timeint_spec.starts, timeint_spec.ends] - start
+        if not np.allclose(bounds, np.round(bounds)):
+            raise ValueError("Pass step_ for time intervals that are not whole seconds.")
+        step_ = np.gcd.reduce(np.round(np.r_[bounds, window_]).astype(np.int64))
+    n_steps = int(np.ceil((timeint_spec.ends.max() - start) / step_))
+    first_steps = np.round((timeint_spec.starts - start) / step_).astype(np.int64)
+    end_steps = np.round((timeint_spec.ends - start) / step_).astype(np.int64)
+    if not (
+        np.allclose(first_steps * step_, timeint_spec.starts - start)
+        and np.allclose(end_steps * step_, timeint_spec.ends - start)
+    ):
+        raise ValueError(f"The time intervals do not start and end on steps of {step_}.")
+    entity_index, entity_keys = get_entity_index(df_, entity_cols_)
+    keep = (entity_index.codes >= 0) & (timeint_codes >= 0)
+    # Volume of each (entity, interval); the intervals are few, so each is spread over
+    # its steps for all the entities at once.
+    interval_volumes = np.bincount(
+        entity_index.codes[keep] * len(timeints) + timeint_codes[keep],
+        weights=np.nan_to_num(df_[volume_col_].values[keep].astype(np.float64)),
+        minlength=entity_index.n_groups * len(timeints),
+    ).reshape(entity_index.n_groups, len(timeints))
+    step_volumes = np.zeros((entity_index.n_groups, n_steps))
+    for timeint_code, (first_step, end_step) in enumerate(zip(first_steps, end_steps)):
+        step_volumes[:, first_step:end_step] += (
+            interval_volumes[:, [timeint_code]] / (end_step - first_step)
+        )
+    return get_peak_window_frames(step_volumes, entity_keys, start, step_, window_)
@@ -0,0 +1,334 @@
+"""
+Module with a mergeable quantile sketch for many groups at once, based on DDSketch
+(Masson et al., 2019). Values are counted in logarithmic buckets: bucket i holds the
+values in (gamma ** (i - 1), gamma ** i] with gamma = (1 + alpha) / (1 - alpha), and is
+read back as 2 * gamma ** i / (gamma + 1). A quantile read from the sketch is within a
+relative error alpha (relative_accuracy_) of the exact quantile. Merging two sketches
+adds their bucket counts, so sketches of chunks of a file, of vissim runs or of scenarios
+can be combined without the raw values. The memory used depends on the number of groups
+and the spread of the values, not on the number of values.
+"""
+import numpy as np
+import pandas as pd
+from tobin_process.utils import categories_to_object
+from tobin_process.utils import map_index_level
+
+# Bucket for zeros. Sorted before the buckets of the positive values.
+ZERO_BUCKET = np.iinfo(np.int64).min
+
+
+class GroupedQuantileSketch:
+    """
+    Quantile sketch of a non-negative column for each group of keys.
+
+    ...
+    Attributes
+    ___________
+    keys: list
+        Group columns.
+    relative_accuracy: float
+        Relative error alpha of the quantiles read from the sketch.
+    gamma: float
+        Ratio between the upper and lower bound of a bucket.
+    counts: pd.Series()
+        Number of values in each bucket of each group; indexed by keys + ["bucket"].
+        Categorical keys are stored as their values (object).
+    Methods
+    ________
+    add(df_, value_col_, group_index_=None): Count the values_col_ values of df_ in the sketch.
+    merge(other_): Add the counts of another sketch with the same keys and accuracy.
+    pool(keys_): Sketch of coarser groups, e.g. all the runs of a time interval,
+        segment and class.
+    regroup(key_, key_map_): Sketch of groups made of several key_ values, e.g. report
+        vehicle classes made of vehicle types.
+    quantiles(quantiles_): Quantiles of each group.
+    """
+
+    def __init__(self, keys_, relative_accuracy_=0.005):
+        """
+        Parameters
+        ----------
+        keys_: list
+            Group columns.
+        relative_accuracy_: float
+            Relative error of the quantiles (between 0 and 1). With the default 0.5%
+            a travel time of 200 s is read back within +/- 1 s. The number of buckets
+            per group grows as log(max value / min value) / relative_accuracy_.
+        """
+        if not 0 < relative_accuracy_ < 1:
+            raise ValueError("relative_accuracy_ needs to be between 0 and 1.")
+        self.keys = list(keys_)
+        self.relative_accuracy = relative_accuracy_
+        self.gamma = (1 + relative_accuracy_) / (1 - relative_accuracy_)
+        self.counts = pd.Series(dtype=np.int64)
+
+    def get_buckets(self, values_):
+        """
+        Bucket of each value. Zeros get ZERO_BUCKET.
+        """
+        values = np.asarray(values_, dtype=np.float64)
+        buckets = np.full(len(values), ZERO_BUCKET, dtype=np.int64)
+        positive = values > 0
+        buckets[positive] = np.ceil(np.log(values[positive]) / np.log(self.gamma))
+        return buckets
+
+    def get_bucket_values(self, buckets_):
+        """
+        Value read back for each bucket; within relative_accuracy of all the values in
+        the bucket.
+        """
+        buckets = np.asarray(buckets_, dtype=np.int64)
+        bucket_values = np.zeros(len(buckets), dtype=np.float64)
+        non_zero = buckets != ZERO_BUCKET
+        bucket_values[non_zero] = (
+            2 * self.gamma ** buckets[non_zero].astype(np.float64) / (self.gamma + 1)
+        )
+        return bucket_values
+
+    def add(self, df_, value_col_, group_index_=None):
+        """
+        Count the value_col_ values of df_ in the sketch of their group. NaN values are
+        skipped.
+        Parameters
+        ----------
+        df_: pd.DataFrame
+            Chunk of data with the keys and value_col_ columns.
+        value_col_: str
+            Column to sketch. Values need to be >= 0.
+        group_index_: tobin_process.grouped_stats.GroupIndex
+            GroupIndex of df_ on keys, if already built. The (group, bucket) pairs are
+            then counted from the integer group codes.
+        """
+        values = df_[value_col_].values.astype(np.float64)
+        valid = ~np.isnan(values)
+        if (values[valid] < 0).any():
+            raise ValueError(f"{value_col_} has negative values. Cannot sketch them.")
+        if group_index_ is not None:
+            if group_index_.keys != self.keys:
+                raise ValueError(f"group_index_ needs the keys {self.keys}.")
+            valid &= group_index_.codes >= 0
+            if not valid.any():
+                return self
+            buckets = self.get_buckets(values[valid])
+            # One int64 key per (group, bucket) pair: a 1-D np.unique is much faster
+            # than np.unique(axis=0) on the pairs. Buckets are offset to 1, 2, ...; the
+            # zero bucket gets 0 so that it stays sorted first.
+            is_zero = buckets == ZERO_BUCKET
+            min_bucket = buckets[~is_zero].min() - 1 if (~is_zero).any() else 0
+            bucket_offsets = np.where(is_zero, 0, buckets - min_bucket)
+            n_offsets = bucket_offsets.max() + 1
+            group_bucket_keys, bucket_counts = np.unique(
+                group_index_.codes[valid].astype(np.int64) * n_offsets + bucket_offsets,
+                return_counts=True,
+            )
+            bucket_offsets = group_bucket_keys % n_offsets
+            group_keys = group_index_.get_object_index()[
+                group_bucket_keys // n_offsets
+            ]
+            self._add_counts(
+                pd.Series(
+                    bucket_counts,
+                    index=pd.MultiIndex.from_arrays(
+                        [group_keys.get_level_values(key) for key in self.keys]
+                        + [
+                            np.where(
+                                bucket_offsets == 0,
+                                ZERO_BUCKET,
+                                bucket_offsets + min_bucket,
+                            )
+                        ],
+                        names=self.keys + ["bucket"],
+                    ),
+                ).sort_index()
+            )
+            return self
+        # Object keys: aligning indexes with categorical levels in _add_counts can
+        # duplicate groups.
+        chunk_counts = (
+            categories_to_object(df_.loc[valid, self.keys])
+            .assign(bucket=self.get_buckets(values[valid]))
+            .groupby(self.keys + ["bucket"])
+            .size()
+        )
+        self._add_counts(chunk_counts)
+        return self
+
+    def merge(self, other_):
+        """
+        Add the bucket counts of other_, e.g. the sketch of another file or process.
+        """
+        if (other_.keys != self.keys) or (
+            other_.relative_accuracy != self.relative_accuracy
+        ):
+            raise ValueError("Can only merge sketches with the same keys and accuracy.")
+        self._add_counts(other_.counts)
+        return self
+
+    def pool(self, keys_):
+        """
+        Merge the sketches of the groups with the same keys_ values. Quantiles of the
+        pooled sketch are quantiles of all the values of the merged groups (e.g. of all
+        the vehicles of all the runs), with the same relative_accuracy.
+        Parameters
+        ----------
+        keys_: list
+            Subset of keys.
+        Returns
+        -------
+        pooled_sketch: GroupedQuantileSketch
+        """
+        if not set(keys_) <= set(self.keys):
+            raise ValueError(f"Can only pool on a subset of {self.keys}.")
+        pooled_sketch = GroupedQuantileSketch(keys_, self.relative_accuracy)
+        if not self.counts.empty:
+            pooled_sketch.counts = self.counts.groupby(
+                level=list(keys_) + ["bucket"]
+            ).sum()
+        return pooled_sketch
+
+    def regroup(self, key_, key_map_):
+        """
+        Sketch of new groups made of key_ values: key_ is replaced with the new key of
+        key_map_. A key_ value mapped to several new values is counted in each of them.
+        Same counts as a sketch of the rows duplicated once per new value.
+        Parameters
+        ----------
+        key_: str
+            Key to replace, e.g. "veh_type".
+        key_map_: pd.DataFrame
+            key_ and the new key columns, one row per pair, e.g. veh_type and
+            veh_cls_res.
+        Returns
+        -------
+        regrouped_sketch: GroupedQuantileSketch
+        """
+        if key_ not in self.keys:
+            raise ValueError(f"{key_} is not in {self.keys}.")
+        if self.counts.empty:
+            new_key = [colnm for colnm in key_map_.columns if colnm != key_][0]
+            return GroupedQuantileSketch(
+                [new_key if key == key_ else key for key in self.keys],
+                self.relative_accuracy,
+            )
+        positions, new_index = map_index_level(self.counts.index, key_, key_map_)
+        regrouped_sketch = GroupedQuantileSketch(
+            list(new_index.names[:-1]), self.relative_accuracy
+        )
+        regrouped_sketch._add_counts(
+            pd.Series(self.counts.values[positions], index=new_index)
+            .groupby(level=list(new_index.names))
+            .sum()
+        )
+        return regrouped_sketch
+
+    def _add_counts(self, counts):
+        if counts.empty:
+            return
+        if self.counts.empty:
+            self.counts = counts.astype(np.int64)
+        else:
+            self.counts = self.counts.add(counts, fill_value=0).astype(np.int64)
+
+    def quantiles(self, quantiles_):
+        """
+        Quantiles of each group with linear interpolation between the ranks below and
+        above, like np.quantile(x, q). Each quantile is within relative_accuracy of
+        np.quantile on the values added to the group.
+        Parameters
+        ----------
+        quantiles_: list
+            Quantiles between 0 and 1.
+        Returns
+        -------
+        group_quantiles: pd.DataFrame
+            One row per group, indexed by keys, one column per quantile.
+        """
+        if self.counts.empty:
+            return pd.DataFrame(
+                columns=list(quantiles_),
+                index=pd.MultiIndex.from_arrays(
+                    [[] for _ in self.keys], names=self.keys
+                ),
+                dtype=np.float64,
+            )
+        counts = self.counts.sort_index()
+        group_codes, group_index = counts.index.droplevel(-1).factorize()
+        group_index.names = self.keys
+        n_counts = counts.values
+        # Groups are contiguous after sort_index.
+        starts = np.r_[0, np.flatnonzero(np.diff(group_codes)) + 1]
+        cum_counts = np.cumsum(n_counts)
+        count_before = np.r_[0, cum_counts][starts]
+        sizes = np.add.reduceat(n_counts, starts)
+        bucket_values = self.get_bucket_values(
+            counts.index.get_level_values(-1).values
+        )
+
+        def get_ranked_values(rank):
+            # Bucket of the value with the given 0-based rank within each group.
+            return bucket_values[
+                np.searchsorted(cum_counts, count_before + rank, side="right")
+            ]
+
+        group_quantiles = {}
+        for quantile in quantiles_:
+            pos = quantile * (sizes - 1)
+            pos_below = np.floor(pos).astype(np.int64)
+            below = get_ranked_values(pos_below)
+            above = get_ranked_values(np.minimum(pos_below + 1, sizes - 1))
+            group_quantiles[quantile] = below + (above - below) * (pos - pos_below)
+        return pd.DataFrame(group_quantiles, index=group_index)
+
+
+def check_relative_accuracy(
+    relative_accuracy_=0.005, quantiles_=(0, 0.05, 0.5, 0.95, 1), n_groups_=50, seed_=0
+):
+    """
+    Compare the quantiles of sketches built from random travel times (chunked, merged
+    and pooled) with np.quantile on the same values. Raises an AssertionError if a
+    quantile is not within relative_accuracy_ of the exact value.
+    Returns
+    -------
+    max_relative_error: float
+    """
+    rng = np.random.default_rng(seed_)
+    n_values = rng.integers(1, 2000, n_groups_)
+    values = pd.DataFrame(
+        {
+            "run_no": np.repeat(np.arange(n_groups_) % 10, n_values),
+            "no": np.repeat(np.arange(n_groups_) // 10, n_values),
+            # Log-normal travel times with a long tail.
+            "trav": np.round(rng.lognormal(4, 0.7, n_values.sum()), 1),
+        }
+    )
+    # Some zeros, e.g. zero delays.
+    values.loc[::97, "trav"] = 0
+    sketch = GroupedQuantileSketch(["run_no", "no"], relative_accuracy_)
+    for chunk in np.array_split(values, 7):
+        # Chunks built separately and merged, like the .rsr chunks and runs.
+        sketch.merge(
+            GroupedQuantileSketch(["run_no", "no"], relative_accuracy_).add(
+                chunk, "trav"
+            )
+        )
+    max_relative_error = 0
+    for keys in (["run_no", "no"], ["no"]):
+        exact = values.groupby(keys).trav.quantile(list(quantiles_)).unstack()
+        approx = sketch.pool(keys).quantiles(quantiles_).reindex(exact.index)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            relative_error = np.nan_to_num(
+                np.abs(approx.values - exact.values) / exact.values
+            )
+        max_relative_error = max(max_relative_error, relative_error.max())
+    assert max_relative_error <= relative_accuracy_ * (1 + 1e-9), (
+        f"Quantile relative error {max_relative_error} > {relative_accuracy_}."
+    )
+    return max_relative_error
+
+
+if __name__ == "__main__":
+    for relative_accuracy in (0.001, 0.005, 0.01, 0.05):
+        print(
+            f"relative_accuracy {relative_accuracy}: max relative error "
+            f"{check_relative_accuracy(relative_accuracy):.5f}"
+        )
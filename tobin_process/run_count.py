@@ -0,0 +1,419 @@
+"""
+Module for estimating the number of vissim runs (random seeds) needed for the results
+averaged across runs. For each metric and group (e.g. travel time of a segment, class and
+time interval) the mean of n runs is within a tolerance E of the true mean with the given
+confidence when
+
+    n >= (t(1 - alpha / 2, n - 1) * s / E) ** 2
+
+with s the standard deviation across runs and t the quantile of the Student
+t-distribution (FHWA Traffic Analysis Toolbox Vol. III). The required n is re-estimated
+sequentially: the per-run results of each new seed update running moments
+(grouped_stats.GroupedMoments), and the groups that have not converged yet tell which
+metrics and segments still need more seeds. Simulating can stop once all the groups have
+converged. Each added run is fingerprinted, so re-simulated runs (e.g. after a model or
+mapper change) replace their old results instead of being skipped.
+"""
+import os
+import pickle
+import hashlib
+import warnings
+import numpy as np
+import pandas as pd
+from scipy import stats
+from tobin_process.grouped_stats import GroupedMoments
+
+# Keys and metrics of the per-run results of each evaluation.
+TT_RUN_KEYS = ["timeint", "direction", "tt_seg_name", "veh_cls_res"]
+TT_RUN_METRICS = ["avg_trav", "avg_veh_delay"]
+NODE_RUN_KEYS = ["timeint", "node_no", "direction_results"]
+NODE_RUN_METRICS = ["vehdelay_all"]
+LINK_SEG_RUN_KEYS = ["timeint", "direction", "linkevalsegment"]
+LINK_SEG_RUN_METRICS = ["speed_1020", "density_1020"]
+
+
+def get_n_required(
+    mean_, std_, tolerance_, confidence_=0.95, relative_=True, min_runs_=2, max_runs_=500
+):
+    """
+    Smallest n with n >= (t(1 - alpha / 2, n - 1) * std_ / E) ** 2, where E is
+    tolerance_ * |mean_| (relative_) or tolerance_. n / t(n - 1) ** 2 increases with n,
+    so n is found with a binary search over min_runs_ to max_runs_.
+    Parameters
+    ----------
+    mean_: np.ndarray
+        Mean across runs of each group.
+    std_: np.ndarray
+        Standard deviation (ddof=1) across runs of each group.
+    tolerance_: float or np.ndarray
+        Allowed error of the mean.
+    confidence_: float
+        Confidence level, e.g. 0.95.
+    relative_: bool
+        If True, tolerance_ is a fraction of the mean (0.1 for +/- 10%). Else it is in
+        the units of the metric.
+    min_runs_: int
+        Smallest number of runs returned (>= 2).
+    max_runs_: int
+        Groups that need more runs get np.inf.
+    Returns
+    -------
+    n_required: np.ndarray
+        Float array; NaN where std_ is NaN (fewer than 2 runs).
+    """
+    if not 0 < confidence_ < 1:
+        raise ValueError("confidence_ needs to be between 0 and 1.")
+    if min_runs_ < 2:
+        raise ValueError("min_runs_ needs to be at least 2.")
+    mean, std = np.asarray(mean_, dtype=np.float64), np.asarray(std_, dtype=np.float64)
+    tolerance = np.asarray(tolerance_, dtype=np.float64)
+    if relative_:
+        tolerance = tolerance * np.abs(mean)
+    n_candidates = np.arange(min_runs_, max_runs_ + 1)
+    t_quantiles = stats.t.ppf(1 - (1 - confidence_) / 2, n_candidates - 1)
+    ratio = n_candidates / t_quantiles ** 2
+    with np.errstate(invalid="ignore", divide="ignore"):
+        target = (std / tolerance) ** 2
+    # No spread: the minimum number of runs. Spread with zero tolerance (e.g. zero mean
+    # with a relative tolerance): never converges.
+    target = np.where(std == 0, 0, target)
+    pos = np.searchsorted(ratio, np.nan_to_num(target, nan=0.0), side="left")
+    n_required = np.where(
+        pos < len(n_candidates),
+        n_candidates[np.minimum(pos, len(n_candidates) - 1)],
+        np.inf,
+    ).astype(np.float64)
+    n_required[np.isnan(std)] = np.nan
+    return n_required
+
+
+class RunCountTracker:
+    """
+    Sequential estimate of the number of runs needed for each metric and group. Add the
+    per-run results of each new seed with update; get_required_runs re-estimates the
+    required runs from all the runs added so far.
+
+    ...
+    Attributes
+    ___________
+    keys: list
+        Group columns, e.g. TT_RUN_KEYS.
+    metrics: list
+        Metric columns, e.g. TT_RUN_METRICS.
+    run_col: str
+        Run column.
+    tolerance: dict
+        Tolerance of each metric.
+    confidence: float
+        Confidence level.
+    relative: bool
+        If True, the tolerances are fractions of the mean.
+    moments: tobin_process.grouped_stats.GroupedMoments
+        Running count, sum and variance of the metrics across the runs added so far.
+    runs: list
+        Runs added so far.
+    run_results: dict
+        Run --> keys and metrics of the run, as added. Used to rebuild moments when
+        the results of a run change.
+    run_hashes: dict
+        Run --> content hash of its results (see get_run_hash).
+    history: pd.DataFrame()
+        One row per update with the number of runs, groups not converged yet and the
+        largest required number of runs.
+    Methods
+    ________
+    get_settings(): Keys, metrics, tolerance, confidence and run limits.
+    get_run_hash(run_results_): Content hash of the results of a run.
+    update(df_): Add the per-run results of new runs. Runs already added with the same
+        results are skipped; runs with changed results replace the old ones.
+    get_required_runs(): Required runs for each group and metric.
+    get_unconverged(): Groups and metrics that need more runs.
+    get_runs_to_add(): Number of runs to add to the runs added so far.
+    save(path_): Pickle the tracker so that it can be updated after the next seed.
+    """
+
+    def __init__(
+        self,
+        keys_,
+        metrics_,
+        run_col_="run_no",
+        tolerance_=0.1,
+        confidence_=0.95,
+        relative_=True,
+        min_runs_=3,
+        max_runs_=500,
+    ):
+        """
+        Parameters
+        ----------
+        keys_: list
+            Group columns.
+        metrics_: list
+            Metric columns.
+        run_col_: str
+            Run column.
+        tolerance_: float or dict
+            Tolerance for all the metrics or {metric: tolerance}. With relative_, 0.1
+            for a mean within +/- 10%.
+        confidence_: float
+            Confidence level, e.g. 0.95.
+        relative_: bool
+            If True, the tolerances are fractions of the mean. Else, in the units of
+            the metrics (e.g. +/- 5 s of delay).
+        min_runs_: int
+            Minimum number of runs, even if the runs agree.
+        max_runs_: int
+            Groups that need more runs get np.inf required runs.
+        """
+        self.keys = list(keys_)
+        self.metrics = list(metrics_)
+        self.run_col = run_col_
+        if isinstance(tolerance_, dict):
+            missing_metrics = set(self.metrics) - set(tolerance_)
+            if missing_metrics:
+                raise ValueError(f"No tolerance for {sorted(missing_metrics)}.")
+            self.tolerance = {metric: tolerance_[metric] for metric in self.metrics}
+        else:
+            self.tolerance = {metric: tolerance_ for metric in self.metrics}
+        self.confidence = confidence_
+        self.relative = relative_
+        self.min_runs = min_runs_
+        self.max_runs = max_runs_
+        self.moments = GroupedMoments(self.keys, self.metrics)
+        self.runs = []
+        self.run_results = {}
+        self.run_hashes = {}
+        self.history = pd.DataFrame()
+
+    def get_settings(self):
+        """
+        Settings that the required runs depend on. A saved tracker is only reused with
+        the same settings (see load_run_count_tracker).
+        """
+        return {
+            "keys": self.keys,
+            "metrics": self.metrics,
+            "run_col": self.run_col,
+            "tolerance": self.tolerance,
+            "confidence": self.confidence,
+            "relative": self.relative,
+            "min_runs": self.min_runs,
+            "max_runs": self.max_runs,
+        }
+
+    def get_run_hash(self, run_results_):
+        """
+        Content hash of the keys and metrics of a run, independent of the row order.
+        """
+        run_results = run_results_.filter(items=self.keys + self.metrics)
+        row_hashes = np.sort(
+            pd.util.hash_pandas_object(run_results, index=False).values
+        )
+        return hashlib.blake2b(row_hashes.tobytes(), digest_size=16).hexdigest()
+
+    def update(self, df_):
+        """
+        Add the per-run results of new runs. Runs already added with the same results
+        are skipped, so the results of all the runs processed so far can be passed
+        after each new seed. A run already added with different results (e.g. re-
+        simulated after a model or mapper change) replaces the old results, with a
+        warning.
+        Parameters
+        ----------
+        df_: pd.DataFrame
+            One row per group and run with keys, run_col and metrics columns, e.g. from
+            get_tt_run_results.
+        """
+        changed_runs = []
+        # One run at a time so that the history has the sequential estimates.
+        for run in pd.unique(df_[self.run_col].dropna()):
+            run_results = df_.loc[lambda df: df[self.run_col] == run].filter(
+                items=self.keys + self.metrics
+            )
+            run_hash = self.get_run_hash(run_results)
+            if run in self.run_hashes:
+                if self.run_hashes[run] == run_hash:
+                    continue
+                changed_runs.append(run)
+                self.run_results[run] = run_results
+                self.run_hashes[run] = run_hash
+                self._rebuild_moments()
+            else:
+                self.moments.update(run_results)
+                self.runs.append(run)
+                self.run_results[run] = run_results
+                self.run_hashes[run] = run_hash
+            required_runs = self.get_required_runs()
+            self.history = pd.concat(
+                [
+                    self.history,
+                    pd.DataFrame(
+                        {
+                            "run": [run],
+                            "n_runs": [len(self.runs)],
+                            "n_groups": [len(required_runs)],
+                            "n_unconverged": [(~required_runs.converged).sum()],
+                            "max_n_required": [required_runs.n_required.max()],
+                        }
+                    ),
+                ],
+                ignore_index=True,
+            )
+        if changed_runs:
+            warnings.warn(
+                f"The results of runs {changed_runs} changed since they were added. "
+                "Their old results were replaced."
+            )
+        return self
+
+    def _rebuild_moments(self):
+        self.moments = GroupedMoments(self.keys, self.metrics)
+        for run in self.runs:
+            self.moments.update(self.run_results[run])
+
+    def get_required_runs(self):
+        """
+        Returns
+        -------
+        required_runs: pd.DataFrame
+            One row per group and metric, indexed by keys + ["metric"]. Columns:
+            n_runs, mean, std, half_width (half width of the confidence interval of the
+            mean with n_runs), n_required, n_more (runs to add) and converged.
+        """
+        group_stats = self.moments.get_stats()
+        if group_stats.empty:
+            return pd.DataFrame()
+        required_runs = []
+        for metric in self.metrics:
+            n_runs = group_stats[("count", metric)]
+            mean = group_stats[("mean", metric)]
+            std = np.sqrt(group_stats[("var", metric)])
+            n_required = get_n_required(
+                mean_=mean.values,
+                std_=std.values,
+                tolerance_=self.tolerance[metric],
+                confidence_=self.confidence,
+                relative_=self.relative,
+                min_runs_=self.min_runs,
+                max_runs_=self.max_runs,
+            )
+            with np.errstate(invalid="ignore", divide="ignore"):
+                t_quantile = stats.t.ppf(
+                    1 - (1 - self.confidence) / 2, n_runs.values - 1
+                )
+                half_width = t_quantile * std.values / np.sqrt(n_runs.values)
+            required_runs.append(
+                pd.DataFrame(
+                    {
+                        "metric": metric,
+                        "n_runs": n_runs.values,
+                        "mean": mean.values,
+                        "std": std.values,
+                        "half_width": half_width,
+                        "n_required": n_required,
+                    },
+                    index=group_stats.index,
+                )
+            )
+        return (
+            pd.concat(required_runs)
+            .set_index("metric", append=True)
+            .assign(
+                n_more=lambda df: np.maximum(df.n_required - df.n_runs, 0),
+                # Groups with fewer than 2 runs need more runs.
+                converged=lambda df: df.n_runs >= df.n_required.fillna(np.inf),
+            )
+        )
+
+    def get_unconverged(self):
+        """
+        Groups and metrics that need more runs, the ones needing the most first.
+        """
+        required_runs = self.get_required_runs()
+        if required_runs.empty:
+            return required_runs
+        return required_runs.loc[lambda df: ~df.converged].sort_values(
+            "n_required", ascending=False
+        )
+
+    def get_runs_to_add(self):
+        """
+        Number of runs to add so that all the groups converge (0 if they all have; np.inf
+        if a group needs more than max_runs). Groups with fewer than 2 runs count as
+        needing min_runs.
+        """
+        required_runs = self.get_required_runs()
+        if required_runs.empty:
+            return self.min_runs
+        return (
+            (required_runs.n_required.fillna(self.min_runs) - required_runs.n_runs)
+            .clip(lower=0)
+            .max()
+        )
+
+    def save(self, path_):
+        """
+        Pickle the tracker to path_. Load it with load_run_count_tracker.
+        """
+        with open(path_, "wb") as tracker_file:
+            pickle.dump(self, tracker_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_run_count_tracker(path_, **kwargs):
+    """
+    Load a tracker saved with RunCountTracker.save; create a new one with kwargs (see
+    RunCountTracker) if path_ does not exist, or if the saved tracker has other
+    settings (keys, metrics, tolerance, confidence, ...) than kwargs. The new tracker
+    starts without runs, so pass it the results of all the runs.
+    """
+    if not os.path.exists(path_):
+        return RunCountTracker(**kwargs)
+    with open(path_, "rb") as tracker_file:
+        run_count_tracker = pickle.load(tracker_file)
+    if not kwargs:
+        return run_count_tracker
+    new_tracker = RunCountTracker(**kwargs)
+    # Trackers saved before the runs were fingerprinted have no run_hashes.
+    if (not hasattr(run_count_tracker, "run_hashes")) or (
+        run_count_tracker.get_settings() != new_tracker.get_settings()
+    ):
+        warnings.warn(
+            f"The tracker saved in {path_} has other settings than the ones passed. "
+            "Starting a new tracker."
+        )
+        return new_tracker
+    return run_count_tracker
+
+
+def get_tt_run_results(tt_eval_):
+    """
+    Per-run travel time results of a tobin_process.travel_time_seg_helper.TtEval after
+    merge_mapper; keys TT_RUN_KEYS, run column run_no.
+    """
+    return tt_eval_.tt_vissim_raw_grp_runs.loc[lambda df: df.run_no.notna()].filter(
+        items=TT_RUN_KEYS + ["run_no"] + TT_RUN_METRICS
+    )
+
+
+def get_node_run_results(node_eval_, exclude_runs_=("AVG",)):
+    """
+    Per-run node results of a tobin_process.node_evaluation_helper.NodeEval after
+    set_report_data or set_report_data_rollup (with the individual runs in keep_runs_
+    of clean_node_eval); keys NODE_RUN_KEYS, run column movementevaluation_simrun.
+    """
+    return node_eval_.report_data.loc[
+        lambda df: ~df.movementevaluation_simrun.isin(exclude_runs_)
+    ]
+
+
+def get_link_seg_run_results(link_seg_eval_, exclude_runs_=("AVG",)):
+    """
+    Per-run link segment results of a tobin_process.link_seg_helper.LinkSegEval after
+    merge_link_mapper (with the individual runs in keep_runs_ of
+    clean_filter_link_eval); keys LINK_SEG_RUN_KEYS, run column
+    linkevalsegmentevaluation_simrun.
+    """
+    return link_seg_eval_.link_seg_vissim_fil_ord.loc[
+        lambda df: df.linkevalsegmentevaluation_simrun.notna()
+        & ~df.linkevalsegmentevaluation_simrun.isin(exclude_runs_)
+    ]
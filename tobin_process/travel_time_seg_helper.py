@@ -5,11 +5,997 @@ import pandas as pd
 import numpy as np
 import os
 import glob
+import mmap
+import warnings
 from tobin_process.utils import remove_special_char_vissim_col
 from tobin_process.utils import get_project_root
+from tobin_process.utils import print_memory_saved
+from tobin_process.utils import TimeIntervalSpec
+from tobin_process.grouped_stats import GroupedMoments
+from tobin_process.grouped_stats import GroupIndex
+from tobin_process.quantile_sketch import GroupedQuantileSketch
+from tobin_process.occupancy import get_threshold_occupancy_table
+from tobin_process.mapper_cache import default_mapper_cache
+from tobin_process.map_reduce import map_reduce
+from tobin_process.peak_window import find_peak_windows
+from tobin_process.traversal_store import bin_sorted_times
+from tobin_process.traversal_store import TraversalStore
 import seaborn as sns
 import matplotlib.pyplot as plt
-import re
+from functools import partial
+
+
+def get_file_no(path_vissim_raw_):
+    """
+    Get the vissim run number from the file name. E.g. 12 for
+    "Tobin Bridge Base Model_012.rsr".
+    """
+    file_nm = os.path.basename(path_vissim_raw_)
+    return int(file_nm.split(".")[0].split("_")[1])
+
+
+def index_paths_by_run(paths_vissim_raw_):
+    """
+    Get a run number --> file path dictionary for the .rsr or .mer files.
+    """
+    return {get_file_no(path): path for path in paths_vissim_raw_}
+
+
+def read_mer_file(path_data_col_vissim_raw_, use_data_col_no_, chunksize_=500000):
+    """
+    Read the data collection point raw data (.mer) file in a single pass. The header row
+    is found while reading the file; only the measurem, t_entry, veh_no, vehicle type and
+    pers columns are parsed and only rows for the use_data_col_no_ data collection
+    points are kept.
+    Parameters
+    ----------
+    path_data_col_vissim_raw_: str
+        Path to the .mer file.
+    use_data_col_no_: list
+        Data collection points to keep.
+    chunksize_: int
+        Number of rows parsed at a time.
+    Returns
+    -------
+    dat_col_persons: pd.DataFrame
+    """
+    keep_cols = ["measurem", "t_entry", "veh_no", "vehicle type", "pers"]
+    with open(path_data_col_vissim_raw_) as input_file:
+        # Lines before the header have fewer fields. Length > 5 implies we have
+        # reached the header row.
+        current_line = input_file.readline()
+        while current_line and (len(current_line.split(";")) <= 5):
+            current_line = input_file.readline()
+        col_nms = remove_special_char_vissim_col(current_line.rstrip("\n").split(";"))
+        # Continue reading from the row after the header with the same file handle.
+        dat_col_persons_chunks = pd.read_csv(
+            input_file,
+            sep=";",
+            header=None,
+            names=col_nms,
+            usecols=keep_cols,
+            chunksize=chunksize_,
+        )
+        dat_col_persons = pd.concat(
+            [
+                dat_col_persons_chunk.loc[
+                    lambda df: df.measurem.isin(use_data_col_no_)
+                ]
+                for dat_col_persons_chunk in dat_col_persons_chunks
+            ]
+        )
+    return dat_col_persons
+
+
+# Compact dtypes for the numeric .rsr columns decoded by read_rsr_numpy. Columns not
+# listed here are decoded as float64.
+RSR_DTYPES = {
+    "time": np.float64,
+    "no": np.int32,
+    "veh": np.int32,
+    "veh_type": np.int32,
+    "trav": np.float64,
+    "delay": np.float64,
+    "dist": np.float64,
+}
+
+
+def iter_rsr_numpy(path_tt_vissim_raw_, keep_tt_segs_, keep_cols_, block_size_mb_=64):
+    """
+    Decode a vissim travel time (.rsr) file block by block straight into NumPy column
+    arrays. The file is memory-mapped; rows for other travel time segments are dropped
+    from each block. All the fields in the .rsr records need to be numeric.
+    Parameters
+    ----------
+    path_tt_vissim_raw_: str
+        Full path to the .rsr file.
+    keep_tt_segs_: list
+        Travel time segments to keep.
+    keep_cols_: list
+        Columns to keep (names after remove_special_char_vissim_col).
+    block_size_mb_: float
+        Size of the blocks decoded at a time.
+    Yields
+    ------
+    tt_vissim_raw_block: dict
+        Column name --> NumPy array with RSR_DTYPES dtype for the rows kept from a block.
+    """
+    block_size = int(block_size_mb_ * 2 ** 20)
+    with open(path_tt_vissim_raw_, "rb") as input_file, mmap.mmap(
+        input_file.fileno(), 0, access=mmap.ACCESS_READ
+    ) as rsr_mmap:
+        # Skip the 8 comment lines (same as skiprows=8) and read the header row.
+        pos = 0
+        for _ in range(8):
+            pos = rsr_mmap.find(b"\n", pos) + 1
+        header_end = rsr_mmap.find(b"\n", pos)
+        col_nms = remove_special_char_vissim_col(
+            rsr_mmap[pos:header_end].decode().split(";")
+        )
+        # Trailing ";" gives an empty column name with no values.
+        col_nms = [colnm for colnm in col_nms if colnm != ""]
+        keep_cols = [colnm for colnm in col_nms if colnm in keep_cols_]
+        col_idx_no = col_nms.index("no")
+        pos = header_end + 1
+        while pos < len(rsr_mmap):
+            end = min(pos + block_size, len(rsr_mmap))
+            if end < len(rsr_mmap):
+                # Block ends at the end of a line.
+                line_end = rsr_mmap.rfind(b"\n", pos, end)
+                end = (
+                    line_end + 1
+                    if line_end != -1
+                    else rsr_mmap.find(b"\n", end) % len(rsr_mmap) + 1
+                )
+            block = rsr_mmap[pos:end].replace(b";", b" ")
+            pos = end
+            with warnings.catch_warnings():
+                # np.fromstring only warns when it hits a non numeric field.
+                warnings.simplefilter("error", DeprecationWarning)
+                try:
+                    values = np.fromstring(block, dtype=np.float64, sep=" ")
+                except DeprecationWarning:
+                    raise ValueError(
+                        f"Non numeric fields in {path_tt_vissim_raw_}. Use the pandas "
+                        f"engine."
+                    )
+            if values.size % len(col_nms) != 0:
+                raise ValueError(
+                    f"Missing fields in {path_tt_vissim_raw_}. Use the pandas engine."
+                )
+            values = values.reshape(-1, len(col_nms))
+            keep_rows = np.isin(values[:, col_idx_no], keep_tt_segs_)
+            yield {
+                colnm: values[keep_rows, col_nms.index(colnm)].astype(
+                    RSR_DTYPES.get(colnm, np.float64)
+                )
+                for colnm in keep_cols
+            }
+
+
+def read_rsr_numpy(path_tt_vissim_raw_, keep_tt_segs_, keep_cols_, block_size_mb_=64):
+    """
+    Decode a vissim travel time (.rsr) file straight into NumPy column arrays. See
+    iter_rsr_numpy. Peak memory is one block plus the rows kept. Works for multi-GB .rsr
+    files where pd.read_csv runs out of memory.
+    Returns
+    -------
+    tt_vissim_raw_cols: dict
+        Column name --> NumPy array with RSR_DTYPES dtype.
+    """
+    list_cols = {}
+    for tt_vissim_raw_block in iter_rsr_numpy(
+        path_tt_vissim_raw_, keep_tt_segs_, keep_cols_, block_size_mb_
+    ):
+        for colnm, values in tt_vissim_raw_block.items():
+            list_cols.setdefault(colnm, []).append(values)
+    if not list_cols:
+        # No records in the file.
+        list_cols = {colnm: [] for colnm in keep_cols_}
+    return {
+        colnm: np.concatenate(list_col)
+        if list_col
+        else np.array([], dtype=RSR_DTYPES.get(colnm, np.float64))
+        for colnm, list_col in list_cols.items()
+    }
+
+
+def compact_rsr_dtypes(tt_vissim_raw_):
+    """
+    Downcast the numeric columns of .rsr based data: integer columns (no, veh, veh_type,
+    run_no...) to the smallest integer type that holds their values and float columns to
+    float32. Vissim writes travel
+    times, distances and delays with 1-2 decimals, well within float32 precision. time
+    stays float64; headways are differences of times and float32 would round them at
+    the 3rd decimal for times above 8192 s.
+    """
+    return tt_vissim_raw_.apply(
+        lambda col: pd.to_numeric(
+            col, downcast="integer" if col.dtype.kind in "iu" else "float"
+        )
+        if (col.dtype.kind in "iuf") & (col.name != "time")
+        else col
+    )
+
+
+def read_rsr_file(
+    path_tt_vissim_raw_,
+    keep_tt_segs_,
+    keep_cols_,
+    chunksize_=None,
+    ingest_cache_=None,
+    engine_="pandas",
+):
+    """
+    Read a single vissim travel time (.rsr) file and keep only the keep_cols_ columns and
+    the keep_tt_segs_ travel time segments.
+    Parameters
+    ----------
+    path_tt_vissim_raw_: str
+        Full path to the .rsr file.
+    keep_tt_segs_: list
+        Travel time segments to keep.
+    keep_cols_: list
+        Columns to keep (names after remove_special_char_vissim_col).
+    chunksize_: int
+        If None, read the whole file and then filter rows and columns. Else stream the
+        file chunksize_ rows at a time; only keep_cols_ (and "no") are parsed and rows
+        for other travel time segments are dropped while reading. Peak memory then
+        depends on the rows kept and not on the size of the .rsr file.
+    ingest_cache_: tobin_process.ingest_cache.IngestCache
+        If given, load the filtered data from the cache when the .rsr file was already
+        parsed with the same keep_tt_segs_ and keep_cols_.
+    engine_: str
+        "pandas" to parse with pd.read_csv. "numpy" to decode the memory-mapped file
+        with read_rsr_numpy; use it for multi-GB .rsr files. chunksize_ is not used by
+        the numpy engine.
+    Returns
+    -------
+    tt_vissim_raw: pd.DataFrame
+        Filtered .rsr data.
+    """
+    if ingest_cache_ is not None:
+        return ingest_cache_.load_or_parse(
+            path_raw_=path_tt_vissim_raw_,
+            parse_func_=lambda: read_rsr_file(
+                path_tt_vissim_raw_,
+                keep_tt_segs_,
+                keep_cols_,
+                chunksize_,
+                engine_=engine_,
+            ),
+            variant_=f"rsr|{engine_}|{sorted(keep_tt_segs_)}|{list(keep_cols_)}",
+        )
+    if engine_ == "numpy":
+        return pd.DataFrame(
+            read_rsr_numpy(path_tt_vissim_raw_, keep_tt_segs_, keep_cols_)
+        )
+    elif engine_ != "pandas":
+        raise ValueError(f"Unknown .rsr engine {engine_}. Use 'pandas' or 'numpy'.")
+    if chunksize_ is None:
+        tt_vissim_raw = pd.read_csv(path_tt_vissim_raw_, sep=";", skiprows=8)
+        tt_vissim_raw.columns = remove_special_char_vissim_col(tt_vissim_raw.columns)
+        return tt_vissim_raw.loc[lambda df: df.no.isin(keep_tt_segs_)].filter(
+            items=keep_cols_
+        )
+    return pd.concat(
+        iter_rsr_chunks(path_tt_vissim_raw_, keep_tt_segs_, keep_cols_, chunksize_)
+    )
+
+
+def iter_rsr_chunks(
+    path_tt_vissim_raw_, keep_tt_segs_, keep_cols_, chunksize_, engine_="pandas"
+):
+    """
+    Stream a vissim travel time (.rsr) file. Only keep_cols_ (and "no") are parsed and
+    rows for other travel time segments are dropped from each chunk.
+    Parameters
+    ----------
+    path_tt_vissim_raw_: str
+        Full path to the .rsr file.
+    keep_tt_segs_: list
+        Travel time segments to keep.
+    keep_cols_: list
+        Columns to keep (names after remove_special_char_vissim_col).
+    chunksize_: int
+        Number of .rsr rows read at a time by the pandas engine. The numpy engine reads
+        blocks of 64 MB.
+    engine_: str
+        "pandas" or "numpy". See read_rsr_file.
+    Yields
+    ------
+    tt_vissim_raw_chunk: pd.DataFrame
+        Filtered .rsr data for a chunk of the file.
+    """
+    if engine_ == "numpy":
+        for tt_vissim_raw_block in iter_rsr_numpy(
+            path_tt_vissim_raw_, keep_tt_segs_, keep_cols_
+        ):
+            yield pd.DataFrame(tt_vissim_raw_block)
+        return
+    elif engine_ != "pandas":
+        raise ValueError(f"Unknown .rsr engine {engine_}. Use 'pandas' or 'numpy'.")
+    # Need "no" for filtering the travel time segments even if it is not in keep_cols_.
+    parse_cols = set(keep_cols_) | {"no"}
+    tt_vissim_raw_chunks = pd.read_csv(
+        path_tt_vissim_raw_,
+        sep=";",
+        skiprows=8,
+        usecols=lambda colnm: remove_special_char_vissim_col([colnm])[0] in parse_cols,
+        chunksize=chunksize_,
+    )
+    for tt_vissim_raw_chunk in tt_vissim_raw_chunks:
+        tt_vissim_raw_chunk.columns = remove_special_char_vissim_col(
+            tt_vissim_raw_chunk.columns
+        )
+        yield tt_vissim_raw_chunk.loc[lambda df: df.no.isin(keep_tt_segs_)].filter(
+            items=keep_cols_
+        )
+
+
+def get_class_membership(veh_types_res_cls_):
+    """
+    Vehicle type x report class membership matrix. Report classes can overlap (e.g.
+    "car_hgv_bus", "car_hgv" and "bus"); with the matrix each traversal is kept once and
+    the statistics of a class are computed over the traversals of its vehicle types,
+    instead of duplicating the traversals once per class.
+    Parameters
+    ----------
+    veh_types_res_cls_: dict
+        Report vehicle class --> vissim vehicle types.
+    Returns
+    -------
+    class_membership: pd.DataFrame
+        Boolean; index veh_type (sorted), one column per report class in
+        veh_types_res_cls_ order.
+    """
+    veh_types = pd.Index(
+        sorted(
+            {
+                veh_type
+                for veh_types_cls in veh_types_res_cls_.values()
+                for veh_type in veh_types_cls
+            }
+        ),
+        name="veh_type",
+    )
+    return pd.DataFrame(
+        {
+            veh_cls_res: veh_types.isin(veh_types_cls)
+            for veh_cls_res, veh_types_cls in veh_types_res_cls_.items()
+        },
+        index=veh_types,
+    )
+
+
+def get_class_pairs(class_membership_):
+    """
+    (veh_type, veh_cls_res) pairs of the class membership matrix. Used to regroup
+    vehicle type aggregates into report classes; the aggregates are small, so
+    duplicating them per class is cheap.
+    """
+    type_pos, cls_pos = np.nonzero(class_membership_.values)
+    return pd.DataFrame(
+        {
+            "veh_type": class_membership_.index.values[type_pos],
+            "veh_cls_res": class_membership_.columns.values[cls_pos],
+        }
+    )
+
+
+def iter_class_masks(veh_type_, class_membership_):
+    """
+    Boolean mask of the rows of each report class, one class at a time.
+    Parameters
+    ----------
+    veh_type_: np.ndarray
+        Vehicle type of each row.
+    class_membership_: pd.DataFrame
+        See get_class_membership.
+    Yields
+    ------
+    veh_cls_res: str
+    cls_mask: np.ndarray
+        True for the rows with a vehicle type of the class.
+    """
+    type_pos = class_membership_.index.get_indexer(veh_type_)
+    known_type = type_pos >= 0
+    membership = class_membership_.values
+    for cls_pos, veh_cls_res in enumerate(class_membership_.columns):
+        yield veh_cls_res, known_type & membership[type_pos, cls_pos]
+
+
+def get_rsr_grp_runs(grp_stats_, q95_trav_, timeint_spec_, person_delay_=False):
+    """
+    Travel time aggregates of a run from grouped_stats.GroupedMoments statistics for
+    each (run_no, timeint, no, veh_cls_res) group. Same groups and columns as the
+    groupby of process_rsr_run: all the time intervals for each run, segment and class
+    with traversals.
+    Parameters
+    ----------
+    grp_stats_: pd.DataFrame
+        GroupedMoments.get_stats of veh_delay, trav, dist_ft (and pers, pers_delay).
+    q95_trav_: pd.Series
+        95th percentile travel time of each group.
+    timeint_spec_: tobin_process.utils.TimeIntervalSpec
+        Time intervals and labels.
+    person_delay_: bool
+        If True, add tot_pers, tot_pers_delay and avg_pers_delay.
+    Returns
+    -------
+    tt_vissim_raw_grp_runs: pd.DataFrame
+    """
+    group_keys = ["run_no", "timeint", "no", "veh_cls_res"]
+    grp_index = pd.MultiIndex.from_product(
+        [
+            np.unique(grp_stats_.index.get_level_values(colnm))
+            if not grp_stats_.empty
+            else []
+            for colnm in group_keys
+        ],
+        names=group_keys,
+    )
+    grp_index = grp_index.set_levels(
+        pd.CategoricalIndex(
+            timeint_spec_.labels, dtype=timeint_spec_.label_dtype, name="timeint"
+        ),
+        level="timeint",
+    )
+    grp_stats = grp_stats_.reindex(grp_index)
+    tt_vissim_raw_grp_runs = pd.DataFrame(
+        {
+            "avg_veh_delay": grp_stats["mean", "veh_delay"],
+            "avg_trav": grp_stats["mean", "trav"],
+            "q95_trav": q95_trav_.reindex(grp_index),
+            "avg_dist_ft": grp_stats["mean", "dist_ft"],
+            "tot_veh": grp_stats["count", "trav"].fillna(0).astype(np.int64),
+        },
+        index=grp_index,
+    )
+    if person_delay_:
+        tt_vissim_raw_grp_runs = tt_vissim_raw_grp_runs.assign(
+            tot_pers=grp_stats["sum", "pers"].fillna(0),
+            tot_pers_delay=grp_stats["sum", "pers_delay"].fillna(0),
+            avg_pers_delay=lambda df: df.tot_pers_delay / df.tot_pers,
+        )
+    return tt_vissim_raw_grp_runs
+
+
+def aggregate_rsr_classes(
+    tt_vissim_raw_,
+    class_membership_,
+    timeint_spec_,
+    relative_accuracy_=0.005,
+    person_delay_=False,
+    pooled_quantiles_=False,
+):
+    """
+    tt_vissim_raw_grp_runs and trav_sketch of a run from traversals without report
+    classes (one row per traversal). Counts, means and the travel time sketch are
+    computed once per vehicle type and regrouped into report classes with the class
+    membership matrix; the 95th percentile travel time of each class uses a mask of the
+    traversals of the class. Time and memory do not grow with the number of
+    overlapping classes.
+    Parameters
+    ----------
+    tt_vissim_raw_: pd.DataFrame
+        Traversals from prepare_rsr_traversals without veh_types_res_cls_df_ (and with
+        person delay if person_delay_).
+    class_membership_: pd.DataFrame
+        See get_class_membership.
+    timeint_spec_: tobin_process.utils.TimeIntervalSpec
+        Time intervals and labels.
+    relative_accuracy_: float
+        Relative accuracy of trav_sketch.
+    person_delay_: bool
+        If True, also aggregate pers and pers_delay.
+    pooled_quantiles_: bool
+        If False, the travel time sketch is not built and trav_sketch is None.
+    Returns
+    -------
+    tt_vissim_raw_grp_runs: pd.DataFrame
+        Same as the tt_vissim_raw_grp_runs of process_rsr_run.
+    trav_sketch: tobin_process.quantile_sketch.GroupedQuantileSketch
+        Travel time quantile sketch for each (run, timeint, segment, class) group, or
+        None.
+    """
+    type_keys = ["run_no", "timeint", "no", "veh_type"]
+    value_cols = ["veh_delay", "trav", "dist_ft"]
+    if person_delay_:
+        value_cols += ["pers", "pers_delay"]
+    class_pairs = get_class_pairs(class_membership_)
+    # Factorized once per vehicle type group; the class quantiles use the coarser
+    # groups without veh_type.
+    type_index = GroupIndex(tt_vissim_raw_, type_keys)
+    grp_stats = (
+        GroupedMoments(type_keys, value_cols)
+        .update(tt_vissim_raw_, type_index)
+        .regroup("veh_type", class_pairs)
+        .get_stats()
+    )
+    base_keys = ["run_no", "timeint", "no"]
+    base_index = type_index.coarsen(base_keys)
+    base_keys_index = base_index.get_object_index()
+    list_q95_trav = []
+    for veh_cls_res, cls_mask in iter_class_masks(
+        tt_vissim_raw_.veh_type.values, class_membership_
+    ):
+        if not cls_mask.any():
+            continue
+        has_cls = np.bincount(
+            base_index.codes[cls_mask & (base_index.codes >= 0)],
+            minlength=base_index.n_groups,
+        ) > 0
+        q95_trav_cls = pd.Series(
+            base_index.quantiles(tt_vissim_raw_.trav.values, [0.95], cls_mask)[
+                has_cls, 0
+            ],
+            index=base_keys_index[has_cls],
+        )
+        list_q95_trav.append(
+            pd.concat({veh_cls_res: q95_trav_cls}, names=["veh_cls_res"])
+        )
+    q95_trav = (
+        pd.concat(list_q95_trav).reorder_levels(base_keys + ["veh_cls_res"])
+        if list_q95_trav
+        else pd.Series(dtype=np.float64)
+    )
+    trav_sketch = None
+    if pooled_quantiles_:
+        trav_sketch = (
+            GroupedQuantileSketch(type_keys, relative_accuracy_)
+            .add(tt_vissim_raw_, "trav", type_index)
+            .regroup("veh_type", class_pairs)
+        )
+    tt_vissim_raw_grp_runs = get_rsr_grp_runs(
+        grp_stats, q95_trav, timeint_spec_, person_delay_
+    )
+    return tt_vissim_raw_grp_runs, trav_sketch
+
+
+def aggregate_rsr_run(
+    tt_vissim_raw_,
+    timeint_spec_,
+    relative_accuracy_=0.005,
+    class_membership_=None,
+    person_delay_=False,
+    pooled_quantiles_=False,
+):
+    """
+    tt_vissim_raw_grp_runs and trav_sketch of a run from its binned traversals (see
+    prepare_rsr_traversals).
+    Parameters
+    ----------
+    tt_vissim_raw_: pd.DataFrame
+        Traversals of a run with timeint, veh_delay, trav and dist_ft (and pers,
+        pers_delay).
+    timeint_spec_: tobin_process.utils.TimeIntervalSpec
+        Time intervals and labels of timeint.
+    relative_accuracy_: float
+        Relative accuracy of trav_sketch. See quantile_sketch.GroupedQuantileSketch.
+    class_membership_: pd.DataFrame
+        If given, tt_vissim_raw_ has one row per traversal (no veh_cls_res) and the
+        classes are aggregated with aggregate_rsr_classes.
+    person_delay_: bool
+        If True, add tot_pers, tot_pers_delay and avg_pers_delay.
+    pooled_quantiles_: bool
+        If True, also build the travel time sketch used to pool the quantiles across
+        runs. If False, trav_sketch is None.
+    Returns
+    -------
+    tt_vissim_raw_grp_runs: pd.DataFrame
+        Travel time aggregates for the run.
+    trav_sketch: tobin_process.quantile_sketch.GroupedQuantileSketch
+        Travel time quantile sketch for each (run, timeint, segment, class) group, or
+        None.
+    """
+    if class_membership_ is not None:
+        return aggregate_rsr_classes(
+            tt_vissim_raw_,
+            class_membership_,
+            timeint_spec_,
+            relative_accuracy_,
+            person_delay_,
+            pooled_quantiles_,
+        )
+    # The group keys are factorized once; the means, counts, person delay sums, q95
+    # and the sketch all reuse the group codes.
+    group_keys = ["run_no", "timeint", "no", "veh_cls_res"]
+    grp_index = GroupIndex(tt_vissim_raw_, group_keys)
+    value_cols = ["veh_delay", "trav", "dist_ft"]
+    if person_delay_:
+        value_cols += ["pers", "pers_delay"]
+    grp_stats = (
+        GroupedMoments(group_keys, value_cols)
+        .update(tt_vissim_raw_, grp_index)
+        .get_stats()
+    )
+    q95_trav = pd.Series(
+        grp_index.quantiles(tt_vissim_raw_.trav.values, [0.95])[:, 0],
+        index=grp_index.get_object_index(),
+    )
+    # Kept so that percentiles can be pooled across runs without tt_vissim_raw.
+    trav_sketch = None
+    if pooled_quantiles_:
+        trav_sketch = GroupedQuantileSketch(group_keys, relative_accuracy_).add(
+            tt_vissim_raw_, "trav", grp_index
+        )
+    tt_vissim_raw_grp_runs = get_rsr_grp_runs(
+        grp_stats, q95_trav, timeint_spec_, person_delay_
+    )
+    return tt_vissim_raw_grp_runs, trav_sketch
+
+
+def read_run_occupancy(
+    occupancy_table_, paths_data_col_vissim_raw_, file_no_, ingest_cache_=None
+):
+    """
+    Measured occupancy of the vehicles of a run from its data collection (.mer) file.
+    Parameters
+    ----------
+    occupancy_table_: tobin_process.occupancy.OccupancyTable
+        Occupancy source of each vehicle type.
+    paths_data_col_vissim_raw_: list or dict
+        Paths to the .mer files or a run no --> path dict from index_paths_by_run.
+    file_no_: int
+        Vissim run number.
+    ingest_cache_: tobin_process.ingest_cache.IngestCache
+        If given, load the parsed .mer file from the cache.
+    Returns
+    -------
+    pers_by_veh: np.ndarray
+        See OccupancyTable.get_measured_pers. None if no vehicle type is measured.
+    """
+    if not occupancy_table_.measured.any():
+        return None
+    if paths_data_col_vissim_raw_ is None:
+        raise ValueError("Add paths_data_col_vissim_raw_ for the measured occupancies.")
+    if not isinstance(paths_data_col_vissim_raw_, dict):
+        paths_data_col_vissim_raw_ = index_paths_by_run(paths_data_col_vissim_raw_)
+    if file_no_ not in paths_data_col_vissim_raw_:
+        raise ValueError(f"No data collection (.mer) file found for run {file_no_}.")
+    path = paths_data_col_vissim_raw_[file_no_]
+    use_data_col_no = occupancy_table_.use_data_col_no
+    if ingest_cache_ is not None:
+        dat_col_persons = ingest_cache_.load_or_parse(
+            path_raw_=path,
+            parse_func_=lambda: read_mer_file(path, use_data_col_no),
+            variant_=f"mer|{use_data_col_no}",
+        )
+    else:
+        dat_col_persons = read_mer_file(path, use_data_col_no)
+    return occupancy_table_.get_measured_pers(dat_col_persons)
+
+
+def lookup_mapper_rows(seg_no_, mapper_seg_no_):
+    """
+    Row of the mapper of each travel time segment number, through a dense array indexed
+    by segment number (segment numbers are small non-negative integers).
+    Parameters
+    ----------
+    seg_no_: np.ndarray
+        Travel time segment number of each row.
+    mapper_seg_no_: np.ndarray
+        Travel time segment number of each mapper row.
+    Returns
+    -------
+    mapper_rows: np.ndarray
+        Mapper row of each segment number; -1 for segments not in the mapper.
+    """
+    seg_no = np.asarray(seg_no_)
+    mapper_seg_no = np.asarray(mapper_seg_no_, dtype=np.int64)
+    lookup_size = int(mapper_seg_no.max()) + 1 if len(mapper_seg_no) else 0
+    lookup = np.full(lookup_size, -1, dtype=np.int64)
+    lookup[mapper_seg_no] = np.arange(len(mapper_seg_no))
+    in_lookup = (seg_no >= 0) & (seg_no < lookup_size)
+    mapper_rows = np.full(len(seg_no), -1, dtype=np.int64)
+    mapper_rows[in_lookup] = lookup[seg_no[in_lookup].astype(np.int64)]
+    return mapper_rows
+
+
+def warn_missing_mapper_segs(seg_no_, mapper_seg_no_):
+    """
+    Warn about the mapper travel time segments without traversals. They are dropped
+    from tt_vissim_raw by the lookup engine and the compact merge of
+    TtEval.merge_mapper.
+    """
+    missing_segs = np.setdiff1d(mapper_seg_no_, np.unique(seg_no_))
+    if len(missing_segs):
+        warnings.warn(
+            f"No traversals for the mapper travel time segments {list(missing_segs)}."
+        )
+
+
+def prepare_rsr_traversals(
+    tt_vissim_raw_, file_no_, timeint_spec_, veh_types_res_cls_df_, compact_=False
+):
+    """
+    Add the time interval, report vehicle class, run number, vehicle delay, vehicle
+    count and distance in ft to the .rsr data of a run (or a chunk of it).
+    Parameters
+    ----------
+    tt_vissim_raw_: pd.DataFrame
+        Filtered .rsr data.
+    file_no_: int
+        Vissim run number.
+    timeint_spec_: tobin_process.utils.TimeIntervalSpec
+        Time intervals and labels used for binning the .rsr time.
+    veh_types_res_cls_df_: pd.DataFrame
+        Long dataframe with report vehicle class and vissim vehicle type. None keeps
+        one row per traversal without veh_cls_res (see aggregate_rsr_classes).
+    compact_: bool
+        If True, use compact dtypes. See TtEval.read_rsr_tt.
+    """
+    if compact_:
+        tt_vissim_raw_ = compact_rsr_dtypes(tt_vissim_raw_)
+    tt_vissim_raw = tt_vissim_raw_.assign(
+        timeint=lambda df: timeint_spec_.bin_times(df.time.values),
+        veh_delay=lambda df: df.delay,
+        veh_count=np.int8(1) if compact_ else 1,
+        dist_ft=lambda df: df.dist * df.dist.dtype.type(3.28084),
+    ).drop(columns=["dist"])
+    if veh_types_res_cls_df_ is not None:
+        tt_vissim_raw = tt_vissim_raw.merge(
+            veh_types_res_cls_df_, on="veh_type", how="left"
+        )
+    if compact_:
+        tt_vissim_raw["run_no"] = np.full(len(tt_vissim_raw), file_no_, dtype=np.int16)
+    else:
+        tt_vissim_raw.loc[:, "run_no"] = file_no_
+    return tt_vissim_raw
+
+
+def process_rsr_run(
+    path_tt_vissim_raw_,
+    keep_tt_segs_,
+    keep_cols_,
+    timeint_spec_,
+    veh_types_res_cls_df_,
+    chunksize_=None,
+    ingest_cache_=None,
+    rsr_engine_="pandas",
+    compact_=False,
+    relative_accuracy_=0.005,
+    class_membership_=None,
+    occupancy_table_=None,
+    pooled_quantiles_=False,
+    **kwargs
+):
+    """
+    Read, bin and aggregate the .rsr file (and the matching .mer file for person delay)
+    of a single vissim run. Kept at module level so that TtEval.read_rsr_tt can send it
+    to worker processes.
+    Parameters
+    ----------
+    path_tt_vissim_raw_: str
+        Full path to the .rsr file.
+    keep_tt_segs_: list
+        Travel time segments to keep.
+    keep_cols_: list
+        Columns to keep.
+    timeint_spec_: tobin_process.utils.TimeIntervalSpec
+        Time intervals and labels used for binning the .rsr time.
+    veh_types_res_cls_df_: pd.DataFrame
+        Long dataframe with report vehicle class and vissim vehicle type.
+    chunksize_: int
+        See read_rsr_file.
+    ingest_cache_: tobin_process.ingest_cache.IngestCache
+        See read_rsr_file.
+    rsr_engine_: str
+        See engine_ in read_rsr_file.
+    compact_: bool
+        If True, use compact dtypes. See TtEval.read_rsr_tt.
+    relative_accuracy_: float
+        Relative accuracy of trav_sketch. See quantile_sketch.GroupedQuantileSketch.
+    class_membership_: pd.DataFrame
+        If given, veh_types_res_cls_df_ is not used: tt_vissim_raw keeps one row per
+        traversal (no veh_cls_res) and the classes are aggregated with
+        aggregate_rsr_classes. See get_class_membership.
+    occupancy_table_: tobin_process.occupancy.OccupancyTable
+        If given, add pers and pers_delay to the traversals and tot_pers,
+        tot_pers_delay and avg_pers_delay to the aggregates.
+    pooled_quantiles_: bool
+        See aggregate_rsr_run.
+    kwargs:
+        paths_data_col_vissim_raw_: .mer files for the measured occupancies of
+        occupancy_table_. See TtEval.read_rsr_tt.
+    Returns
+    -------
+    tt_vissim_raw: pd.DataFrame
+        Raw travel time data for the run.
+    tt_vissim_raw_grp_runs: pd.DataFrame
+        Travel time aggregates for the run.
+    trav_sketch: tobin_process.quantile_sketch.GroupedQuantileSketch
+        Travel time quantile sketch for each (run, timeint, segment, class) group, or
+        None without pooled_quantiles_.
+    """
+    tt_vissim_raw = read_rsr_file(
+        path_tt_vissim_raw_=path_tt_vissim_raw_,
+        keep_tt_segs_=keep_tt_segs_,
+        keep_cols_=keep_cols_,
+        chunksize_=chunksize_,
+        ingest_cache_=ingest_cache_,
+        engine_=rsr_engine_,
+    )
+    file_no = get_file_no(path_tt_vissim_raw_)
+    tt_vissim_raw = prepare_rsr_traversals(
+        tt_vissim_raw,
+        file_no,
+        timeint_spec_,
+        None if class_membership_ is not None else veh_types_res_cls_df_,
+        compact_,
+    )
+    if occupancy_table_ is not None:
+        tt_vissim_raw = occupancy_table_.add_person_delay(
+            tt_vissim_raw,
+            read_run_occupancy(
+                occupancy_table_,
+                kwargs.get("paths_data_col_vissim_raw_"),
+                file_no,
+                ingest_cache_,
+            ),
+        )
+    tt_vissim_raw_grp_runs, trav_sketch = aggregate_rsr_run(
+        tt_vissim_raw,
+        timeint_spec_,
+        relative_accuracy_,
+        class_membership_,
+        occupancy_table_ is not None,
+        pooled_quantiles_,
+    )
+    if compact_:
+        tt_vissim_raw_grp_runs = compact_rsr_dtypes(tt_vissim_raw_grp_runs)
+    return tt_vissim_raw, tt_vissim_raw_grp_runs, trav_sketch
+
+
+def rebin_rsr_run(
+    run_traversals_,
+    timeint_specs_,
+    relative_accuracy_=0.005,
+    class_membership_=None,
+    person_delay_=False,
+    compact_=False,
+    pooled_quantiles_=False,
+):
+    """
+    tt_vissim_raw_grp_runs and trav_sketch of a run for each time interval scheme of
+    timeint_specs_, from the traversals of the run sorted by time (see
+    traversal_store.TraversalStore.get_partitions). Kept at module level so that
+    TtEval.get_rebinned_rsr_tt can send it to worker processes.
+    Parameters
+    ----------
+    run_traversals_: pd.DataFrame
+        Traversals of a run sorted by time, without timeint.
+    timeint_specs_: dict
+        Name --> tobin_process.utils.TimeIntervalSpec.
+    relative_accuracy_, class_membership_, person_delay_, pooled_quantiles_:
+        See aggregate_rsr_run.
+    compact_: bool
+        If True, use compact dtypes for tt_vissim_raw_grp_runs.
+    Returns
+    -------
+    rebinned: dict
+        Name --> (tt_vissim_raw_grp_runs, trav_sketch) of the run.
+    """
+    rebinned = {}
+    for name, timeint_spec in timeint_specs_.items():
+        tt_vissim_raw_grp_runs, trav_sketch = aggregate_rsr_run(
+            run_traversals_.assign(
+                timeint=pd.Categorical.from_codes(
+                    bin_sorted_times(run_traversals_.time.values, timeint_spec),
+                    dtype=timeint_spec.label_dtype,
+                )
+            ),
+            timeint_spec,
+            relative_accuracy_,
+            class_membership_,
+            person_delay_,
+            pooled_quantiles_,
+        )
+        if compact_:
+            tt_vissim_raw_grp_runs = compact_rsr_dtypes(tt_vissim_raw_grp_runs)
+        rebinned[name] = (tt_vissim_raw_grp_runs, trav_sketch)
+    return rebinned
+
+
+def summarise_rsr_run(
+    path_tt_vissim_raw_,
+    keep_tt_segs_,
+    keep_cols_,
+    timeint_spec_,
+    veh_types_res_cls_df_,
+    chunksize_=None,
+    ingest_cache_=None,
+    rsr_engine_="pandas",
+    compact_=False,
+    relative_accuracy_=0.005,
+    class_membership_=None,
+    occupancy_table_=None,
+    pooled_quantiles_=True,
+    **kwargs
+):
+    """
+    Summary-only version of process_rsr_run. The .rsr file is streamed chunk by chunk
+    into running accumulators for each (run, timeint, segment, class) group: counts
+    and Welford means/ variances (grouped_stats.GroupedMoments), and a quantile sketch
+    of the travel time (quantile_sketch.GroupedQuantileSketch). The traversals of a
+    chunk are dropped once they are added, so the memory used depends on the chunk size
+    and the number of groups, not on the number of vehicles simulated.
+    Parameters
+    ----------
+    path_tt_vissim_raw_, keep_tt_segs_, keep_cols_, timeint_spec_,
+    veh_types_res_cls_df_, rsr_engine_, compact_, class_membership_,
+    occupancy_table_, kwargs:
+        See process_rsr_run. With class_membership_, the accumulators are kept per
+        vehicle type and regrouped into report classes at the end.
+    chunksize_: int
+        Number of .rsr rows read at a time by the pandas engine. Defaults to 500000.
+    ingest_cache_: tobin_process.ingest_cache.IngestCache
+        Only used for the .mer file; the filtered .rsr data is not cached as it is
+        never materialized.
+    relative_accuracy_: float
+        Relative accuracy of q95_trav. See quantile_sketch.GroupedQuantileSketch.
+    pooled_quantiles_: bool
+        Not used: q95_trav is read from the sketch, so it is always built.
+    Returns
+    -------
+    tt_vissim_raw: pd.DataFrame
+        Empty dataframe.
+    tt_vissim_raw_grp_runs: pd.DataFrame
+        Travel time aggregates for the run. Same groups and columns as process_rsr_run;
+        q95_trav is within relative_accuracy_ of the exact value.
+    trav_sketch: tobin_process.quantile_sketch.GroupedQuantileSketch
+        Travel time quantile sketch for each (run, timeint, segment, class) group.
+    """
+    if chunksize_ is None:
+        chunksize_ = 500000
+    file_no = get_file_no(path_tt_vissim_raw_)
+    group_keys = ["run_no", "timeint", "no", "veh_cls_res"]
+    if class_membership_ is not None:
+        group_keys = ["run_no", "timeint", "no", "veh_type"]
+        veh_types_res_cls_df_ = None
+    value_cols = ["veh_delay", "trav", "dist_ft"]
+    if occupancy_table_ is not None:
+        pers_by_veh = read_run_occupancy(
+            occupancy_table_,
+            kwargs.get("paths_data_col_vissim_raw_"),
+            file_no,
+            ingest_cache_,
+        )
+        value_cols += ["pers", "pers_delay"]
+    grp_moments = GroupedMoments(group_keys, value_cols)
+    trav_sketch = GroupedQuantileSketch(group_keys, relative_accuracy_)
+    for tt_vissim_raw_chunk in iter_rsr_chunks(
+        path_tt_vissim_raw_, keep_tt_segs_, keep_cols_, chunksize_, rsr_engine_
+    ):
+        tt_vissim_raw_chunk = prepare_rsr_traversals(
+            tt_vissim_raw_chunk,
+            file_no,
+            timeint_spec_,
+            veh_types_res_cls_df_,
+            compact_,
+        )
+        if occupancy_table_ is not None:
+            tt_vissim_raw_chunk = occupancy_table_.add_person_delay(
+                tt_vissim_raw_chunk, pers_by_veh
+            )
+        # One factorization of the group keys per chunk for both accumulators.
+        chunk_index = GroupIndex(tt_vissim_raw_chunk, group_keys)
+        grp_moments.update(tt_vissim_raw_chunk, chunk_index)
+        trav_sketch.add(tt_vissim_raw_chunk, "trav", chunk_index)
+    if class_membership_ is not None:
+        class_pairs = get_class_pairs(class_membership_)
+        grp_moments = grp_moments.regroup("veh_type", class_pairs)
+        trav_sketch = trav_sketch.regroup("veh_type", class_pairs)
+    tt_vissim_raw_grp_runs = get_rsr_grp_runs(
+        grp_moments.get_stats(),
+        trav_sketch.quantiles([0.95])[0.95],
+        timeint_spec_,
+        occupancy_table_ is not None,
+    )
+    if compact_:
+        tt_vissim_raw_grp_runs = compact_rsr_dtypes(tt_vissim_raw_grp_runs)
+    return pd.DataFrame(), tt_vissim_raw_grp_runs, trav_sketch
 
 
 class TtEval:
@@ -36,6 +1022,18 @@ class TtEval:
         302, 303, 304, and 305 are all buses.
     veh_types_res_cls_df: pd.DataFrame()
         veh_types_res_cls turned into a dataframe.
+    class_membership: pd.DataFrame()
+        Vehicle type x report class boolean matrix from veh_types_res_cls. See
+        get_class_membership.
+    class_masks: bool
+        If True, tt_vissim_raw has one row per traversal (no veh_cls_res) and the
+        report classes are aggregated with class_membership. Set by read_rsr_tt.
+    occupancy_table: tobin_process.occupancy.OccupancyTable
+        Occupancy source of each vehicle type used for person delay; None without
+        person delay. Set by read_rsr_tt.
+    compact: bool
+        If True, tt_vissim_raw and tt_vissim_raw_grp_runs use compact dtypes. Set by
+        read_rsr_tt.
     tt_mapper: pd.DataFrame()
         Mapper file with mapping between vissim travel time segment number and the
         travel time segment name and direction.
@@ -43,6 +1041,17 @@ class TtEval:
         Dataframe with raw .rsr data for all runs.
     tt_vissim_raw_grp_runs: pd.DataFrame()
         Dataframe with aggregate data by run.
+    trav_sketch: tobin_process.quantile_sketch.GroupedQuantileSketch
+        Mergeable travel time quantile sketch for each (run_no, timeint, no,
+        veh_cls_res) group. Set by read_rsr_tt with pooled_quantiles_ or
+        summary_only_; None otherwise. agg_tt pools it across runs for
+        q95_trav_pooled. Merge the trav_sketch of other TtEval objects (other runs or
+        scenarios) with trav_sketch.merge to pool them without re-reading .rsr files.
+    sketch_accuracy: float
+        Relative accuracy of trav_sketch. Set by read_rsr_tt.
+    traversal_store: tobin_process.traversal_store.TraversalStore
+        tt_vissim_raw sorted by run and time, built by the first get_rebinned_rsr_tt
+        call. None before.
     tt_vissim_raw_grps_ttname_agg: pd.DataFrame()
         Final data with pivoted indices. This would be the final output.
     Methods
@@ -53,26 +1062,38 @@ class TtEval:
             keep_tt_segs_,
             veh_types_res_cls_,
             keep_cols_,
+            chunksize_=None,
+            n_workers_=1,
+            ingest_cache_=None,
+            rsr_engine_="pandas",
+            compact_=False,
+            timeint_spec_=None,
+            summary_only_=False,
+            sketch_accuracy_=0.005,
+            class_masks_=False,
+            occupancy_table_=None,
+            pooled_quantiles_=False,
             **kwargs
         ): If the user only passes order_timeint_, order_timeint_labels_, keep_tt_segs_,
             veh_types_res_cls_, keep_cols_ then use this function to read the .rsr file
             and compute some run specific summaries.   #
-            Add the following kwarg parameters to incoporate occupancy data from data
-            collection points for computing person delay:
+            Pass occupancy_table_ (and paths_data_col_vissim_raw_ for measured
+            occupancies) to compute person delay. Or add the following kwarg parameters
+            to incoporate occupancy data from data collection points for computing
+            person delay (vehicle types >= 300 measured, others car_hgv_veh_occupancy;
+            see occupancy.get_threshold_occupancy_table):
                 paths_data_col_vissim_raw_ = paths_data_col_vissim_raw,
                 use_data_col_no_ = use_data_col_no,
                 use_data_col_res = True,
                 car_hgv_veh_occupancy = 1.3,
 
-    get_person_delay_from_data_col_raw_data_bus_occupancy(
-        paths_data_col_vissim_raw,
-        use_data_col_no_,
-        file_no,
-        car_hgv_veh_occupancy,
-        tt_vissim_raw,
-        tt_vissim_raw_grp_runs,
-    ): Get person delay from data collection point raw output file.
-    merge_mapper(): Add the mapper data to tt_vissim_raw and tt_vissim_raw_grp_runs
+    get_rebinned_rsr_tt(timeint_specs_, n_workers_=1): tt_vissim_raw_grp_runs and
+        trav_sketch for other time interval schemes without re-reading the .rsr files.
+    rebin_rsr_tt(timeint_spec_, n_workers_=1): Switch tt_vissim_raw,
+        tt_vissim_raw_grp_runs and trav_sketch to another time interval scheme.
+    merge_mapper(engine_="pandas"): Add the mapper data to tt_vissim_raw and
+        tt_vissim_raw_grp_runs
+    set_mapper_cols_lookup(): Add the mapper columns to tt_vissim_raw in place.
     agg_tt(
         results_cols_=(
             "avg_trav",
@@ -83,7 +1104,13 @@ class TtEval:
         ),
     ): Aggreagate to scenario level results. Aggregate data in tt_vissim_raw_grp_runs
         to tt_vissim_raw_grps_ttname_agg.
-    save_tt_processed(): Save tt_vissim_raw_grps_ttname_agg.
+    get_pooled_trav_quantiles(quantiles_=(0.95,)): Travel time quantiles of the
+        vehicles of all the runs from trav_sketch.
+    get_peak_windows(window_=3600, step_=60, entity_cols_=("run_no", "no"),
+        start_=None, end_=None): Peak window of each travel time segment and run from
+        the traversal exit times.
+    save_tt_processed(ci_=None): Save tt_vissim_raw_grps_ttname_agg (and the bootstrap
+        intervals ci_ on a second sheet).
     plot_heatmaps(segs_to_plot, var="avg_speed_from_tt"): Create heatmap for
         avg_speed_from_tt.
     """
@@ -93,6 +1120,7 @@ class TtEval:
         paths_tt_vissim_raw_,
         path_output_tt_,
         path_to_output_tt_fig_,
+        mapper_cache_=None,
     ):
         """
         Parameters
@@ -104,6 +1132,9 @@ class TtEval:
             Path to output file for processed travel time result.
         path_to_output_tt_fig_: str
             Path to output file for processed travel time figures.
+        mapper_cache_: tobin_process.mapper_cache.MapperCache
+            Cache for the parsed mapper workbook. Defaults to
+            mapper_cache.default_mapper_cache.
         """
         self.path_to_mapper_tt_seg = path_to_mapper_tt_seg_
         self.paths_tt_vissim_raw = paths_tt_vissim_raw_
@@ -111,9 +1142,18 @@ class TtEval:
         self.path_to_output_tt_fig = path_to_output_tt_fig_
         self.veh_types_res_cls = {}
         self.veh_types_res_cls_df = pd.DataFrame()
-        self.tt_mapper = pd.read_excel(path_to_mapper_tt_seg_)
+        self.class_membership = pd.DataFrame()
+        self.class_masks = False
+        self.occupancy_table = None
+        self.compact = False
+        if mapper_cache_ is None:
+            mapper_cache_ = default_mapper_cache
+        self.tt_mapper = mapper_cache_.read_sheet(path_to_mapper_tt_seg_)
         self.tt_vissim_raw = pd.DataFrame()
         self.tt_vissim_raw_grp_runs = pd.DataFrame()
+        self.trav_sketch = None
+        self.sketch_accuracy = 0.005
+        self.traversal_store = None
         self.tt_vissim_raw_grps_ttname_agg = pd.DataFrame()
 
     def read_rsr_tt(
@@ -123,6 +1163,17 @@ class TtEval:
         keep_tt_segs_,
         veh_types_res_cls_,
         keep_cols_,
+        chunksize_=None,
+        n_workers_=1,
+        ingest_cache_=None,
+        rsr_engine_="pandas",
+        compact_=False,
+        timeint_spec_=None,
+        summary_only_=False,
+        sketch_accuracy_=0.005,
+        class_masks_=False,
+        occupancy_table_=None,
+        pooled_quantiles_=False,
         **kwargs
     ):
         """
@@ -132,31 +1183,83 @@ class TtEval:
         ----------
         order_timeint: Order of timeint.
         order_timeint_labels_: Labels for the timeint.
-        use_data_col_no_: Data collection points to use.
         keep_tt_segs_: Travel time segments that are relevant for travel time. Some
             travel time segemnts are used for bus headway calculation, thus are not
             used for travel time processing.
         veh_types_res_cls_: dict
             Dictinoary of result vehicles class to vissim vehicle tyeps.
         keep_cols_: Filter columns.
+        chunksize_: int
+            If set, stream each .rsr file chunksize_ rows at a time and drop the
+            columns and travel time segments that are not kept while reading. Use for
+            large .rsr files with travel time segments that are not reported.
+        n_workers_: int
+            Number of worker processes. Each vissim run (.rsr and matching .mer file)
+            is processed in its own process when n_workers_ > 1. Results are the same
+            as with n_workers_ = 1.
+        ingest_cache_: tobin_process.ingest_cache.IngestCache
+            If given, the filtered .rsr data is loaded from the cache for files that
+            were already parsed.
+        rsr_engine_: str
+            "pandas" (default) or "numpy". The numpy engine memory-maps each .rsr file
+            and decodes the numeric fields straight into column arrays. Use it for
+            multi-GB .rsr files from long simulation periods.
+        compact_: bool
+            If True, use compact dtypes for tt_vissim_raw and tt_vissim_raw_grp_runs:
+            smallest integer types for no, veh, veh_type and run_no, float32 for times,
+            distances and delays, and categoricals for veh_cls_res (also timeint,
+            tt_seg_name and direction). merge_mapper, agg_tt and
+            BusHeadway.get_headway_stats keep the compact dtypes. Prints the memory
+            saved. Averages can differ from the default mode in the 5th-6th significant
+            digit because of float32.
+        timeint_spec_: tobin_process.utils.TimeIntervalSpec
+            Time intervals and labels shared with the other modules. If given,
+            order_timeint_ and order_timeint_labels_ are not used and can be None.
+        summary_only_: bool
+            If True, only compute tt_vissim_raw_grp_runs: each .rsr file is streamed
+            chunksize_ rows at a time (default 500000) into running per-group
+            accumulators (see summarise_rsr_run) and tt_vissim_raw stays empty. Use
+            when the per-vehicle data is not needed; memory then depends on the number
+            of groups and not on the number of vehicles simulated. q95_trav is read
+            from a quantile sketch and is within sketch_accuracy_ of the exact value.
+            The .rsr files are not cached in ingest_cache_.
+        sketch_accuracy_: float
+            Relative accuracy of the travel time quantile sketches (trav_sketch and
+            q95_trav in summary-only mode). A sketch quantile is within
+            sketch_accuracy_ of np.quantile on the same vehicles, e.g. +/- 1 s for a
+            200 s travel time with the default 0.5%. See quantile_sketch.
+        class_masks_: bool
+            If True, keep one row per traversal in tt_vissim_raw instead of one row per
+            traversal and report class. With overlapping classes (e.g. "car_hgv_bus",
+            "car_hgv" and "bus") merging veh_types_res_cls_df duplicates every
+            traversal once per class it is in. The class statistics are instead
+            computed per vehicle type and regrouped with the class_membership matrix,
+            and the 95th percentiles use a mask of the traversals of each class.
+            tt_vissim_raw then has no veh_cls_res column (BusHeadway needs it).
+            Averages can differ from the default mode in the last digits (sum /
+            count instead of pandas mean).
+        occupancy_table_: tobin_process.occupancy.OccupancyTable
+            Constant or measured occupancy of each vehicle type, for person delay
+            (pers, pers_delay, tot_pers, tot_pers_delay and avg_pers_delay). Measured
+            occupancies are read from the paths_data_col_vissim_raw_ kwarg (.mer
+            files). Replaces the use_data_col_res, use_data_col_no_ and
+            car_hgv_veh_occupancy kwargs, which build the table of the Tobin Bridge
+            convention (see occupancy.get_threshold_occupancy_table).
+        pooled_quantiles_: bool
+            If True, also build trav_sketch, for q95_trav_pooled in agg_tt and
+            get_pooled_trav_quantiles. Off by default as sketching every traversal
+            slows down the read. Always on with summary_only_ (q95_trav is read from
+            the sketch).
         """
         if keep_cols_ is None:
             keep_cols_ = ["time", "no", "veh", "veh_type", "trav", "delay", "dist"]
 
-        # Create an interval index based on the order_timeint.
-        order_timeint_intindex_ = pd.IntervalIndex.from_tuples(
-            [
-                (int(timeint.split("-")[0]), int(timeint.split("-")[1]))
-                for timeint in order_timeint_
-            ],
-            closed="left",
-        )
-        timeint_dict = {
-            x: y for (x, y) in zip(order_timeint_intindex_, order_timeint_labels_)
-        }
-        list_tt_vissim_raw_grp_run = []
-        list_tt_vissim_raw = []
+        if timeint_spec_ is None:
+            timeint_spec_ = TimeIntervalSpec(order_timeint_, order_timeint_labels_)
         self.veh_types_res_cls = veh_types_res_cls_
+        self.compact = compact_
+        self.class_masks = class_masks_
+        self.class_membership = get_class_membership(veh_types_res_cls_)
         # Create a long dataframe from veh_types_res_cls_.
         self.veh_types_res_cls_df = (
             pd.DataFrame.from_dict(veh_types_res_cls_, orient="index")
@@ -166,206 +1269,235 @@ class TtEval:
             .dropna()
             .rename(columns={"index": "veh_cls_res", "value": "veh_type"})
         )
-
-        for path_tt_vissim_raw in self.paths_tt_vissim_raw:
-            tt_vissim_raw = pd.read_csv(path_tt_vissim_raw, sep=";", skiprows=8)
-            tt_vissim_raw.columns = remove_special_char_vissim_col(
-                tt_vissim_raw.columns
+        if compact_:
+            # Categories in sorted order so that groups are sorted the same way as
+            # with object classes.
+            self.veh_types_res_cls_df = self.veh_types_res_cls_df.astype(
+                {
+                    "veh_cls_res": pd.CategoricalDtype(sorted(veh_types_res_cls_)),
+                    "veh_type": np.int16,
+                }
             )
-            tt_vissim_raw = (
-                tt_vissim_raw.loc[lambda df: df.no.isin(keep_tt_segs_)]
-                .filter(items=keep_cols_)
-                .assign(
-                    timeint=lambda df: pd.cut(df.time, order_timeint_intindex_).map(
-                        timeint_dict
-                    ),
-                    veh_delay=lambda df: df.delay,
-                    veh_count=1,
-                    dist_ft=lambda df: df.dist * 3.28084,
-                )
-                .drop(columns=["dist"])
+
+        use_data_col_res = kwargs.pop("use_data_col_res", False)
+        car_hgv_veh_occupancy = kwargs.pop("car_hgv_veh_occupancy", None)
+        use_data_col_no = kwargs.pop("use_data_col_no_", None)
+        if (occupancy_table_ is None) and (use_data_col_res == True):
+            if car_hgv_veh_occupancy is None:
+                raise ValueError("Add car_hgv_veh_occupancy parameter.")
+            occupancy_table_ = get_threshold_occupancy_table(
+                veh_types_=self.class_membership.index.values,
+                car_hgv_veh_occupancy_=car_hgv_veh_occupancy,
+                use_data_col_no_=use_data_col_no,
             )
-            tt_vissim_raw = tt_vissim_raw.merge(
-                self.veh_types_res_cls_df, on="veh_type", how="left"
+        self.occupancy_table = occupancy_table_
+        if "paths_data_col_vissim_raw_" in kwargs:
+            # Run no --> .mer path, built once instead of searching the .mer paths for
+            # every run.
+            kwargs["paths_data_col_vissim_raw_"] = index_paths_by_run(
+                kwargs["paths_data_col_vissim_raw_"]
             )
-
-            file_nm = os.path.basename(path_tt_vissim_raw)
-            file_no = int(file_nm.split(".")[0].split("_")[1])
-            tt_vissim_raw.loc[:, "run_no"] = file_no
-
-            tt_vissim_raw_grp_runs = tt_vissim_raw.groupby(
-                ["run_no", "timeint", "no", "veh_cls_res"]
-            ).agg(
-                avg_veh_delay=("veh_delay", "mean"),
-                avg_trav=("trav", "mean"),
-                q95_trav=("trav", lambda x: np.quantile(x, 0.95)),
-                avg_dist_ft=("dist_ft", "mean"),
-                tot_veh=("veh_count", "sum"),
+        process_rsr_run_ = partial(
+            summarise_rsr_run if summary_only_ else process_rsr_run,
+            keep_tt_segs_=keep_tt_segs_,
+            keep_cols_=keep_cols_,
+            timeint_spec_=timeint_spec_,
+            veh_types_res_cls_df_=self.veh_types_res_cls_df,
+            chunksize_=chunksize_,
+            ingest_cache_=ingest_cache_,
+            rsr_engine_=rsr_engine_,
+            compact_=compact_,
+            relative_accuracy_=sketch_accuracy_,
+            class_membership_=self.class_membership if class_masks_ else None,
+            occupancy_table_=occupancy_table_,
+            pooled_quantiles_=pooled_quantiles_,
+            **kwargs
+        )
+        # Map: each vissim run (.rsr and matching .mer file) is a partition, processed
+        # in its own process when n_workers_ > 1. Reduce: concat the tables and merge
+        # the sketches in run order, so the output is the same as the serial path.
+        tt_vissim_raw, tt_vissim_raw_grp_runs, trav_sketch = map_reduce(
+            process_rsr_run_, self.paths_tt_vissim_raw, n_workers_
+        )
+        self.sketch_accuracy = sketch_accuracy_
+        self.trav_sketch = None
+        if trav_sketch is not None:
+            self.trav_sketch = GroupedQuantileSketch(
+                ["run_no", "timeint", "no", "veh_cls_res"], sketch_accuracy_
+            ).merge(trav_sketch)
+        if not summary_only_:
+            self.tt_vissim_raw = tt_vissim_raw.reset_index()
+        self.tt_vissim_raw_grp_runs = tt_vissim_raw_grp_runs.reset_index()
+        if compact_ and summary_only_:
+            self.tt_vissim_raw_grp_runs = self.tt_vissim_raw_grp_runs.astype(
+                {"veh_cls_res": pd.CategoricalDtype(sorted(veh_types_res_cls_))}
+            ).assign(veh_cls_res=lambda df: df.veh_cls_res.cat.remove_unused_categories())
+        elif compact_:
+            # Runs can have different classes; concat then returns object columns.
+            veh_cls_res_dtype = pd.CategoricalDtype(sorted(veh_types_res_cls_))
+            # Person delay columns are added as float64; downcast them too.
+            if class_masks_:
+                self.tt_vissim_raw = compact_rsr_dtypes(self.tt_vissim_raw)
+            else:
+                self.tt_vissim_raw = compact_rsr_dtypes(
+                    self.tt_vissim_raw.astype({"veh_cls_res": veh_cls_res_dtype})
+                ).assign(
+                    veh_cls_res=lambda df: df.veh_cls_res.cat.remove_unused_categories()
+                )
+            self.tt_vissim_raw_grp_runs = self._compact_grp_runs(
+                self.tt_vissim_raw_grp_runs
             )
-            # TODO: This is hard coded. Make it more flexible in the future.
-            if "use_data_col_res" in kwargs:
-                if kwargs["use_data_col_res"] == True:
-                    if "car_hgv_veh_occupancy" in kwargs:
-                        "We have the occupancy data."
-                    else:
-                        raise ValueError("Add car_hgv_veh_occupancy parameter.")
-                    (
-                        tt_vissim_raw,
-                        tt_vissim_raw_grp_runs,
-                    ) = self.get_person_delay_from_data_col_raw_data_bus_occupancy(
-                        paths_data_col_vissim_raw=kwargs["paths_data_col_vissim_raw_"],
-                        use_data_col_no_=kwargs["use_data_col_no_"],
-                        file_no=file_no,
-                        car_hgv_veh_occupancy=kwargs["car_hgv_veh_occupancy"],
-                        tt_vissim_raw=tt_vissim_raw,
-                        tt_vissim_raw_grp_runs=tt_vissim_raw_grp_runs,
-                    )
-            list_tt_vissim_raw_grp_run.append(tt_vissim_raw_grp_runs)
-            list_tt_vissim_raw.append(tt_vissim_raw)
+            print_memory_saved(self.tt_vissim_raw, "tt_vissim_raw")
 
-        self.tt_vissim_raw = pd.concat(list_tt_vissim_raw).reset_index()
-        self.tt_vissim_raw_grp_runs = pd.concat(
-            list_tt_vissim_raw_grp_run
-        ).reset_index()
+    def _compact_grp_runs(self, tt_vissim_raw_grp_runs):
+        veh_cls_res_dtype = pd.CategoricalDtype(sorted(self.veh_types_res_cls))
+        return compact_rsr_dtypes(
+            tt_vissim_raw_grp_runs.astype({"veh_cls_res": veh_cls_res_dtype})
+        ).assign(veh_cls_res=lambda df: df.veh_cls_res.cat.remove_unused_categories())
 
-    # TODO: Make the function more flexible. Current it makes assumption about what
-    #  vehicle types are buses. Let user define what vehicle type is a bus. I (Apoorb)
-    #  have hard coded this for Tobin Bridge.
-    def get_person_delay_from_data_col_raw_data_bus_occupancy(
-        self,
-        paths_data_col_vissim_raw,
-        use_data_col_no_,
-        file_no,
-        car_hgv_veh_occupancy,
-        tt_vissim_raw,
-        tt_vissim_raw_grp_runs,
-    ):
+    def get_rebinned_rsr_tt(self, timeint_specs_, n_workers_=1):
         """
-        Use the data collection file to get the bus occupancy data for busses. For Tobim
-        bridge projects, all the buses pass through 2-3 common points so it was easy to
-        put data collection points on these location and measure the bus occupancy. The
-        data collection raw file (.mer file) starts collecting data before the travel time
-        data file (.rsr file); I am starting the data collection for data collection file
-        at 0 seconds whereas the data colelction for .rsr file starts at 2700 seconds.
-        This is needed to capture all the buses that pass the travel time segment.
-
-        Some of the assumptions in this function are Tobin Bridge project specific and
-        can be relaxed with function arguments later on. For instance, I consider all
-        vehicles with vehicle type < 300 as cars or HGVs and do not explicitly handles
-        vehicle type above 300.
+        tt_vissim_raw_grp_runs and trav_sketch for each time interval scheme of
+        timeint_specs_, e.g. 5-minute, hourly and peak hour aggregates from the
+        traversals read once with 15-minute intervals. The .rsr files are not re-read:
+        tt_vissim_raw is sorted by run and time once (traversal_store) and the
+        intervals of each scheme are found with np.searchsorted on the sorted times.
+        All the schemes are aggregated in one pass over the runs (see rebin_rsr_run
+        and map_reduce). Uses the classes, occupancy, compact, sketch accuracy and
+        pooled quantiles settings of read_rsr_tt.
         Parameters
         ----------
-        paths_data_col_vissim_raw: str
-            path to all the data collection files.
-        use_data_col_no_: list
-            List of data collection points that are used to get the bus occupancy data.
-        file_no: int
-            Travel time run number that is being processed. Pull the data collection point
-            results for the correspoing data collection point file.
-        car_hgv_veh_occupancy: float
-            Occupancy for cars and hgvs. I computed it for Tobin brdige based on the data
-            provided by Pete. For future projects, make this variable more flexible; can
-            use different occupancy for car and buses.
-        tt_vissim_raw: pd.DataFrame
-            Raw travel time data. This will be modified with features from data
-            collection point results in this function.
-        tt_vissim_raw_grp_runs: pd.DataFrame
-            Travel time aggregates/ summaries for a run. This will be modified with
-            features from data collection point results in this function.
+        timeint_specs_: dict
+            Name --> tobin_process.utils.TimeIntervalSpec, e.g.
+            {"hourly": TimeIntervalSpec(["2700-6300", "6300-9900"], ["6-7", "7-8"]),
+            "peak": TimeIntervalSpec(["5400-9000"], ["6:45-7:45"])}.
+        n_workers_: int
+            Number of worker processes for the runs. Default 1 processes the runs in
+            this process.
         Returns
         -------
-        tt_vissim_raw: pd.DataFrame
-            Raw travel time data with person delay.
-        tt_vissim_raw_grp_runs: pd.DataFrame
-            Travel time data with average person delay.
+        rebinned: dict
+            Name --> (tt_vissim_raw_grp_runs, trav_sketch). Same groups and columns as
+            read_rsr_tt with that time interval scheme; averages can differ in the last
+            digits as the traversals are summed in time order. trav_sketch is None
+            if read_rsr_tt was run without pooled_quantiles_.
         """
-        for path in paths_data_col_vissim_raw:
-            file_nm_dat_col = os.path.basename(path)
-            file_no_dat_col = int(file_nm_dat_col.split(".")[0].split("_")[1])
-            # Proceed if file no of current data collection file matches the .rsr file.
-            if file_no == file_no_dat_col:
-                row = 0
-                with open(path) as input_file:
-                    for current_line in input_file:
-                        len_ = len(re.split(";", current_line))
-                        if len_ > 5:
-                            break # Length > 5 implies we have reached 1st valid row.
-                        row = row + 1
-                dat_col_persons = pd.read_csv(path, skiprows=row, sep=";")
-                dat_col_persons.columns = remove_special_char_vissim_col(
-                    dat_col_persons.columns
-                )
-                # t_entry > 0 removes -1 entries.
-                # df["vehicle type"] >=300 get all the buses.
-                # TODO: Change this >=300 by a user defined input. Let user define what
-                #  vehicle type is a bus. I (Apoorb) have hard coded this for Tobin
-                #  Bridge.
-                dat_col_persons_fil = (
-                    dat_col_persons.loc[
-                        lambda df: (df.measurem.isin(use_data_col_no))
-                        & (df.t_entry > 0)
-                        & (df["vehicle type"] >= 300)
-                    ]
-                    .rename(columns={"veh_no": "veh", "vehicle type": "veh_type_temp",})
-                    .sort_values("t_entry")
-                    .drop_duplicates("veh")
-                    .filter(items=["veh", "veh_type_temp", "pers"])
-                )
-                tt_vissim_raw = tt_vissim_raw.merge(
-                    dat_col_persons_fil, on="veh", how="left"
-                )
-                # Assuming all veh type < 300 are not buses.
-                # Assuming all veh type above 300 are busses
-                tt_vissim_raw.loc[
-                    lambda df: (df.veh_type < 300), "pers"
-                ] = car_hgv_veh_occupancy
-                assert not tt_vissim_raw.pers.isna().values.any(), (
-                    "Check if there is occupancy data collected in data"
-                    "collection point for all buses."
-                )
-
-                tt_vissim_raw = tt_vissim_raw.assign(
-                    pers_delay=lambda df: df.pers * df.veh_delay
-                )
+        if self.tt_vissim_raw_grp_runs.empty:
+            raise ValueError("No traversals. Run read_rsr_tt first.")
+        if self.traversal_store is None:
+            self.traversal_store = TraversalStore(self.tt_vissim_raw)
+        rebinned = map_reduce(
+            partial(
+                rebin_rsr_run,
+                timeint_specs_=timeint_specs_,
+                relative_accuracy_=self.sketch_accuracy,
+                class_membership_=self.class_membership if self.class_masks else None,
+                person_delay_=self.occupancy_table is not None,
+                compact_=self.compact,
+                pooled_quantiles_=self.trav_sketch is not None,
+            ),
+            self.traversal_store.get_partitions(),
+            n_workers_,
+        )
+        for name, (tt_vissim_raw_grp_runs, trav_sketch) in rebinned.items():
+            tt_vissim_raw_grp_runs = tt_vissim_raw_grp_runs.reset_index()
+            if self.compact:
+                tt_vissim_raw_grp_runs = self._compact_grp_runs(tt_vissim_raw_grp_runs)
+            if trav_sketch is not None:
+                trav_sketch = GroupedQuantileSketch(
+                    ["run_no", "timeint", "no", "veh_cls_res"], self.sketch_accuracy
+                ).merge(trav_sketch)
+            rebinned[name] = (tt_vissim_raw_grp_runs, trav_sketch)
+        return rebinned
 
-                tt_vissim_raw_grp_runs_extra = (
-                    tt_vissim_raw.groupby(["run_no", "timeint", "no", "veh_cls_res"])
-                    .agg(
-                        tot_pers=("pers", "sum"), tot_pers_delay=("pers_delay", "sum"),
-                    )
-                    .assign(avg_pers_delay=lambda df: df.tot_pers_delay / df.tot_pers)
-                )
-                # Add the person delay information to tt_vissim_raw_grp_runs dataframe.
-                tt_vissim_raw_grp_runs = pd.merge(
-                    tt_vissim_raw_grp_runs,
-                    tt_vissim_raw_grp_runs_extra,
-                    left_index=True,
-                    right_index=True,
-                )
-                return tt_vissim_raw, tt_vissim_raw_grp_runs
+    def rebin_rsr_tt(self, timeint_spec_, n_workers_=1):
+        """
+        Set tt_vissim_raw_grp_runs and trav_sketch to the aggregates of timeint_spec_
+        (see get_rebinned_rsr_tt) and relabel the timeint of tt_vissim_raw, as if
+        read_rsr_tt had been run with timeint_spec_. Call it before merge_mapper.
+        Parameters
+        ----------
+        timeint_spec_: tobin_process.utils.TimeIntervalSpec
+            New time intervals and labels.
+        n_workers_: int
+            See get_rebinned_rsr_tt.
+        """
+        if "tt_seg_name" in self.tt_vissim_raw_grp_runs.columns:
+            raise ValueError(
+                "Call rebin_rsr_tt before merge_mapper, or use get_rebinned_rsr_tt."
+            )
+        self.tt_vissim_raw_grp_runs, self.trav_sketch = self.get_rebinned_rsr_tt(
+            {"timeint": timeint_spec_}, n_workers_
+        )["timeint"]
+        self.tt_vissim_raw = self.tt_vissim_raw.assign(
+            timeint=timeint_spec_.bin_times(self.tt_vissim_raw.time.values)
+        )
 
-    def merge_mapper(self):
+    def merge_mapper(self, engine_="pandas"):
         """
         Add travel time segment names and direction to self.tt_vissim_raw .
+        Parameters
+        ----------
+        engine_: str
+            "pandas" (default) merges tt_mapper onto tt_vissim_raw (how="right"), which
+            copies all its columns and adds a row of NaN for mapper segments without
+            traversals. "lookup" maps no to the mapper rows with lookup_mapper_rows and
+            adds tt_seg_no, tt_seg_name, direction (categorical codes) and sort_order
+            to tt_vissim_raw in place: rows keep their order and dtypes, traversals of
+            segments not in the mapper are dropped, and mapper segments without
+            traversals are reported with a warning. tt_vissim_raw_grp_runs is merged
+            the same way with both engines; it keeps a row for each mapper segment.
         """
+        if engine_ not in ("pandas", "lookup"):
+            raise ValueError(f"Unknown engine {engine_}. Use 'pandas' or 'lookup'.")
         self.tt_mapper = self.tt_mapper.sort_values(
             ["direction", "sort_order"]
         ).reset_index()
-        self.tt_vissim_raw = self.tt_vissim_raw.merge(
-            self.tt_mapper, left_on="no", right_on="tt_seg_no", how="right"
-        ).assign(
-            tt_seg_name=lambda df: pd.Categorical(
-                df.tt_seg_name, self.tt_mapper.tt_seg_name.values, ordered=True
-            ),
-            direction=lambda df: pd.Categorical(
-                df.direction,
-                self.tt_mapper.direction.drop_duplicates().values,
-                ordered=True,
-            ),
-        )
+        tt_mapper = self.tt_mapper
+        if self.compact:
+            # Merge categorical names and directions instead of broadcasting strings to
+            # every traversal.
+            tt_mapper = self.tt_mapper.astype(
+                {
+                    "tt_seg_name": pd.CategoricalDtype(
+                        self.tt_mapper.tt_seg_name.values, ordered=True
+                    ),
+                    "direction": pd.CategoricalDtype(
+                        self.tt_mapper.direction.drop_duplicates().values, ordered=True
+                    ),
+                }
+            )
+        # In compact mode travel time segments without traversals are not added to
+        # tt_vissim_raw (how="inner"); their rows would be all NaN and turn the integer
+        # columns into float64. tt_vissim_raw_grp_runs keeps them for agg_tt.
+        # tt_vissim_raw is empty in summary-only mode.
+        if (not self.tt_vissim_raw.empty) and (engine_ == "lookup"):
+            self.set_mapper_cols_lookup()
+        elif not self.tt_vissim_raw.empty:
+            if self.compact:
+                # Reported as the lookup engine does; the right join keeps them as NaN
+                # rows instead.
+                warn_missing_mapper_segs(
+                    self.tt_vissim_raw.no.values, self.tt_mapper.tt_seg_no.values
+                )
+            self.tt_vissim_raw = self.tt_vissim_raw.merge(
+                tt_mapper,
+                left_on="no",
+                right_on="tt_seg_no",
+                how="inner" if self.compact else "right",
+            ).assign(
+                tt_seg_name=lambda df: pd.Categorical(
+                    df.tt_seg_name, self.tt_mapper.tt_seg_name.values, ordered=True
+                ),
+                direction=lambda df: pd.Categorical(
+                    df.direction,
+                    self.tt_mapper.direction.drop_duplicates().values,
+                    ordered=True,
+                ),
+            )
 
         self.tt_vissim_raw_grp_runs = self.tt_vissim_raw_grp_runs.merge(
-            self.tt_mapper, left_on="no", right_on="tt_seg_no", how="right"
+            tt_mapper, left_on="no", right_on="tt_seg_no", how="right"
         ).assign(
             tt_seg_name=lambda df: pd.Categorical(
                 df.tt_seg_name, self.tt_mapper.tt_seg_name.values, ordered=True
@@ -376,6 +1508,40 @@ class TtEval:
                 ordered=True,
             ),
         )
+        if self.compact and (not self.tt_vissim_raw.empty):
+            self.tt_vissim_raw = compact_rsr_dtypes(self.tt_vissim_raw)
+            print_memory_saved(self.tt_vissim_raw, "tt_vissim_raw")
+
+    def set_mapper_cols_lookup(self):
+        """
+        Add the tt_mapper columns to tt_vissim_raw through the mapper row of each
+        traversal. See merge_mapper.
+        """
+        mapper_rows = lookup_mapper_rows(
+            self.tt_vissim_raw.no.values, self.tt_mapper.tt_seg_no.values
+        )
+        warn_missing_mapper_segs(
+            self.tt_vissim_raw.no.values, self.tt_mapper.tt_seg_no.values
+        )
+        if (mapper_rows < 0).any():
+            # Same as the right join: traversals of segments not in the mapper are not
+            # kept.
+            self.tt_vissim_raw = self.tt_vissim_raw.loc[mapper_rows >= 0].reset_index(
+                drop=True
+            )
+            mapper_rows = mapper_rows[mapper_rows >= 0]
+        direction_codes, directions = pd.factorize(self.tt_mapper.direction)
+        self.tt_vissim_raw["tt_seg_no"] = self.tt_mapper.tt_seg_no.values[mapper_rows]
+        # Categories in mapper order: the code of a segment name is its mapper row.
+        self.tt_vissim_raw["tt_seg_name"] = pd.Categorical.from_codes(
+            mapper_rows,
+            dtype=pd.CategoricalDtype(self.tt_mapper.tt_seg_name.values, ordered=True),
+        )
+        self.tt_vissim_raw["direction"] = pd.Categorical.from_codes(
+            direction_codes[mapper_rows],
+            dtype=pd.CategoricalDtype(directions.values, ordered=True),
+        )
+        self.tt_vissim_raw["sort_order"] = self.tt_mapper.sort_order.values[mapper_rows]
 
     def agg_tt(
         self,
@@ -388,7 +1554,11 @@ class TtEval:
         ),
     ):
         """
-        Aggregate travel time features. Reformat data to report format.
+        Aggregate travel time features. Reformat data to report format. Run averages
+        are reported for all the columns, q95_trav is the mean of the per-run 95th
+        percentiles. Add "q95_trav_pooled" to results_cols_ for the 95th percentile of
+        the vehicles of all the runs, read from the merged trav_sketch (within
+        sketch_accuracy_ of the exact value; needs read_rsr_tt with pooled_quantiles_).
         """
         agg_dict = {
             "avg_veh_delay": "mean",
@@ -417,6 +1587,11 @@ class TtEval:
             .assign(
                 avg_speed=lambda df: np.round(df.avg_dist_ft / df.avg_trav / 1.47, 2),
             )
+            .pipe(
+                lambda df: self._add_pooled_trav_quantile(df)
+                if "q95_trav_pooled" in results_cols_
+                else df
+            )
             .reset_index()
             .set_index(["timeint", "direction", "tt_seg_name", "veh_cls_res"])
             .filter(items=results_cols_)
@@ -432,13 +1607,121 @@ class TtEval:
         self.tt_vissim_raw_grps_ttname_agg = self.tt_vissim_raw_grps_ttname_agg.reindex(
             mux, axis=1
         )
+        if self.compact:
+            # Report table is small. float64 so that the rounded values are written to
+            # the output file as 98.85 and not as the float32 value 98.849998.
+            self.tt_vissim_raw_grps_ttname_agg = self.tt_vissim_raw_grps_ttname_agg.astype(
+                np.float64
+            )
         self.tt_vissim_raw_grps_ttname_agg = self.tt_vissim_raw_grps_ttname_agg.round(2)
 
-    def save_tt_processed(self):
+    def get_pooled_trav_quantiles(self, quantiles_=(0.95,)):
+        """
+        Travel time quantiles of the vehicles of all the runs, from trav_sketch. Sketches
+        of other runs or scenarios merged into trav_sketch are included.
+        Parameters
+        ----------
+        quantiles_: list
+            Quantiles between 0 and 1.
+        Returns
+        -------
+        pooled_trav_quantiles: pd.DataFrame
+            One column per quantile, indexed by timeint, tt_seg_name and veh_cls_res.
+        """
+        if self.trav_sketch is None:
+            raise ValueError(
+                "No travel time sketch. Run read_rsr_tt with pooled_quantiles_=True."
+            )
+        tt_seg_no_name = self.tt_mapper.drop_duplicates("tt_seg_no").set_index(
+            "tt_seg_no"
+        ).tt_seg_name
+        return (
+            self.trav_sketch.pool(["timeint", "no", "veh_cls_res"])
+            .quantiles(quantiles_)
+            .reset_index()
+            .assign(tt_seg_name=lambda df: df.no.map(tt_seg_no_name))
+            .set_index(["timeint", "tt_seg_name", "veh_cls_res"])
+            .drop(columns="no")
+        )
+
+    def _add_pooled_trav_quantile(self, tt_agg):
+        pooled_trav_q95 = self.get_pooled_trav_quantiles([0.95])[0.95]
+        return tt_agg.assign(
+            q95_trav_pooled=pooled_trav_q95.reindex(tt_agg.index.to_flat_index()).values
+        )
+
+    def get_peak_windows(
+        self,
+        window_=3600,
+        step_=60,
+        entity_cols_=("run_no", "no"),
+        start_=None,
+        end_=None,
+    ):
+        """
+        Peak window (e.g. the peak hour) of each travel time segment and run, and of
+        all of them together, from the exit times (time) of the traversals in
+        tt_vissim_raw. Each traversal is counted once, also when it is in several
+        report classes. See peak_window.find_peak_windows.
+        Parameters
+        ----------
+        window_: float
+            Window length (s). Default: peak hour.
+        step_: float
+            Resolution (s) of the window starts. Default: 1 minute.
+        entity_cols_: list
+            Keys of the entities, e.g. ("no",) for the segments of all the runs
+            together or ("run_no", "no", "veh_cls_res") by report class.
+        start_, end_: float
+            Period searched (s). See peak_window.find_peak_windows.
+        Returns
+        -------
+        peak_by_entity: pd.DataFrame
+            entity_cols_ with peak_start, peak_end, peak_timeint and peak_volume.
+        peak_overall: pd.DataFrame
+            Peak window of the traversals of all the entities.
+        """
+        if self.tt_vissim_raw.empty:
+            raise ValueError(
+                "No traversals. Run read_rsr_tt without summary_only_ first."
+            )
+        tt_vissim_raw = self.tt_vissim_raw
+        if ("veh_cls_res" in tt_vissim_raw.columns) and (
+            "veh_cls_res" not in entity_cols_
+        ):
+            # One row per traversal and report class; keep each traversal once.
+            tt_vissim_raw = tt_vissim_raw.drop_duplicates(
+                [
+                    colnm
+                    for colnm in ["run_no", "no", "veh", "time"]
+                    if colnm in tt_vissim_raw.columns
+                ]
+            )
+        return find_peak_windows(
+            tt_vissim_raw,
+            "time",
+            list(entity_cols_),
+            window_=window_,
+            step_=step_,
+            start_=start_,
+            end_=end_,
+        )
+
+    def save_tt_processed(self, ci_=None):
         """
         Save the processed travel time data.
+        Parameters
+        ----------
+        ci_: pd.DataFrame
+            Bootstrap confidence intervals, e.g. from bootstrap.bootstrap_tt_ci. If
+            given, saved to the "ci" sheet of the same file.
         """
-        self.tt_vissim_raw_grps_ttname_agg.to_excel(self.path_output_tt)
+        if ci_ is None:
+            self.tt_vissim_raw_grps_ttname_agg.to_excel(self.path_output_tt)
+            return
+        with pd.ExcelWriter(self.path_output_tt) as writer:
+            self.tt_vissim_raw_grps_ttname_agg.to_excel(writer)
+            ci_.to_excel(writer, sheet_name="ci")
 
     def plot_heatmaps(self, segs_to_plot, var="avg_speed_from_tt"):
         """
@@ -605,13 +1888,9 @@ if __name__ == "__main__":
     #     use_data_col_no_ = use_data_col_no,
     #     use_data_col_res = True,
     #     car_hgv_veh_occupancy = 1.3,
-    # TODO: Make the read_rsr_tt and get_person_delay_from_data_col_raw_data_bus_occupancy more
-    #  flexible.
-    #  Currently it makes assumption about what vehicle types are buses; all vehicle type
-    #  below 300 are considered cars and HGVs and all vehicle type above or equal to 300
-    #  are considered buses.
-    #  Let user define what vehicle type is a bus. I (Apoorb) have hard coded this for
-    #  Tobin Bridge.
+    # These kwargs treat vehicle types >= 300 as buses with measured occupancy. Pass an
+    # occupancy.OccupancyTable as occupancy_table_ to set the occupancy of each vehicle
+    # type instead.
 
     tt_eval_am.read_rsr_tt(
         order_timeint_=order_timeint,
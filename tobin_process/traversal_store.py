@@ -0,0 +1,147 @@
+"""
+Module with a time-sorted store of the parsed .rsr traversals, for re-binning them into
+other time interval schemes (e.g. 5-minute, 15-minute, hourly or a custom peak hour)
+without re-reading the .rsr files. The traversals are sorted by run and time once, so
+the rows of a run are a contiguous slice and the rows of a time interval are found with
+two binary searches on the sorted times instead of binning every row.
+"""
+import numpy as np
+
+# Columns of the parsed traversals kept in the store (when present).
+TRAVERSAL_STORE_COLS = [
+    "run_no",
+    "time",
+    "no",
+    "veh",
+    "veh_type",
+    "veh_cls_res",
+    "trav",
+    "veh_delay",
+    "veh_count",
+    "dist_ft",
+    "pers",
+    "pers_delay",
+]
+
+
+def bin_sorted_times(time_, timeint_spec_):
+    """
+    Interval code (position in timeint_spec_.order_timeint) for each time of sorted
+    time_; -1 for times outside the intervals. Same codes as
+    TimeIntervalSpec.get_codes, with two np.searchsorted calls per interval instead of
+    one per time.
+    Parameters
+    ----------
+    time_: np.ndarray
+        Times sorted in increasing order.
+    timeint_spec_: tobin_process.utils.TimeIntervalSpec
+        Time intervals, closed on the left.
+    Returns
+    -------
+    timeint_codes: np.ndarray
+        int16 interval codes.
+    """
+    # Intervals do not overlap (see TimeIntervalSpec), so each row is set at most once.
+    first_rows = np.searchsorted(time_, timeint_spec_.starts, side="left")
+    end_rows = np.searchsorted(time_, timeint_spec_.ends, side="left")
+    timeint_codes = np.full(len(time_), -1, dtype=np.int16)
+    for timeint_code, (first_row, end_row) in enumerate(zip(first_rows, end_rows)):
+        timeint_codes[first_row:end_row] = timeint_code
+    return timeint_codes
+
+
+class TraversalStore:
+    """
+    Parsed .rsr traversals of all the runs sorted by run and time, without time
+    interval labels. Built once from TtEval.tt_vissim_raw; re-binned into any
+    TimeIntervalSpec with get_partitions and bin_sorted_times.
+
+    ...
+    Attributes
+    ___________
+    traversals: pd.DataFrame()
+        TRAVERSAL_STORE_COLS columns of the traversals, sorted by run_no and time
+        (stable, so rows with the same time keep their order).
+    run_nos: np.ndarray
+        Run numbers, sorted.
+    run_offsets: np.ndarray
+        Row of traversals where each run starts, and the number of rows at the end:
+        the rows of run_nos[i] are run_offsets[i]:run_offsets[i + 1].
+    Methods
+    ________
+    get_run(run_no_): Traversals of a run.
+    get_partitions(): Traversals of each run, in run order (see map_reduce).
+    get_timeint_codes(timeint_spec_): Interval code of each traversal.
+    """
+
+    def __init__(self, tt_vissim_raw_):
+        """
+        Parameters
+        ----------
+        tt_vissim_raw_: pd.DataFrame
+            Parsed traversals with run_no and time, e.g. TtEval.tt_vissim_raw after
+            read_rsr_tt. The time interval (timeint) and mapper columns are not kept.
+        """
+        missing_cols = {"run_no", "time"} - set(tt_vissim_raw_.columns)
+        if missing_cols:
+            raise ValueError(f"tt_vissim_raw_ needs the columns {sorted(missing_cols)}.")
+        if tt_vissim_raw_.empty:
+            raise ValueError(
+                "No traversals to store. read_rsr_tt with summary_only_=True does not "
+                "keep the traversals."
+            )
+        if tt_vissim_raw_.run_no.isna().any():
+            # Rows added by TtEval.merge_mapper for mapper segments without traversals;
+            # they turn the integer columns into float64.
+            tt_vissim_raw_ = tt_vissim_raw_.loc[lambda df: df.run_no.notna()].astype(
+                {
+                    colnm: np.int64
+                    for colnm in ["run_no", "no", "veh", "veh_type"]
+                    if colnm in tt_vissim_raw_.columns
+                }
+            )
+        self.traversals = (
+            tt_vissim_raw_.filter(items=TRAVERSAL_STORE_COLS)
+            .sort_values(["run_no", "time"], kind="mergesort")
+            .reset_index(drop=True)
+        )
+        run_no = self.traversals.run_no.values
+        run_starts = np.flatnonzero(np.r_[True, run_no[1:] != run_no[:-1]])
+        self.run_nos = run_no[run_starts]
+        self.run_offsets = np.r_[run_starts, len(run_no)]
+
+    def get_run(self, run_no_):
+        """
+        Traversals of run_no_, sorted by time.
+        """
+        run_pos = np.flatnonzero(self.run_nos == run_no_)
+        if not len(run_pos):
+            raise ValueError(f"Run {run_no_} is not in the store: {list(self.run_nos)}.")
+        return self.traversals.iloc[
+            self.run_offsets[run_pos[0]] : self.run_offsets[run_pos[0] + 1]
+        ]
+
+    def get_partitions(self):
+        """
+        Traversals of each run (sorted by time), in run order. Each partition is a
+        slice of traversals, not a groupby.
+        """
+        return [
+            self.traversals.iloc[first_row:end_row]
+            for first_row, end_row in zip(self.run_offsets[:-1], self.run_offsets[1:])
+        ]
+
+    def get_timeint_codes(self, timeint_spec_):
+        """
+        Interval code of each traversal (in traversals order) for timeint_spec_; -1 for
+        times outside the intervals.
+        """
+        time = self.traversals.time.values
+        return np.concatenate(
+            [
+                bin_sorted_times(time[first_row:end_row], timeint_spec_)
+                for first_row, end_row in zip(
+                    self.run_offsets[:-1], self.run_offsets[1:]
+                )
+            ]
+        )
@@ -1,5 +1,8 @@
+import sys
 from pathlib import Path
 import inflection
+import numpy as np
+import pandas as pd
 
 
 def get_project_root() -> Path:
@@ -18,3 +21,361 @@ def remove_special_char_vissim_col(df_columns):
         .strip()
         for colnm in df_columns
     ]
+
+
+# Dtypes for the columns of the vissim .att tables, by table name (text between $ and
+# : in the header). Column names are after remove_special_char_vissim_col. Columns not
+# listed here get the dtype inferred by pandas. Use register_att_schema to add tables.
+ATT_SCHEMAS = {
+    "MOVEMENTEVALUATION": {
+        "movementevaluation_simrun": "category",
+        "timeint": "category",
+        "movement": "category",
+        "movement_direction": "category",
+        "movement_fromlink_level": np.float32,
+        "qlen": np.float64,
+        "qlenmax": np.float64,
+        "vehdelay_all": np.float64,
+    },
+    "LINKEVALSEGMENTEVALUATION": {
+        "linkevalsegmentevaluation_simrun": "category",
+        "timeint": "category",
+        "linkevalsegment": "category",
+        "linkevalsegment_link_numlanes": np.float32,
+    },
+    "VEHICLENETWORKPERFORMANCEMEASUREMENTEVALUATION": {
+        "vehiclenetworkperformancemeasurementevaluation_simrun": "category",
+        "timeint": "category",
+    },
+}
+
+
+def register_att_schema(table_, dtypes_):
+    """
+    Add or update the dtypes used by read_vissim_att for a vissim .att table.
+    Parameters
+    ----------
+    table_: str
+        Table name in the .att header, e.g. "MOVEMENTEVALUATION".
+    dtypes_: dict
+        Column name (after remove_special_char_vissim_col) --> dtype.
+    """
+    ATT_SCHEMAS.setdefault(table_.upper(), {}).update(dtypes_)
+
+
+def read_att_header(path_att_):
+    """
+    Parse the header of a vissim .att file.
+    Parameters
+    ----------
+    path_att_: str
+        Path to the .att file.
+    Returns
+    -------
+    table: str
+        Table name, e.g. "MOVEMENTEVALUATION".
+    col_nms: list
+        Column names after remove_special_char_vissim_col.
+    header_line_no: int
+        0-based line number of the header. Data starts on the next line.
+    """
+    with open(path_att_) as input_file:
+        # 1st line is $VISION. Header is the next line starting with $<TABLE>:.
+        for header_line_no, line in enumerate(input_file):
+            if (header_line_no > 0) & line.startswith("$") & (":" in line):
+                break
+        else:
+            raise ValueError(f"No $<TABLE>: header found in {path_att_}.")
+    table = line[1 : line.index(":")].upper()
+    col_nms = remove_special_char_vissim_col(line.rstrip("\n").split(";"))
+    return table, col_nms, header_line_no
+
+
+def read_vissim_att(path_att_, usecols_=None, keep_runs_=None, chunksize_=500000):
+    """
+    Read a vissim .att file (node, link segment, network performance evaluation...).
+    Only reads usecols_, assigns the dtypes from ATT_SCHEMAS and keeps the SIMRUN values
+    in keep_runs_ while reading.
+    Parameters
+    ----------
+    path_att_: str
+        Path to the .att file.
+    usecols_: list
+        Columns to read; vissim names (e.g. "VEHDELAY(ALL)") or names after
+        remove_special_char_vissim_col. None reads all the columns.
+    keep_runs_: list
+        SIMRUN values to keep, e.g. ["AVG"] or [1, 2]. None keeps all the runs. The file
+        is read in chunks of chunksize_ rows and each chunk is filtered.
+    chunksize_: int
+        Rows per chunk when filtering on keep_runs_.
+    Returns
+    -------
+    att_data: pd.DataFrame
+        Data with column names after remove_special_char_vissim_col.
+    """
+    table, col_nms, header_line_no = read_att_header(path_att_)
+    schema = ATT_SCHEMAS.get(table, {})
+    simrun_col = f"{remove_special_char_vissim_col([table])[0]}_simrun"
+    if usecols_ is None:
+        usecols = col_nms
+    else:
+        usecols_cor_nm = set(remove_special_char_vissim_col(usecols_))
+        if keep_runs_ is not None:
+            usecols_cor_nm.add(simrun_col)
+        usecols = [colnm for colnm in col_nms if colnm in usecols_cor_nm]
+    dtypes = {colnm: dtype for colnm, dtype in schema.items() if colnm in usecols}
+    # * is comment line. Same as the old pd.read_csv(comment="*", skiprows=1) readers.
+    read_csv_kwargs = dict(
+        sep=";",
+        comment="*",
+        header=None,
+        names=col_nms,
+        usecols=usecols,
+        skiprows=header_line_no + 1,
+    )
+    if keep_runs_ is None:
+        att_data = pd.read_csv(path_att_, dtype=dtypes, **read_csv_kwargs)
+        return att_data.filter(items=usecols)
+    keep_runs = [str(run) for run in keep_runs_]
+    # Categories differ between chunks, so categoricals are set after concatenating.
+    dtypes_chunk = {
+        colnm: (str if dtype == "category" else dtype) for colnm, dtype in dtypes.items()
+    }
+    dtypes_chunk[simrun_col] = str
+    att_data = pd.concat(
+        [
+            chunk.loc[lambda df: df[simrun_col].isin(keep_runs)]
+            for chunk in pd.read_csv(
+                path_att_, dtype=dtypes_chunk, chunksize=chunksize_, **read_csv_kwargs
+            )
+        ],
+        ignore_index=True,
+    )
+    return att_data.astype(
+        {colnm: dtype for colnm, dtype in dtypes.items() if dtype == "category"}
+    ).filter(items=usecols)
+
+
+def categories_to_object(df_):
+    """
+    Convert the categorical columns returned by read_vissim_att back to object columns.
+    Use after filtering rows, so that groupby only returns the observed groups.
+    """
+    return df_.astype(
+        {
+            colnm: object
+            for colnm, dtype in df_.dtypes.items()
+            if isinstance(dtype, pd.CategoricalDtype)
+        }
+    )
+
+
+def extract_distinct(values_, pattern_):
+    """
+    Same as values_.str.extract(pattern_), but each distinct string is matched once and
+    the groups are broadcast back to the rows through the factorize codes. Use for
+    columns such as movement or direction names that repeat for every run and time
+    interval.
+    Parameters
+    ----------
+    values_: pd.Series
+        Strings.
+    pattern_: str or re.Pattern
+        Regular expression with capture groups.
+    Returns
+    -------
+    extracted: pd.DataFrame
+        One column per capture group, with the index of values_.
+    """
+    codes, uniques = pd.factorize(values_)
+    extracted = pd.Series(uniques, dtype=object).str.extract(pattern_, expand=True)
+    # Code -1 (missing value) gets a row of NaN, like str.extract.
+    extracted = extracted.reindex(codes)
+    extracted.index = values_.index
+    return extracted
+
+
+def map_index_level(index_, level_, key_map_):
+    """
+    Replace the level_ values of index_ with the values they map to in key_map_. A value
+    mapped to several new values (e.g. a vehicle type in overlapping report classes)
+    repeats its entries; a value mapped to none drops them.
+    Parameters
+    ----------
+    index_: pd.MultiIndex
+        Index with a level_ level.
+    level_: str
+        Level to replace.
+    key_map_: pd.DataFrame
+        Two columns: level_ and the new level. One row per (old value, new value) pair.
+    Returns
+    -------
+    positions: np.ndarray
+        Position in index_ of each entry of new_index.
+    new_index: pd.MultiIndex
+        index_ entries at positions, with the new level in place of level_.
+    """
+    new_level = [colnm for colnm in key_map_.columns if colnm != level_]
+    if (len(key_map_.columns) != 2) or (len(new_level) != 1):
+        raise ValueError(f"key_map_ needs two columns: {level_} and the new level.")
+    new_level = new_level[0]
+    pairs = pd.DataFrame(
+        {"position": np.arange(len(index_)), level_: index_.get_level_values(level_)}
+    ).merge(categories_to_object(key_map_), on=level_)
+    new_index = index_[pairs.position.values].to_frame(index=False)
+    new_index[level_] = pairs[new_level].values
+    return (
+        pairs.position.values,
+        pd.MultiIndex.from_frame(new_index.rename(columns={level_: new_level})),
+    )
+
+
+def get_memory_usage_mb(df_):
+    """
+    Deep memory usage of df_ in MB.
+    """
+    return df_.memory_usage(deep=True).sum() / 2 ** 20
+
+
+def get_default_dtype_memory_usage_mb(df_):
+    """
+    Estimated deep memory usage of df_ in MB if it used the default pandas dtypes:
+    int64/ float64 for numbers and object columns of strings for the categoricals. The
+    estimate is computed from the category counts without building the full-width frame.
+    """
+    n_rows = len(df_)
+    memory_bytes = df_.index.memory_usage(deep=True)
+    for _, col in df_.items():
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            # Object column: one pointer per row plus the size of each row's object.
+            # Missing values (code -1) are counted as np.nan (last size).
+            category_sizes = np.array(
+                [sys.getsizeof(category) for category in col.cat.categories]
+                + [sys.getsizeof(np.nan)]
+            )
+            codes = np.where(
+                col.cat.codes.values >= 0, col.cat.codes.values, len(category_sizes) - 1
+            )
+            memory_bytes += (
+                8 * n_rows
+                + np.bincount(codes, minlength=len(category_sizes)) @ category_sizes
+            )
+        elif col.dtype.kind in "biuf":
+            memory_bytes += 8 * n_rows
+        else:
+            memory_bytes += col.memory_usage(deep=True, index=False)
+    return memory_bytes / 2 ** 20
+
+
+def print_memory_saved(df_, name_):
+    """
+    Print the memory used by df_ and the memory saved compared to the default dtypes.
+    """
+    memory_mb = get_memory_usage_mb(df_)
+    default_memory_mb = get_default_dtype_memory_usage_mb(df_)
+    print(
+        f"{name_}: {memory_mb:.1f} MB with compact dtypes, {default_memory_mb:.1f} MB "
+        f"with default dtypes ({default_memory_mb - memory_mb:.1f} MB saved)."
+    )
+
+
+class TimeIntervalSpec:
+    """
+    Vissim time intervals (e.g. "2700-3600") and their report labels. Built once in the
+    01-04 scripts and shared by TtEval, BusHeadway, LinkSegEval and NodeEval so that all
+    the modules use the same interval definitions.
+
+    ...
+    Attributes
+    ___________
+    order_timeint: list
+        Time intervals in report order, "start-end" in seconds.
+    labels: list
+        Report label for each interval in order_timeint.
+    starts: np.ndarray
+        Interval start times (s).
+    ends: np.ndarray
+        Interval end times (s).
+    label_dtype: pd.CategoricalDtype
+        Ordered categorical dtype with labels as categories.
+    Methods
+    ________
+    get_codes(time_): Interval code (position in order_timeint) for each time; -1 for
+        times outside the intervals.
+    bin_times(time_): Categorical of labels for each time.
+    get_timeint_codes(timeint_): Interval code for "start-end" strings.
+    label_timeint(timeint_): Categorical of labels for "start-end" strings.
+    """
+
+    def __init__(self, order_timeint_, order_timeint_labels_=None):
+        """
+        Parameters
+        ----------
+        order_timeint_: list
+            Time intervals in report order, e.g. ["2700-3600", "3600-4500"]. Intervals
+            are closed on the left: 3600 is in "3600-4500".
+        order_timeint_labels_: list or dict
+            Labels for order_timeint_ (list in the same order, or interval --> label
+            dict). None uses the intervals as labels.
+        """
+        self.order_timeint = list(order_timeint_)
+        if order_timeint_labels_ is None:
+            self.labels = list(self.order_timeint)
+        elif isinstance(order_timeint_labels_, dict):
+            self.labels = [order_timeint_labels_[timeint] for timeint in self.order_timeint]
+        else:
+            self.labels = list(order_timeint_labels_)
+        if len(self.labels) != len(self.order_timeint):
+            raise ValueError("Pass one label for each time interval.")
+        bounds = np.array(
+            [[float(bound) for bound in timeint.split("-")] for timeint in self.order_timeint]
+        ).reshape(-1, 2)
+        self.starts = bounds[:, 0]
+        self.ends = bounds[:, 1]
+        # Intervals sorted by start time for np.searchsorted.
+        self._sort_order = np.argsort(self.starts, kind="stable")
+        starts_sorted = self.starts[self._sort_order]
+        if (starts_sorted[1:] < self.ends[self._sort_order][:-1]).any():
+            raise ValueError("Time intervals overlap.")
+        self.label_dtype = pd.CategoricalDtype(self.labels, ordered=True)
+        self._timeint_index = pd.Index(self.order_timeint)
+
+    def get_codes(self, time_):
+        """
+        Interval code (position in order_timeint) for each time; -1 for times outside
+        the intervals. Same intervals as pd.cut with a left-closed IntervalIndex.
+        """
+        time = np.asarray(time_, dtype=np.float64)
+        pos = np.searchsorted(self.starts[self._sort_order], time, side="right") - 1
+        pos_clip = np.clip(pos, 0, None)
+        in_interval = (pos >= 0) & (time < self.ends[self._sort_order][pos_clip])
+        return np.where(in_interval, self._sort_order[pos_clip], -1).astype(np.int16)
+
+    def bin_times(self, time_):
+        """
+        Categorical of labels for each time. NaN for times outside the intervals.
+        """
+        return pd.Categorical.from_codes(self.get_codes(time_), dtype=self.label_dtype)
+
+    def get_timeint_codes(self, timeint_):
+        """
+        Interval code for each "start-end" string (e.g. the TIMEINT column of the .att
+        files); -1 for strings not in order_timeint.
+        """
+        if isinstance(getattr(timeint_, "dtype", None), pd.CategoricalDtype):
+            # Look up the categories only and broadcast with the codes.
+            timeint_cat = pd.Categorical(timeint_)
+            category_codes = np.append(
+                self._timeint_index.get_indexer(timeint_cat.categories.astype(str)), -1
+            )
+            return category_codes[timeint_cat.codes].astype(np.int16)
+        return self._timeint_index.get_indexer(np.asarray(timeint_)).astype(np.int16)
+
+    def label_timeint(self, timeint_):
+        """
+        Categorical of labels for each "start-end" string. NaN for strings not in
+        order_timeint.
+        """
+        return pd.Categorical.from_codes(
+            self.get_timeint_codes(timeint_), dtype=self.label_dtype
+        )